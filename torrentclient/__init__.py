@@ -1,5 +0,0 @@
-import logging
-logging.basicConfig(
-    format='%(asctime)s %(levelname)s - %(process)d - %(name)s - %(message)s',
-    level=logging.DEBUG,
-)
@@ -0,0 +1,237 @@
+import random
+import struct
+import asyncio
+import logging
+from typing import List, Optional
+from urllib.parse import parse_qs
+
+import bencode
+
+from torrentclient.peerinteract.ratelimit import TokenBucket
+
+
+class FakeSeeder:
+    """Loopback peer having all pieces of a payload, answering requests as a remote peer would:
+    every message it sends is delayed by `latency` and the blocks it sends are limited to `bandwidth`.
+    Loopback TCP loses nothing, so a `loss` fraction of the blocks is delayed by RETRANSMIT_TIMEOUT,
+    holding up the messages after it as a retransmitted segment would."""
+
+    HANDSHAKE_LENGTH = 68
+    PEER_ID_BYTE = 48
+
+    RETRANSMIT_TIMEOUT = 0.2  # [seconds]
+    """minimal retransmission timeout of Linux TCP"""
+
+    logger = logging.getLogger('fake-seeder')
+
+    def __init__(self, payload: bytes, piece_length: int, index: int, port: int, latency: float = 0,
+                 loss: float = 0, bandwidth: Optional[float] = None):
+        """
+        :param payload: entire content of the torrent
+        :param piece_length: bytes per piece
+        :param index: number of the seeder, part of its peer ID
+        :param port: loopback port to listen on
+        :param latency: seconds every message is delayed by
+        :param loss: fraction of the requested blocks which are retransmitted
+        :param bandwidth: bytes per second of blocks sent to all peers, unlimited if None
+        """
+        self.payload = memoryview(payload)
+        self.piece_length = piece_length
+        self.piece_count = -(-len(payload) // piece_length)
+        self.peer_id = "-FS0001-{:012d}".format(index).encode("utf-8")
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.bucket = TokenBucket(bandwidth)
+        self.server = None
+        self.uploaded = 0
+
+    def __str__(self):
+        return "FakeSeeder(port={}, latency={}, loss={}, bandwidth={})".format(
+            self.port, self.latency, self.loss, self.bucket.rate)
+
+    def _bitfield(self) -> bytes:
+        bitfield = bytearray(b"\xff" * (self.piece_count // 8))
+        if self.piece_count % 8:
+            bitfield.append((0xff << (8 - self.piece_count % 8)) & 0xff)
+        return bytes(bitfield)
+
+    async def _send(self, writer: asyncio.StreamWriter, outbox: asyncio.Queue):
+        """writes the queued messages once their delay passed, in order"""
+        loop = asyncio.get_running_loop()
+        while True:
+            due, message, block_length = await outbox.get()
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            if block_length:
+                await self.bucket.take(block_length)
+                self.uploaded += block_length
+            writer.write(message)
+            await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        outbox = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send(writer, outbox))
+
+        def queue(message: bytes, block_length: int = 0, delay: float = 0):
+            outbox.put_nowait((loop.time() + self.latency + delay, message, block_length))
+        try:
+            handshake = await reader.readexactly(self.HANDSHAKE_LENGTH)
+            queue(handshake[:self.PEER_ID_BYTE] + self.peer_id)
+            bitfield = self._bitfield()
+            queue(struct.pack(">IB", 1 + len(bitfield), 5) + bitfield)
+            while True:
+                length = struct.unpack(">I", await reader.readexactly(4))[0]
+                if length == 0:
+                    continue  # KeepAlive
+                body = await reader.readexactly(length)
+                if body[0] == 2:  # Interested
+                    queue(struct.pack(">IB", 1, 1))
+                elif body[0] == 6:  # RequestBlock
+                    piece_idx, begin, block_length = struct.unpack(">III", body[1:13])
+                    offset = piece_idx * self.piece_length + begin
+                    queue(struct.pack(">IBII", 9 + block_length, 7, piece_idx, begin) +
+                          self.payload[offset:offset + block_length], block_length,
+                          self.RETRANSMIT_TIMEOUT if random.random() < self.loss else 0)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class FakeTracker:
+    """Loopback HTTP tracker returning the same compact peers list to every announce"""
+
+    INTERVAL = 1800  # [seconds]
+
+    logger = logging.getLogger('fake-tracker')
+
+    def __init__(self, port: int, peer_ports: List[int]):
+        """
+        :param port: loopback port to listen on
+        :param peer_ports: loopback ports of the peers returned
+        """
+        self.port = port
+        self.peers = b"".join(struct.pack(">4sH", bytes([127, 0, 0, 1]), peer_port) for peer_port in peer_ports)
+        self.announces = []  # query parameters of every announce
+        self.server = None
+
+    def __str__(self):
+        return "FakeTracker(port={}, peers={})".format(self.port, len(self.peers) // 6)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}/announce".format(self.port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # headers
+            target = request_line.split()[1].decode("latin-1")
+            self.announces.append(parse_qs(target.partition("?")[2], encoding="latin-1"))
+            body = bencode.bencode({'interval': self.INTERVAL, 'peers': self.peers})
+            writer.write("HTTP/1.1 200 OK\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                len(body)).encode("latin-1") + body)
+            await writer.drain()
+        except (IndexError, ConnectionError) as e:
+            self.logger.warning("Invalid announce: {}".format(e))
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class FakeUdpTracker(asyncio.DatagramProtocol):
+    """Loopback UDP tracker (BEP 15) returning the same compact peers list to every announce.
+    A `loss` fraction of the received datagrams is dropped, so clients have to retransmit"""
+
+    PROTOCOL_ID = 0x41727101980
+
+    ACTION_CONNECT = 0
+    ACTION_ANNOUNCE = 1
+    ACTION_ERROR = 3
+
+    CONNECT_REQUEST = struct.Struct(">QII")
+    ANNOUNCE_REQUEST = struct.Struct(">QII20s20sQQQIIIiH")
+
+    INTERVAL = 1800  # [seconds]
+
+    logger = logging.getLogger('fake-udp-tracker')
+
+    def __init__(self, port: int, peer_ports: List[int], loss: float = 0):
+        """
+        :param port: loopback port to listen on
+        :param peer_ports: loopback ports of the peers returned
+        :param loss: fraction of the received datagrams which are dropped
+        """
+        self.port = port
+        self.peers = b"".join(struct.pack(">4sH", bytes([127, 0, 0, 1]), peer_port) for peer_port in peer_ports)
+        self.loss = loss
+        self.connection_ids = set()
+        self.announces = []  # (info hash, port, event) of every announce
+        self.dropped = 0
+        self.transport = None
+
+    def __str__(self):
+        return "FakeUdpTracker(port={}, peers={}, loss={})".format(self.port, len(self.peers) // 6, self.loss)
+
+    @property
+    def url(self) -> str:
+        return "udp://127.0.0.1:{}/announce".format(self.port)
+
+    def _error(self, transaction_id: int, message: str) -> bytes:
+        return struct.pack(">II", self.ACTION_ERROR, transaction_id) + message.encode("utf-8")
+
+    def _respond(self, data: bytes) -> bytes:
+        if len(data) < self.CONNECT_REQUEST.size:
+            return b""
+        connection_id, action, transaction_id = self.CONNECT_REQUEST.unpack_from(data)
+        if action == self.ACTION_CONNECT:
+            if connection_id != self.PROTOCOL_ID:
+                return self._error(transaction_id, "invalid protocol ID")
+            connection_id = random.getrandbits(64)
+            self.connection_ids.add(connection_id)
+            return struct.pack(">IIQ", self.ACTION_CONNECT, transaction_id, connection_id)
+        if action != self.ACTION_ANNOUNCE or len(data) < self.ANNOUNCE_REQUEST.size:
+            return self._error(transaction_id, "invalid request")
+        if connection_id not in self.connection_ids:
+            return self._error(transaction_id, "unknown connection ID")
+        fields = self.ANNOUNCE_REQUEST.unpack_from(data)
+        infohash, event, port = fields[3], fields[8], fields[12]
+        self.announces.append((infohash, port, event))
+        return struct.pack(">IIIII", self.ACTION_ANNOUNCE, transaction_id, self.INTERVAL, 0,
+                           len(self.peers) // 6) + self.peers
+
+    def datagram_received(self, data: bytes, addr):
+        if random.random() < self.loss:
+            self.dropped += 1
+            return
+        response = self._respond(data)
+        if response:
+            self.transport.sendto(response, addr)
+
+    async def start(self):
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, local_addr=("127.0.0.1", self.port))
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
@@ -0,0 +1,251 @@
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import timeit
+from typing import Callable, Dict, List, Optional, Tuple
+
+from torrentclient import logconfig
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.peerinteract.peer import Peer
+from torrentclient.peerinteract.connection import PeerConnection
+from torrentclient.peerinteract.getpiece import GetPiece
+from torrentclient.peercode.framer import MessageFramer
+from torrentclient.peercode.allmessages import KeepAlive, Choke, UnChoke, Interested, NotInterested, HavePiece, \
+    PiecesBitField, RequestBlock, Block, CancelRequest, Port, all_messages
+from torrentclient.trackerinteract.handleresponse import HandleResponse
+from torrentclient.benchmark.swarmbench import make_torrent
+
+
+class MicroBenchmark:
+    """A hot path timed in isolation.
+    `run(number)` returns the seconds `number` calls of the path took, each call handling `items` items
+    (e.g. messages or peers), so results of different sizes are comparable per item."""
+
+    def __init__(self, name: str, run: Callable[[int], float], items: int = 1):
+        """
+        :param name: dotted name of the benchmark, e.g. "peercode.encode.Block"
+        :param run: times `number` calls of the path
+        :param items: number of items handled by every call
+        """
+        self.name = name
+        self.run = run
+        self.items = items
+
+    def __str__(self):
+        return "MicroBenchmark(name={}, items={})".format(self.name, self.items)
+
+    @classmethod
+    def of(cls, name: str, function: Callable[[], object], items: int = 1) -> 'MicroBenchmark':
+        """benchmark of calling a synchronous function"""
+        return cls(name, timeit.Timer(function).timeit, items)
+
+    def measure(self, repeat: int = 5, min_time: float = 0.2) -> float:
+        """returns the best seconds per item over `repeat` runs, each run calls the path for at least `min_time`"""
+        number = 1
+        while True:
+            seconds = self.run(number)
+            if seconds >= min_time:
+                break
+            number = max(number * 2, int(number * min_time / seconds) if seconds > 0 else number * 10)
+        best = seconds
+        for _ in range(repeat - 1):
+            best = min(best, self.run(number))
+        return best / number / self.items
+
+
+SAMPLE_MESSAGES = {
+    KeepAlive: KeepAlive(),
+    Choke: Choke(),
+    UnChoke: UnChoke(),
+    Interested: Interested(),
+    NotInterested: NotInterested(),
+    HavePiece: HavePiece(1234),
+    PiecesBitField: PiecesBitField(bytes(range(256)) * 4),
+    RequestBlock: RequestBlock(1234, 2 ** 16, MyTorrent.BLOCK_SIZE),
+    Block: Block(1234, 2 ** 16, bytes(MyTorrent.BLOCK_SIZE)),
+    CancelRequest: CancelRequest(1234, 2 ** 16, MyTorrent.BLOCK_SIZE),
+    Port: Port(6881),
+}
+"""a message of every class, as sent in a swarm"""
+
+DECODE_BATCH = 64
+"""number of copies of a message framed at once"""
+
+
+def message_benchmarks() -> List[MicroBenchmark]:
+    benchmarks = []
+    for message_cls in all_messages:
+        message = SAMPLE_MESSAGES[message_cls]
+        encoded = bytes(message.create()) * DECODE_BATCH
+        framer = MessageFramer()
+        benchmarks.append(MicroBenchmark.of("peercode.encode.{}".format(message_cls.__name__), message.create))
+        benchmarks.append(MicroBenchmark.of("peercode.decode.{}".format(message_cls.__name__),
+                                            lambda framer=framer, encoded=encoded: framer.feed(encoded),
+                                            items=DECODE_BATCH))
+    return benchmarks
+
+
+def synthetic_messages_stream(block_count: int = 2, small_count: int = 64) -> Tuple[bytes, int]:
+    """returns encoded messages as a peer sends them while uploading - haves, requests, control and a few blocks,
+    and the number of messages"""
+    messages = [Interested(), UnChoke()]
+    for idx in range(small_count):
+        messages.append(HavePiece(idx) if idx % 2 else RequestBlock(idx, 0, MyTorrent.BLOCK_SIZE))
+        if idx < block_count:
+            messages.append(Block(idx, 0, bytes(MyTorrent.BLOCK_SIZE)))
+    messages.append(KeepAlive())
+    return b"".join(bytes(message.create()) for message in messages), len(messages)
+
+
+def parse_response_benchmark() -> MicroBenchmark:
+    """`PeerConnection._parse_response` of a stream written to a local socket pair,
+    the stream is small enough to fit in the socket buffers"""
+    stream, message_count = synthetic_messages_stream()
+
+    def run(number: int) -> float:
+        async def main() -> float:
+            local, remote = socket.socketpair()
+            local.setblocking(False)
+            connection = PeerConnection(Peer("127.0.0.1", 6881), local)
+            try:
+                started = time.perf_counter()
+                for _ in range(number):
+                    remote.sendall(stream)
+                    parsed = 0
+                    while parsed < message_count:
+                        parsed += len(await connection._parse_response())
+                return time.perf_counter() - started
+            finally:
+                connection.close()
+                remote.close()
+        return asyncio.run(main())
+    return MicroBenchmark("peerinteract.parse_response", run, items=message_count)
+
+
+PEER_COUNTS = (10 ** 4, 10 ** 5, 10 ** 6)
+
+
+def compact_peers(count: int) -> bytes:
+    return b"".join(bytes([10, (idx >> 16) & 0xff, (idx >> 8) & 0xff, idx & 0xff]) + (6881 + idx % 1000).to_bytes(
+        2, byteorder="big") for idx in range(count))
+
+
+def parse_peers_benchmarks(peer_counts=PEER_COUNTS) -> List[MicroBenchmark]:
+    benchmarks = []
+    for count in peer_counts:
+        handle_response = HandleResponse(response=None)
+        handle_response.bresponse = {'peers': compact_peers(count)}
+        benchmarks.append(MicroBenchmark.of("trackerinteract.parse_peers_bytes.{}".format(count),
+                                            handle_response._parse_peers_bytes, items=count))
+    return benchmarks
+
+
+def torrent_benchmarks(torrent: MyTorrent) -> List[MicroBenchmark]:
+    def access_properties():
+        return (torrent.total_length, torrent.piece_count, torrent.my_piece_size, torrent.block_count,
+                torrent.block_size, torrent.infohash, torrent.hashes[torrent.piece_count - 1])
+    return [
+        MicroBenchmark.of("mytorrent.properties", access_properties, items=7),
+        MicroBenchmark.of("mytorrent.blocks", lambda: torrent.blocks(torrent.piece_count - 1)),
+    ]
+
+
+def getpiece_benchmarks(torrent: MyTorrent, payload: bytes) -> List[MicroBenchmark]:
+    """assembly of the blocks of the first piece in reverse order, as received from several peers, and its hashing"""
+    getter = GetPiece(None, torrent, piece_idx=0)
+    piece = memoryview(payload)[:torrent.meta.piece_size(0)]
+    blocks = [Block(0, block_begin, piece[block_begin:block_begin + block_length])
+              for block_begin, block_length in reversed(torrent.blocks(0))]
+    requested = {(0, block_begin): block_length for block_begin, block_length in torrent.blocks(0)}
+
+    def assemble():
+        getter.outstanding = dict(requested)
+        getter.progress.received.clear()
+        getter._store_blocks(blocks)
+    assemble()
+    return [
+        MicroBenchmark.of("getpiece.assemble", assemble, items=len(blocks)),
+        MicroBenchmark.of("getpiece.hash", getter._validate_hash),
+    ]
+
+
+def all_benchmarks(root: str, peer_counts=PEER_COUNTS) -> List[MicroBenchmark]:
+    """returns every micro-benchmark, the torrent they use is generated in `root`"""
+    torrent_path, payload = make_torrent(root, size=2 ** 22, piece_length=2 ** 18, announce="http://127.0.0.1/")
+    torrent = MyTorrent.read(filepath=torrent_path)
+    return message_benchmarks() + [parse_response_benchmark()] + parse_peers_benchmarks(peer_counts) + \
+        torrent_benchmarks(torrent) + getpiece_benchmarks(torrent, payload)
+
+
+def run_benchmarks(name_filter: str = "", repeat: int = 5, min_time: float = 0.2,
+                   peer_counts=PEER_COUNTS) -> Dict[str, float]:
+    """returns the best seconds per item of every benchmark whose name contains `name_filter`"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="microbench-") as root:
+        for benchmark in all_benchmarks(root, peer_counts):
+            if name_filter in benchmark.name:
+                results[benchmark.name] = benchmark.measure(repeat, min_time)
+    return results
+
+
+def save_baseline(path: str, results: Dict[str, float]):
+    with open(path, "w") as out:
+        json.dump({
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'seconds_per_item': results,
+        }, out, indent=2, sort_keys=True)
+
+
+def load_baseline(path: str) -> Dict[str, float]:
+    with open(path) as baseline:
+        return json.load(baseline)['seconds_per_item']
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    """returns the names of the benchmarks slower than their baseline by more than `threshold` (a fraction)"""
+    return [name for name, seconds in results.items()
+            if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+
+def format_result(name: str, seconds: float, baseline: Optional[float]) -> str:
+    line = "{:<45} {:>12.1f} ns".format(name, seconds * 1e9)
+    if baseline is not None:
+        line += "  {:+7.1%} vs baseline {:.1f} ns".format(seconds / baseline - 1, baseline * 1e9)
+    return line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='torrentclient-microbench')
+    parser.add_argument("--filter", default="", help="run only the benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every benchmark, the best one counts")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds of every run")
+    parser.add_argument("--peers", type=int, nargs="+", default=PEER_COUNTS,
+                        help="numbers of compact peers parsed")
+    parser.add_argument("--save", help="write the results to this baseline JSON file")
+    parser.add_argument("--compare", help="compare the results to this baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fraction a benchmark may be slower than its baseline before failing")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logconfig.configure(*logconfig.parse_levels(args.log_level))
+    results = run_benchmarks(args.filter, args.repeat, args.min_time, args.peers)
+    baseline = load_baseline(args.compare) if args.compare else {}
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for name, seconds in results.items():
+            print(format_result(name, seconds, baseline.get(name)))
+    if args.save:
+        save_baseline(args.save, results)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("Regressed by more than {:.0%}: {}".format(args.threshold, ", ".join(regressions)), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,203 @@
+import os
+import json
+import socket
+import asyncio
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import time
+import multiprocessing
+from typing import List, Optional, Tuple
+
+import bencode
+
+from torrentclient.main import get_files
+from torrentclient.metrics import Metrics
+from torrentclient import logconfig
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.diskinteract.storage import Storage
+from torrentclient.benchmark.fakeswarm import FakeSeeder, FakeTracker, FakeUdpTracker
+
+
+class BenchmarkResult:
+    """Data class of a single download from a loopback swarm"""
+
+    def __init__(self, size: int, seconds: float, first_piece_seconds: Optional[float], cpu_seconds: float,
+                 peak_rss: int, valid: bool):
+        """
+        :param size: bytes downloaded
+        :param seconds: wall time of the download
+        :param first_piece_seconds: time from the start of the download to the first piece obtained
+        :param cpu_seconds: user and system CPU time of the download
+        :param peak_rss: peak resident set size of the process [bytes]
+        :param valid: whether the downloaded content matches the payload
+        """
+        self.size = size
+        self.seconds = seconds
+        self.first_piece_seconds = first_piece_seconds
+        self.cpu_seconds = cpu_seconds
+        self.peak_rss = peak_rss
+        self.valid = valid
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.size / 2 ** 20 / self.seconds
+
+    def __str__(self):
+        return "{:.1f} MB/s, {:.2f}s total, first piece after {}, {:.2f}s CPU, peak RSS {:.1f} MB{}".format(
+            self.mb_per_second, self.seconds,
+            "{:.3f}s".format(self.first_piece_seconds) if self.first_piece_seconds is not None else "-",
+            self.cpu_seconds, self.peak_rss / 2 ** 20, "" if self.valid else ", INVALID CONTENT")
+
+    def as_dict(self) -> dict:
+        return {
+            'size': self.size,
+            'seconds': self.seconds,
+            'mb_per_second': self.mb_per_second,
+            'first_piece_seconds': self.first_piece_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'peak_rss': self.peak_rss,
+            'valid': self.valid,
+        }
+
+
+def make_torrent(root: str, size: int, piece_length: int, announce: str, file_count: int = 1) -> Tuple[str, bytes]:
+    """generates a random payload and a torrent file of it in `root`, returns the torrent path and the payload
+    :param announce: URL of the torrent's tracker
+    :param file_count: number of files the payload is split into evenly
+    """
+    payload = os.urandom(size)
+    info = {
+        'name': "payload",
+        'piece length': piece_length,
+        'pieces': b"".join(hashlib.sha1(payload[offset:offset + piece_length]).digest()
+                           for offset in range(0, size, piece_length)),
+    }
+    if file_count == 1:
+        info['length'] = size
+    else:
+        lengths = [size // file_count] * file_count
+        lengths[-1] += size - sum(lengths)
+        info['files'] = [{'path': ["file{}".format(file_idx)], 'length': length}
+                         for file_idx, length in enumerate(lengths)]
+    torrent_path = os.path.join(root, "payload.torrent")
+    with open(torrent_path, "wb") as out:
+        out.write(bencode.bencode({'announce': announce, 'info': info}))
+    return torrent_path, payload
+
+
+def free_ports(count: int) -> List[int]:
+    """returns loopback ports which were free a moment ago"""
+    sockets = []
+    try:
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(("127.0.0.1", 0))
+            sockets.append(sock)
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def run_swarm(connection, root: str, size: int, piece_length: int, file_count: int, tracker_port: int,
+              seeder_ports: List[int], latency: float, loss: float, bandwidth: Optional[float], udp: bool = False):
+    """runs a fake tracker and seeders of a generated torrent in a process of their own,
+    so they do not count towards the CPU time and memory of the download.
+    sends the torrent path and the SHA-1 of the payload to `connection` once they serve
+    :param udp: whether the tracker is a UDP one, dropping a `loss` fraction of the datagrams, otherwise HTTP
+    """
+    logconfig.configure(logging.getLevelName(logging.getLogger().level))  # the forked listener has no thread
+    tracker = FakeUdpTracker(tracker_port, seeder_ports, loss) if udp else FakeTracker(tracker_port, seeder_ports)
+    torrent_path, payload = make_torrent(root, size, piece_length, tracker.url, file_count)
+
+    async def serve():
+        seeders = [FakeSeeder(payload, piece_length, index, port, latency, loss, bandwidth)
+                   for index, port in enumerate(seeder_ports)]
+        for server in [tracker] + seeders:
+            await server.start()
+        connection.send((torrent_path, tracker.url, hashlib.sha1(payload).hexdigest()))
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def content_digest(torrent: MyTorrent, storage: Storage) -> str:
+    digest = hashlib.sha1()
+    for path in storage.paths:
+        with open(path, "rb") as data:
+            for chunk in iter(lambda: data.read(2 ** 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_benchmark(size: int = 64 * 2 ** 20, piece_length: int = 2 ** 18, seeders: int = 4, latency: float = 0,
+                  loss: float = 0, bandwidth: Optional[float] = None, file_count: int = 1,
+                  udp: bool = False) -> BenchmarkResult:
+    """downloads a generated torrent with `get_files` from loopback seeders found through a loopback tracker
+    :param size: bytes of the payload
+    :param piece_length: bytes per piece
+    :param seeders: number of seeders
+    :param latency: seconds every message of a seeder is delayed by
+    :param loss: fraction of the requested blocks a seeder retransmits
+    :param bandwidth: bytes per second of every seeder, unlimited if None
+    :param file_count: number of files the payload is split into
+    :param udp: whether the seeders are found through a UDP tracker (BEP 15) instead of an HTTP one
+    """
+    root = tempfile.mkdtemp(prefix="swarmbench-")
+    tracker_port, *seeder_ports = free_ports(seeders + 1)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    swarm = multiprocessing.Process(target=run_swarm, daemon=True, args=(
+        sender, root, size, piece_length, file_count, tracker_port, seeder_ports, latency, loss, bandwidth, udp))
+    swarm.start()
+    cwd = os.getcwd()
+    try:
+        torrent_path, tracker_url, payload_digest = receiver.recv()
+        trackers_path = os.path.join(root, "trackers.txt")
+        with open(trackers_path, "w") as out:
+            out.write(tracker_url + "\n")
+        os.chdir(root)  # downloads, resume and cache files are relative to the working directory
+        metrics = Metrics()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.monotonic()
+        get_files(torrent_path, trackers_path=trackers_path, metrics=metrics)
+        seconds = time.monotonic() - started
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        torrent = MyTorrent.read(filepath=torrent_path)
+        valid = content_digest(torrent, Storage(torrent)) == payload_digest
+    finally:
+        os.chdir(cwd)
+        swarm.terminate()
+        swarm.join()
+    return BenchmarkResult(
+        size=size,
+        seconds=seconds,
+        first_piece_seconds=metrics.get("first_piece_seconds") or None,
+        cpu_seconds=end_usage.ru_utime + end_usage.ru_stime - usage.ru_utime - usage.ru_stime,
+        peak_rss=end_usage.ru_maxrss * 1024,  # [kilobytes] on Linux
+        valid=valid,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='torrentclient-swarmbench')
+    parser.add_argument("--size", type=float, default=64, help="MiB of the payload")
+    parser.add_argument("--piece-length", type=int, default=256, help="KiB per piece")
+    parser.add_argument("--files", type=int, default=1, help="number of files the payload is split into")
+    parser.add_argument("--seeders", type=int, default=4, help="number of loopback seeders")
+    parser.add_argument("--latency", type=float, default=0, help="seconds every message of a seeder is delayed by")
+    parser.add_argument("--loss", type=float, default=0, help="fraction of the requested blocks retransmitted")
+    parser.add_argument("--bandwidth", type=float, help="KiB per second of every seeder, unlimited by default")
+    parser.add_argument("--udp", action="store_true", help="find the seeders through a UDP tracker")
+    parser.add_argument("--repeat", type=int, default=1, help="number of downloads")
+    parser.add_argument("--json", action="store_true", help="print every result as a JSON line")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logconfig.configure(*logconfig.parse_levels(args.log_level))
+    for _ in range(args.repeat):
+        result = run_benchmark(size=int(args.size * 2 ** 20), piece_length=args.piece_length * 2 ** 10,
+                               seeders=args.seeders, latency=args.latency, loss=args.loss,
+                               bandwidth=args.bandwidth * 2 ** 10 if args.bandwidth is not None else None,
+                               file_count=args.files, udp=args.udp)
+        print(json.dumps(result.as_dict()) if args.json else result)
@@ -0,0 +1,77 @@
+import mmap
+import threading
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.diskinteract.storage import Storage
+
+
+class MmapStorage(Storage):
+    """Storage keeping every file open and memory-mapped for the whole download.
+    Pieces are copied into the mappings, dirty pages are written back by the OS
+    and made durable only by `flush`, which is called on a schedule instead of per piece.
+    Uploaded blocks are sent straight from memoryviews of the mappings."""
+
+    def __init__(self, torrent: MyTorrent, root: str = Storage.ROOT):
+        super().__init__(torrent, root)
+        self.files = {}  # file index -> open file object
+        self.mappings = {}  # file index -> mmap
+        self.lock = threading.Lock()  # mappings are opened lazily from disk and hashing threads
+
+    def __str__(self):
+        return "MmapStorage(base_path={}, files={}, mapped={})".format(
+            self.base_path, len(self.paths), len(self.mappings))
+
+    def _mapping(self, file_idx: int) -> mmap.mmap:
+        """returns the mapping of a file, opening it on first use. files must be preallocated"""
+        mapping = self.mappings.get(file_idx)
+        if mapping is None:
+            with self.lock:
+                mapping = self.mappings.get(file_idx)
+                if mapping is None:
+                    file = open(self.paths[file_idx], "rb+")
+                    try:
+                        mapping = mmap.mmap(file.fileno(), self.lengths[file_idx], access=mmap.ACCESS_WRITE)
+                    except (OSError, ValueError) as e:
+                        file.close()
+                        raise Storage.Exception("Could not map {}: {}".format(self.paths[file_idx], e))
+                    self.files[file_idx] = file
+                    self.mappings[file_idx] = mapping
+        return mapping
+
+    def write(self, offset: int, data: bytes):
+        view = memoryview(data)
+        for file_idx, file_offset, length in self.spans(offset, len(view)):
+            self._mapping(file_idx)[file_offset:file_offset + length] = view[:length]
+            self._mark_dirty(file_idx)
+            view = view[length:]
+
+    def flush(self):
+        """writes back dirty pages of files written since the last flush and waits for them (msync)"""
+        for file_idx in self._take_dirty():
+            self.mappings[file_idx].flush()
+
+    def close(self):
+        super().close()
+        with self.lock:
+            for mapping in self.mappings.values():
+                mapping.close()
+            for file in self.files.values():
+                file.close()
+            self.mappings.clear()
+            self.files.clear()
+
+    def readinto(self, offset: int, view: memoryview) -> int:
+        read_count = 0
+        for file_idx, file_offset, length in self.spans(offset, len(view)):
+            try:
+                mapping = self._mapping(file_idx)
+            except (Storage.Exception, FileNotFoundError):
+                break
+            view[read_count:read_count + length] = mapping[file_offset:file_offset + length]
+            read_count += length
+        return read_count
+
+    def sendable(self, offset: int, length: int) -> list:
+        """returns memoryviews of the mappings, which must be released before the storage is closed"""
+        return [memoryview(self._mapping(file_idx))[file_offset:file_offset + span_length]
+                for file_idx, file_offset, span_length in self.spans(offset, length)]
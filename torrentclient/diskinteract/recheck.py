@@ -0,0 +1,114 @@
+import os
+import time
+import hashlib
+import logging
+from typing import List, Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.diskinteract.storage import Storage
+
+
+class RecheckResult:
+    """Data class of the outcome of a Recheck"""
+
+    def __init__(self, piece_count: int):
+        self.bitfield = bytearray(-(-piece_count // 8))  # pieces matching their hash
+        self.bad_pieces = []
+        self.checked_count = 0
+        self.checked_bytes = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return "Checked {} pieces ({:.1f} MB) in {:.2f}s: {:.1f} MB/s, {} bad pieces".format(
+            self.checked_count, self.checked_bytes / 2 ** 20, self.seconds, self.throughput / 2 ** 20,
+            len(self.bad_pieces))
+
+    @property
+    def throughput(self) -> float:
+        """[bytes/second]"""
+        return self.checked_bytes / self.seconds if self.seconds else 0.0
+
+    def set_good(self, piece_idx: int):
+        self.bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+
+
+class Recheck:
+    """Hashes pieces of existing data against the torrent's piece hashes with a pool of threads,
+    hashlib releases the GIL so hashing scales with cores.
+    Pieces are split into one contiguous stripe per thread, each stripe is read sequentially in large chunks."""
+
+    CHUNK_SIZE = 2 ** 24  # [bytes] rounded to whole pieces
+
+    WORKERS = os.cpu_count() or 1
+
+    logger = logging.getLogger('recheck')
+
+    class Exception(Exception):
+        """An exception with re-checking the data occurred"""
+
+    def __init__(self, torrent: MyTorrent, storage: Storage, workers: int = WORKERS):
+        """
+        :param torrent: MyTorrent of the data
+        :param storage: Storage of the torrent content
+        :param workers: number of hashing threads
+        """
+        self.torrent = torrent
+        self.storage = storage
+        self.workers = workers
+        self.chunk_pieces = max(1, self.CHUNK_SIZE // torrent.my_piece_size)
+
+    def __str__(self):
+        return "Recheck(storage={}, workers={})".format(self.storage, self.workers)
+
+    def _check_run(self, first_piece: int, last_piece: int, chunk: bytearray, result: RecheckResult):
+        """checks consecutive pieces `first_piece`..`last_piece` with a single read"""
+        meta = self.torrent.meta
+        view = memoryview(chunk)
+        read_count = self.storage.readinto(meta.piece_offset(first_piece), view[
+            :meta.piece_offset(last_piece) + meta.piece_size(last_piece) - meta.piece_offset(first_piece)])
+        for piece_idx in range(first_piece, last_piece + 1):
+            start = meta.piece_offset(piece_idx) - meta.piece_offset(first_piece)
+            end = start + meta.piece_size(piece_idx)
+            if end <= read_count and hashlib.sha1(view[start:end]).digest() == self.torrent.hashes[piece_idx]:
+                result.set_good(piece_idx)
+            else:
+                result.bad_pieces.append(piece_idx)
+        result.checked_count += last_piece - first_piece + 1
+        result.checked_bytes += read_count
+
+    def _check_stripe(self, pieces: List[int], result: RecheckResult):
+        """checks ascending `pieces`, consecutive ones are read together up to CHUNK_SIZE"""
+        chunk = bytearray(self.chunk_pieces * self.torrent.my_piece_size)
+        run_start = 0
+        for idx in range(1, len(pieces) + 1):
+            if idx == len(pieces) or pieces[idx] != pieces[idx - 1] + 1 or idx - run_start == self.chunk_pieces:
+                self._check_run(pieces[run_start], pieces[idx - 1], chunk, result)
+                run_start = idx
+
+    def check(self, pieces: Iterable[int] = None) -> RecheckResult:
+        """hashes `pieces`, all pieces by default"""
+        if not any(os.path.exists(path) for path in self.storage.paths):
+            raise Recheck.Exception("No data to check at {}".format(self.storage.base_path))
+        pieces = sorted(range(self.torrent.piece_count) if pieces is None else pieces)
+        result = RecheckResult(self.torrent.piece_count)
+        started = time.monotonic()
+        stripe_length = -(-len(pieces) // self.workers) if pieces else 1
+        stripes = [pieces[start:start + stripe_length] for start in range(0, len(pieces), stripe_length)]
+        self.logger.info("Checking {} pieces of {} with {} threads".format(
+            len(pieces), self.storage.base_path, len(stripes)))
+        with ThreadPoolExecutor(self.workers) as executor:
+            stripe_results = [RecheckResult(self.torrent.piece_count) for _ in stripes]
+            for future in [executor.submit(self._check_stripe, stripe, stripe_result)
+                           for stripe, stripe_result in zip(stripes, stripe_results)]:
+                future.result()
+        merged = 0
+        for stripe_result in stripe_results:
+            merged |= int.from_bytes(stripe_result.bitfield, byteorder="big")
+            result.bad_pieces.extend(stripe_result.bad_pieces)
+            result.checked_count += stripe_result.checked_count
+            result.checked_bytes += stripe_result.checked_bytes
+        result.bitfield[:] = merged.to_bytes(len(result.bitfield), byteorder="big")
+        result.seconds = time.monotonic() - started
+        self.logger.info(result)
+        return result
@@ -0,0 +1,138 @@
+import os
+import logging
+from typing import Iterator
+
+import bencode
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.diskinteract.storage import Storage
+from torrentclient.diskinteract.recheck import Recheck
+
+
+def as_bytes(value) -> bytes:
+    """bencode.py decodes byte strings which are valid UTF-8 to str"""
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+
+class FastResume:
+    """Completed pieces of a download, persisted next to the downloaded data.
+    The resume file holds the completed-pieces bitfield, the size and modification time of every data file
+    and whether the download was shut down cleanly, which is when the data is known to match the bitfield."""
+
+    SUFFIX = ".resume"
+
+    logger = logging.getLogger('fast-resume')
+
+    class Exception(Exception):
+        """An exception with the resume file occurred"""
+
+    def __init__(self, torrent: MyTorrent, storage: Storage, path: str = None):
+        """
+        :param torrent: MyTorrent being downloaded
+        :param storage: Storage the pieces are written to
+        :param path: path of the resume file, defaults to the storage base path with SUFFIX
+        """
+        self.torrent = torrent
+        self.storage = storage
+        self.path = path if path is not None else storage.base_path + self.SUFFIX
+        self.bitfield = bytearray(-(-torrent.piece_count // 8))
+
+    def __str__(self):
+        return "FastResume(path={}, completed={})".format(self.path, self.completed_count)
+
+    def __contains__(self, piece_idx: int) -> bool:
+        return bool(self.bitfield[piece_idx >> 3] & (0x80 >> (piece_idx & 7)))
+
+    @property
+    def completed_count(self) -> int:
+        return sum(bin(byte).count("1") for byte in self.bitfield)
+
+    def completed_pieces(self) -> Iterator[int]:
+        return (piece_idx for piece_idx in range(self.torrent.piece_count) if piece_idx in self)
+
+    def _files_state(self) -> list:
+        state = []
+        for path in self.storage.paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                state.append({'path': path, 'size': -1, 'mtime': 0})
+            else:
+                state.append({'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+        return state
+
+    def mark(self, piece_idx: int):
+        """marks a piece which was written to the data files as completed"""
+        self.bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+
+    def unmark(self, piece_idx: int):
+        self.bitfield[piece_idx >> 3] &= ~(0x80 >> (piece_idx & 7)) & 0xFF
+
+    def save(self, clean: bool = False, bitfield: bytes = None):
+        """atomically writes the resume file,
+        `clean` is set only when no more pieces are written after it.
+        :param bitfield: completed pieces to save instead of the current ones,
+            a snapshot taken before the storage was flushed so no unflushed piece is saved as completed
+        """
+        content = bencode.bencode({
+            'infohash': self.torrent.infohash,
+            'pieces': bytes(self.bitfield if bitfield is None else bitfield),
+            'files': self._files_state(),
+            'clean': int(clean),
+        })
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as out:
+            out.write(content)
+        os.replace(temp_path, self.path)
+
+    def verify(self):
+        """unmarks completed pieces whose data does not match their hash"""
+        result = Recheck(self.torrent, self.storage).check(self.completed_pieces())
+        for piece_idx in result.bad_pieces:
+            self.logger.warning("Piece #{} does not match its hash".format(piece_idx))
+            self.unmark(piece_idx)
+
+    def update(self, bitfield: bytes):
+        """replaces the completed pieces, e.g. with the bitfield of a Recheck"""
+        self.bitfield[:] = bitfield
+
+    def _load(self, verify: bool):
+        try:
+            resume = bencode.bread(self.path)
+        except FileNotFoundError:
+            self.logger.info("No resume file {}, starting a new download".format(self.path))
+            return
+        except bencode.BencodeDecodeError as e:
+            raise FastResume.Exception("Could not bdecode {}: {}".format(self.path, e))
+        if as_bytes(resume.get('infohash')) != self.torrent.infohash:
+            raise FastResume.Exception("{} belongs to another torrent".format(self.path))
+        bitfield = as_bytes(resume['pieces'])
+        if len(bitfield) != len(self.bitfield):
+            raise FastResume.Exception("{} has a bitfield of {} bytes, should be {}".format(
+                self.path, len(bitfield), len(self.bitfield)))
+        saved_files = [(file['path'], file['size']) for file in resume['files']]
+        current_files = self._files_state()
+        if saved_files != [(file['path'], file['size']) for file in current_files]:
+            raise FastResume.Exception("Data files of {} were changed since it was saved".format(self.path))
+        self.bitfield[:] = bitfield
+        if resume['clean']:
+            if [file['mtime'] for file in resume['files']] != [file['mtime'] for file in current_files]:
+                raise FastResume.Exception("Data files of {} were modified since it was saved".format(self.path))
+        elif verify:
+            self.logger.info("Download was not shut down cleanly, verifying {} pieces".format(self.completed_count))
+            self.verify()
+        self.logger.info("Resuming with {}/{} pieces".format(self.completed_count, self.torrent.piece_count))
+
+    @classmethod
+    def load(cls, torrent: MyTorrent, storage: Storage, verify: bool = False, path: str = None):
+        """returns FastResume with the completed pieces of the resume file,
+        without any if it does not exist or does not match the data files.
+        :param verify: whether to verify pieces after an unclean shutdown, otherwise they are trusted
+        """
+        fast_resume = cls(torrent, storage, path)
+        try:
+            fast_resume._load(verify)
+        except (FastResume.Exception, KeyError, TypeError) as e:
+            cls.logger.warning("Ignoring resume file: {}".format(e))
+            fast_resume.bitfield = bytearray(len(fast_resume.bitfield))
+        return fast_resume
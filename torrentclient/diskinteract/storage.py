@@ -0,0 +1,139 @@
+import os
+import logging
+import threading
+from typing import List, Tuple
+
+from torrentclient.mytorrent import MyTorrent
+
+
+class Storage:
+    """Maps the torrent content onto its files in the downloads folder,
+    pieces are written straight to the (path, offset, length) spans of the files they cover."""
+
+    ROOT = "downloads"
+
+    FULL_ALLOCATION = False
+    """whether to allocate disk blocks of the files up front (posix_fallocate), otherwise they are sparse"""
+
+    logger = logging.getLogger('storage')
+
+    class Exception(Exception):
+        """An exception with the downloaded files occurred"""
+
+    def __init__(self, torrent: MyTorrent, root: str = ROOT):
+        """
+        :param torrent: MyTorrent whose content is stored
+        :param root: folder of the downloaded files
+        """
+        self.torrent = torrent
+        self.root = root
+        self.base_path = os.path.join(root, torrent.out_filename)
+        if torrent.meta.files is None:
+            self.paths = [self.base_path]
+        else:
+            self.paths = [os.path.join(self.base_path, *relative_path) for relative_path, _ in torrent.meta.files]
+        self.lengths = [length for _, length in torrent.meta.files or [(None, torrent.total_length)]]
+        self.dirty = set()  # indices of files written since the last flush
+        self.dirty_lock = threading.Lock()  # pieces may be written by many disk threads while flushing
+        self.readers = {}  # file index -> file object open for reading, blocks are uploaded from
+
+    def __str__(self):
+        return "Storage(base_path={}, files={})".format(self.base_path, len(self.paths))
+
+    def spans(self, offset: int, length: int) -> List[Tuple[int, int, int]]:
+        """returns (file index, offset in file, length) of every file covering `length` bytes
+        from `offset` of the entire torrent content"""
+        spans = []
+        file_idx = self.torrent.meta.file_index(offset)
+        while length > 0 and file_idx < len(self.paths):
+            file_offset = offset - self.torrent.meta.file_offsets[file_idx]
+            span_length = min(length, self.lengths[file_idx] - file_offset)
+            if span_length > 0:
+                spans.append((file_idx, file_offset, span_length))
+                offset += span_length
+                length -= span_length
+            file_idx += 1
+        return spans
+
+    def piece_spans(self, piece_idx: int) -> List[Tuple[int, int, int]]:
+        return self.spans(self.torrent.meta.piece_offset(piece_idx), self.torrent.meta.piece_size(piece_idx))
+
+    def preallocate(self):
+        """creates all files with their final length, keeping any existing content"""
+        for path, length in zip(self.paths, self.lengths):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "ab") as out:
+                if out.tell() != length:
+                    self.logger.info("Allocating {} bytes for {}".format(length, path))
+                    out.truncate(length)
+                if self.FULL_ALLOCATION and length and hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(out.fileno(), 0, length)
+
+    def write(self, offset: int, data: bytes):
+        """writes `data` at `offset` of the entire torrent content"""
+        view = memoryview(data)
+        for file_idx, file_offset, length in self.spans(offset, len(view)):
+            with open(self.paths[file_idx], "rb+") as out:
+                out.seek(file_offset)
+                out.write(view[:length])
+            self._mark_dirty(file_idx)
+            view = view[length:]
+
+    def _mark_dirty(self, file_idx: int):
+        """must be called once the data was written, so a flush taking the file after it also flushes the data"""
+        with self.dirty_lock:
+            self.dirty.add(file_idx)
+
+    def _take_dirty(self) -> list:
+        """returns the indices of files written since the last flush, files written from now are flushed next time"""
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, set()
+        return sorted(dirty)
+
+    def write_piece(self, piece_idx: int, piece: bytes):
+        self.write(self.torrent.meta.piece_offset(piece_idx), piece)
+
+    def flush(self):
+        """makes all writes since the last flush durable (fsync)"""
+        for file_idx in self._take_dirty():
+            with open(self.paths[file_idx], "rb+") as out:
+                os.fsync(out.fileno())
+
+    def close(self):
+        self.flush()
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+    def readinto(self, offset: int, view: memoryview) -> int:
+        """reads bytes from `offset` of the entire torrent content into `view`,
+        returns number of bytes read - less than its length if files are missing or short"""
+        read_count = 0
+        for file_idx, file_offset, length in self.spans(offset, len(view)):
+            try:
+                with open(self.paths[file_idx], "rb") as data:
+                    data.seek(file_offset)
+                    file_read_count = data.readinto(view[read_count:read_count + length]) or 0
+            except FileNotFoundError:
+                file_read_count = 0
+            read_count += file_read_count
+            if file_read_count < length:
+                break
+        return read_count
+
+    def sendable(self, offset: int, length: int) -> list:
+        """returns `length` bytes from `offset` of the entire torrent content as parts
+        PeerConnection.send_parts sends without copying them: (file, offset, count) tuples sent with sendfile"""
+        parts = []
+        for file_idx, file_offset, span_length in self.spans(offset, length):
+            reader = self.readers.get(file_idx)
+            if reader is None:
+                reader = self.readers[file_idx] = open(self.paths[file_idx], "rb")
+            parts.append((reader, file_offset, span_length))
+        return parts
+
+    def read_piece(self, piece_idx: int) -> bytes:
+        piece = bytearray(self.torrent.meta.piece_size(piece_idx))
+        if self.readinto(self.torrent.meta.piece_offset(piece_idx), memoryview(piece)) != len(piece):
+            raise Storage.Exception("Piece #{} is not stored".format(piece_idx))
+        return bytes(piece)
@@ -0,0 +1,465 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from typing import Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.metrics import Metrics
+from torrentclient.diskinteract.storage import Storage
+from torrentclient.diskinteract.resume import FastResume
+from torrentclient.peerinteract.peer import Peer
+from torrentclient.peerinteract.connection import PeerConnection
+from torrentclient.peerinteract.dialer import Dialer, ConnectionLimits
+from torrentclient.peerinteract.getpiece import GetPiece, PieceProgress
+from torrentclient.peerinteract.piecepicker import PiecePicker
+from torrentclient.peerinteract.uploader import Uploader
+from torrentclient.peerinteract.ratelimit import RateLimiter
+from torrentclient.trackerinteract.announcer import Announcer
+from torrentclient.trackerinteract.swarmcache import SwarmCache
+
+
+class DownloadEngine:
+    """Downloads all pieces of a torrent from its peers,
+    driving every peer connection as a coroutine of a single asyncio event loop.
+    SHA-1 hashing and disk writes are sent to thread pool executors.
+    Once no piece is left to pick, endgame mode requests the missing blocks of pieces in progress
+    from other peers having them too, so the last pieces are not held up by slow peers.
+    With an Uploader, completed pieces are uploaded to the peers while downloading, and after it when seeding.
+    Rates, latencies and queue depths are collected into Metrics every PROGRESS_INTERVAL and exported."""
+
+    MAX_CONNECTIONS = 200
+    """number of peer connections downloading concurrently"""
+
+    HASH_WORKERS = os.cpu_count() or 1
+    DISK_WORKERS = 1
+
+    PICK_INTERVAL = 5  # [seconds]
+    """time to read HavePiece messages of a peer with no wanted pieces before picking again"""
+
+    PEER_IDLE_TIMEOUT = 60  # [seconds]
+    """time after which a peer with no wanted pieces is disconnected"""
+
+    ENDGAME_MAX_PEERS = 3
+    """number of peers a piece is requested from at the same time in endgame mode"""
+
+    TAIL_FRACTION = 0.01
+    """fraction of the pieces at the end of the download whose time is measured"""
+
+    PROGRESS_INTERVAL = 1  # [seconds]
+
+    PROGRESS_PATH = "progress.txt"
+
+    FLUSH_INTERVAL = 5  # [seconds]
+    """time between flushes of written pieces to disk, each followed by a save of the resume file"""
+
+    logger = logging.getLogger('download-engine')
+
+    class Exception(Exception):
+        """An exception with downloading the torrent content occurred"""
+
+    def __init__(self, torrent: MyTorrent, peers: Iterable[Peer] = (), max_connections: int = MAX_CONNECTIONS,
+                 storage: Storage = None, resume: FastResume = None, announcer: Announcer = None,
+                 cache: SwarmCache = None, uploader: Uploader = None, seed: bool = False, limiter: RateLimiter = None,
+                 metrics: Metrics = None, limits: ConnectionLimits = None, progress_path: str = PROGRESS_PATH):
+        """
+        :param torrent: MyTorrent to download
+        :param peers: peers of the torrent to connect to
+        :param max_connections: maximal number of concurrent peer connections
+        :param storage: Storage pieces are written to, the torrent's files in the default folder if None
+        :param resume: FastResume of pieces completed before, updated as pieces complete
+        :param announcer: Announcer of the torrent, its peers are connected to as trackers respond
+        :param cache: SwarmCache the throughput of peers pieces are obtained from is recorded in
+        :param uploader: Uploader serving the completed pieces to peers, nothing is uploaded if None
+        :param seed: whether to keep uploading once all pieces were obtained, until cancelled
+        :param limiter: RateLimiter of the torrent, the parent of a limiter of every peer connection
+        :param metrics: Metrics of the download, not exported if None
+        :param limits: ConnectionLimits shared with the engines of other torrents of a session
+        :param progress_path: file the number of pieces obtained is written to
+        """
+        self.torrent = torrent
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.dialer = Dialer(torrent, peers, metrics=self.metrics, limits=limits)
+        self.announcer = announcer
+        self.cache = cache
+        self.storage = storage if storage is not None else Storage(torrent)
+        self.max_connections = max_connections
+        self.resume = resume
+        self.uploader = uploader
+        self.seed = seed
+        self.limiter = limiter
+        self.progress_path = progress_path
+        self.hash_executor = None  # set by `download`, or shared by a session of many torrents
+        self.disk_executor = None
+        self.picker = PiecePicker(torrent.piece_count)
+        self.progresses = {}  # piece index -> PieceProgress of pieces in progress
+        self.pieces_done = 0
+        self.downloaded = 0  # [bytes] of pieces obtained from peers
+        self.left = torrent.total_length  # [bytes] of pieces still missing
+        self.tail_count = max(1, math.ceil(torrent.piece_count * self.TAIL_FRACTION))
+        self.tail_started = None
+        self.tail_seconds = None  # time to get the last TAIL_FRACTION of the pieces
+        self.endgame_started = None
+        self.started = None
+        self.first_piece_seconds = None  # time from the start to the first piece obtained
+        self.duplicate_bytes = 0  # of blocks received from more than one peer in endgame mode
+        self.connections = set()  # PeerConnection of every worker
+        self.disk_queued = 0  # number of pieces waiting to be written
+        self.counted = {}  # PeerConnection -> (downloaded, uploaded) bytes at the previous metrics collection
+        self.collected_at = time.monotonic()
+        if resume is not None:
+            for piece_idx in resume.completed_pieces():
+                self.picker.mark_obtained(piece_idx)
+                self.pieces_done += 1
+                self.left -= torrent.meta.piece_size(piece_idx)
+
+    def __str__(self):
+        return "DownloadEngine(torrent={}, dialer={})".format(self.torrent.name, self.dialer)
+
+    def add_peers(self, peers: Iterable[Peer]):
+        """queues peers which were not seen before to be dialed"""
+        new_count = self.dialer.add_peers(peers)
+        if new_count:
+            self.logger.info("Queued {} new peers".format(new_count))
+
+    def _announce_stats(self) -> dict:
+        return {
+            'uploaded': self.uploader.uploaded if self.uploader is not None else 0,
+            'downloaded': self.downloaded,
+            'left': self.left,
+        }
+
+    async def _announce(self):
+        """streams peers from the trackers to the dialer. if trackers were skipped for the interval they asked for,
+        they are announced to anyway once the peers run out, as the cached peers may be stale"""
+        try:
+            if await self.announcer.announce(self.add_peers, **self._announce_stats()):
+                await self.dialer.wait_starving(self.max_connections)
+                self.logger.info("Ran out of peers, announcing to the skipped trackers")
+                await self.announcer.announce(self.add_peers, force=True, **self._announce_stats())
+        except Announcer.Exception as e:
+            self.logger.error(e)
+        finally:
+            self.dialer.set_more_peers(False)  # waiting workers find out no more peers are coming
+
+    async def _next_connected_peer(self) -> Optional[PeerConnection]:
+        """returns a handshaked PeerConnection from the dialer, None if no peers are left"""
+        connection = await self.dialer.get()
+        if connection is not None:
+            self.connections.add(connection)
+            connection.picker = self.picker
+            if self.limiter is not None:
+                connection.limiter = self.limiter.for_peer()
+            if self.uploader is not None:
+                await self.uploader.add(connection)
+        return connection
+
+    def _release_peer(self, connection: PeerConnection, failed: bool):
+        """closes the connection, the peer is connected to again later unless it failed too often"""
+        self.picker.remove_peer(connection.peer)
+        self.connections.discard(connection)
+        if self.uploader is not None:
+            self.uploader.remove(connection)
+        self.dialer.release(connection, failed)
+
+    async def _next_piece(self, connection: PeerConnection) -> Optional[int]:
+        """returns index of the rarest wanted piece the peer has,
+        waiting for the peer to announce pieces for up to PEER_IDLE_TIMEOUT.
+        returns None if it did not have any"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.PEER_IDLE_TIMEOUT
+        while True:
+            piece_idx = self.picker.pick(connection.peer)
+            if piece_idx is None and self.picker.wanted_count == 0:
+                piece_idx = self._pick_endgame(connection.peer)
+            if piece_idx is not None or loop.time() > deadline:
+                return piece_idx
+            try:
+                await asyncio.wait_for(connection.expect_blocks(), self.PICK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _pick_endgame(self, peer: Peer) -> Optional[int]:
+        """returns index of a piece in progress with other peers which `peer` has,
+        the one requested from the fewest peers. None if there is no such piece"""
+        if self.endgame_started is None and self.progresses:
+            self.logger.info("Entering endgame mode with {} pieces in progress".format(len(self.progresses)))
+            self.endgame_started = asyncio.get_running_loop().time()
+        candidates = [(len(progress.getters), piece_idx) for piece_idx, progress in self.progresses.items()
+                      if not progress.complete and 0 < len(progress.getters) < self.ENDGAME_MAX_PEERS
+                      and self.picker.has_piece(peer, piece_idx)]
+        return min(candidates)[1] if candidates else None
+
+    def _piece_done(self, piece_idx: int):
+        self.picker.complete(piece_idx)
+        self.pieces_done += 1
+        self.left -= self.torrent.meta.piece_size(piece_idx)
+        if self.resume is not None:
+            self.resume.mark(piece_idx)
+        if self.uploader is not None:
+            self.uploader.piece_completed(piece_idx)
+        loop = asyncio.get_running_loop()
+        if self.first_piece_seconds is None:
+            self.first_piece_seconds = loop.time() - self.started
+            self.metrics.set("first_piece_seconds", self.first_piece_seconds)
+        remaining = self.torrent.piece_count - self.pieces_done
+        if self.tail_started is None and remaining <= self.tail_count:
+            self.tail_started = loop.time()
+        if remaining == 0:
+            self.tail_seconds = loop.time() - self.tail_started
+            self.logger.info("Got the last {} pieces in {:.2f}s, {} duplicate bytes in endgame mode".format(
+                self.tail_count, self.tail_seconds, self.duplicate_bytes))
+            self.done.set()
+
+    async def _download_pieces(self):
+        """gets pieces chosen by the PiecePicker with one peer connection at a time,
+        a piece which failed is wanted again"""
+        loop = asyncio.get_running_loop()
+        connection = await self._next_connected_peer()
+        pipeline_depth = GetPiece.PIPELINE_DEPTH
+        try:
+            while connection is not None:
+                try:
+                    piece_idx = await self._next_piece(connection)
+                except PeerConnection.Exception as e:
+                    self.logger.error("Lost {} while waiting for pieces: {}".format(connection, e))
+                    piece_idx = None
+                if piece_idx is None:
+                    self._release_peer(connection, failed=False)
+                    connection = await self._next_connected_peer()
+                    pipeline_depth = GetPiece.PIPELINE_DEPTH
+                    continue
+                progress = self.progresses.get(piece_idx)
+                if progress is None:
+                    progress = self.progresses[piece_idx] = PieceProgress(self.torrent, piece_idx)
+                get_piece = GetPiece(peer_connection=connection, torrent=self.torrent, piece_idx=piece_idx,
+                                     pipeline_depth=pipeline_depth, adaptive=True, hash_executor=self.hash_executor,
+                                     progress=progress)
+                started = loop.time()
+                try:
+                    piece = await get_piece.get()
+                except Exception as e:
+                    GetPiece.logger.error("Failed to get piece #{} with {}: {}".format(piece_idx, connection, e))
+                    self.metrics.inc("piece_failures_total")
+                    if isinstance(e, GetPiece.HashException):
+                        self.metrics.inc("hash_failures_total")
+                    if not progress.getters:  # no other peer is getting the piece
+                        self.progresses.pop(piece_idx, None)
+                        self.picker.abort(piece_idx)
+                    self._release_peer(connection, failed=True)
+                    connection = await self._next_connected_peer()
+                    pipeline_depth = GetPiece.PIPELINE_DEPTH
+                    continue
+                pipeline_depth = get_piece.pipeline_depth  # adapted to this peer, kept for its next piece
+                if piece is None:
+                    GetPiece.logger.debug("Piece #%d was obtained from another peer", piece_idx)
+                    continue
+                GetPiece.logger.info("Successfully obtained piece #%d with %s", piece_idx, connection)
+                self.metrics.observe("piece_latency_seconds", loop.time() - started)
+                self.progresses.pop(piece_idx, None)
+                self.downloaded += len(piece)
+                self.duplicate_bytes += progress.duplicate_bytes
+                if self.cache is not None:
+                    self.cache.peer_succeeded(connection.peer, len(piece), loop.time() - started)
+                self.disk_queued += 1
+                try:
+                    write_seconds = await loop.run_in_executor(self.disk_executor, self._write_piece, piece_idx, piece)
+                finally:
+                    self.disk_queued -= 1
+                self.metrics.observe("disk_write_seconds", write_seconds)
+                self._piece_done(piece_idx)
+        finally:
+            if connection is not None:
+                self.connections.discard(connection)
+                if self.uploader is not None:
+                    self.uploader.remove(connection)
+                connection.close()
+        self.logger.debug("No more peers to connect to")
+
+    def _write_piece(self, piece_idx: int, piece: bytearray) -> float:
+        """writes a piece in the disk executor, returns the seconds it took"""
+        started = time.monotonic()
+        self.storage.write_piece(piece_idx, piece)
+        return time.monotonic() - started
+
+    def _collect_metrics(self):
+        """updates the rates of every peer and overall since the previous collection, and the queue depths"""
+        now = time.monotonic()
+        elapsed = max(now - self.collected_at, 0.001)
+        self.collected_at = now
+        connections = set(self.connections)
+        if self.uploader is not None:
+            connections.update(self.uploader.uploads)
+        self.metrics.clear("peer_download_rate_bytes")
+        self.metrics.clear("peer_upload_rate_bytes")
+        downloaded = uploaded = 0
+        counted = {}
+        for connection in connections:
+            counted[connection] = connection.downloaded, connection.uploaded
+            previous_downloaded, previous_uploaded = self.counted.get(connection, (0, 0))
+            peer = "{}:{}".format(connection.peer.ip_address, connection.peer.port)
+            self.metrics.set("peer_download_rate_bytes", (connection.downloaded - previous_downloaded) / elapsed,
+                             peer=peer)
+            self.metrics.set("peer_upload_rate_bytes", (connection.uploaded - previous_uploaded) / elapsed, peer=peer)
+            downloaded += connection.downloaded - previous_downloaded
+            uploaded += connection.uploaded - previous_uploaded
+        self.counted = counted
+        self.metrics.inc("downloaded_bytes_total", downloaded)
+        self.metrics.inc("uploaded_bytes_total", uploaded)
+        self.metrics.set("download_rate_bytes", downloaded / elapsed)
+        self.metrics.set("upload_rate_bytes", uploaded / elapsed)
+        handshakes = self.metrics.get("handshakes_total", result="success") + \
+            self.metrics.get("handshakes_total", result="failure")
+        if handshakes:
+            self.metrics.set("handshake_success_ratio",
+                             self.metrics.get("handshakes_total", result="success") / handshakes)
+        self.metrics.set("pieces_completed", self.pieces_done)
+        self.metrics.set("pieces_in_progress", len(self.progresses))
+        self.metrics.set("pieces_wanted", self.picker.wanted_count)
+        self.metrics.set("peer_connections", len(connections))
+        self.metrics.set("dialer_candidates", len(self.dialer.candidates))
+        self.metrics.set("dialer_dialing", len(self.dialer.dialing))
+        self.metrics.set("dialer_spares", len(self.dialer.spares))
+        self.metrics.set("dialer_waiting_workers", self.dialer.waiting)
+        self.metrics.set("disk_queued_pieces", self.disk_queued)
+        if self.uploader is not None:
+            self.metrics.set("upload_queued_requests",
+                             sum(len(upload.requests) for upload in self.uploader.uploads.values()))
+            self.metrics.set("upload_unchoked_peers",
+                             sum(not upload.choked for upload in self.uploader.uploads.values()))
+
+    def _report_metrics(self):
+        self._collect_metrics()
+        try:
+            self.metrics.export()
+        except OSError as e:
+            self.logger.error("Could not export metrics: {}".format(e))
+
+    async def _report_progress(self):
+        """updates file with number of pieces obtained out of the total amount, and exports the metrics"""
+        while True:
+            self._report_metrics()
+            with open(self.progress_path, "w") as out:
+                out.write("{}/{} downloaded".format(self.pieces_done, self.torrent.piece_count))
+                if self.tail_seconds is not None:
+                    out.write(", last {} pieces in {:.2f}s".format(self.tail_count, self.tail_seconds))
+            if self.done.is_set():
+                return
+            try:
+                await asyncio.wait_for(self.done.wait(), self.PROGRESS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def _flush(self, bitfield: Optional[bytes]) -> float:
+        """makes written pieces durable, then saves them as completed. returns the seconds the flush took"""
+        started = time.monotonic()
+        self.storage.flush()
+        flush_seconds = time.monotonic() - started
+        if bitfield is not None:
+            self.resume.save(bitfield=bitfield)
+        return flush_seconds
+
+    async def _flush_periodically(self):
+        """flushes the storage every FLUSH_INTERVAL instead of once per piece,
+        the completed pieces are snapshot before the flush, so the resume file never claims unflushed data"""
+        loop = asyncio.get_running_loop()
+        while not self.done.is_set():
+            try:
+                await asyncio.wait_for(self.done.wait(), self.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            bitfield = bytes(self.resume.bitfield) if self.resume is not None else None
+            flush_seconds = await loop.run_in_executor(self.disk_executor, self._flush, bitfield)
+            self.metrics.observe("disk_flush_seconds", flush_seconds)
+
+    async def _seed(self):
+        """uploads to the peers which connect to us until cancelled,
+        announcing the download was completed - or started, if all pieces were obtained before"""
+        self.logger.info("Seeding on port {}".format(self.uploader.port))
+        if self.announcer is not None:
+            try:
+                await self.announcer.announce(lambda peers: None, event="completed" if self.downloaded else "started",
+                                              **self._announce_stats())
+            except Announcer.Exception as e:
+                self.logger.error(e)
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            self._report_metrics()
+
+    async def run(self):
+        """downloads all pieces, then seeds them if `seed` was set.
+        raises an exception if peers ran out before all pieces were obtained"""
+        try:
+            await self.metrics.start()
+            if self.uploader is not None:
+                self.uploader.start()
+                if self.announcer is not None and self.announcer.port is None:
+                    self.announcer.port = self.uploader.port  # trackers hand it to the peers
+            await self._download()
+            if self.seed and self.uploader is not None:
+                await self._seed()
+        finally:
+            if self.uploader is not None:
+                await self.uploader.close()
+            await self.metrics.close()
+
+    async def _download(self):
+        """downloads all pieces, raises an exception if peers ran out before that"""
+        self.logger.info("Trying to get {} pieces".format(self.torrent.piece_count - self.pieces_done))
+        self.started = asyncio.get_running_loop().time()
+        self.done = asyncio.Event()
+        if self.pieces_done == self.torrent.piece_count:
+            self.done.set()
+        if self.torrent.piece_count - self.pieces_done <= self.tail_count:
+            self.tail_started = asyncio.get_running_loop().time()
+        self.dialer.start()
+        if self.announcer is not None:
+            self.dialer.set_more_peers(True)  # before the workers start, so they wait for the first peers
+            announce = asyncio.ensure_future(self._announce())
+            connections_count = self.max_connections
+        else:
+            announce = None
+            connections_count = min(self.max_connections, len(self.dialer))
+        self.logger.debug("connections_count=%d", connections_count)
+        workers = asyncio.gather(*(self._download_pieces() for _ in range(connections_count)))
+        progress = asyncio.ensure_future(self._report_progress())
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        done = asyncio.ensure_future(self.done.wait())
+        try:
+            await asyncio.wait([done, workers], return_when=asyncio.FIRST_COMPLETED)
+            if workers.done():
+                workers.result()  # raises unexpected exceptions of workers
+        finally:
+            done.cancel()
+            if announce is not None:
+                announce.cancel()
+            workers.cancel()
+            await asyncio.gather(workers, return_exceptions=True)  # waits for connections to close
+            if announce is not None:
+                await asyncio.gather(announce, return_exceptions=True)
+            await self.dialer.close()
+            self.done.set()
+            await progress
+            await flusher
+        if self.pieces_done < self.torrent.piece_count:
+            raise DownloadEngine.Exception("Ran out of peers with {} pieces missing".format(
+                self.torrent.piece_count - self.pieces_done))
+
+    def download(self):
+        """runs the event loop until all pieces were written"""
+        self.hash_executor = ThreadPoolExecutor(self.HASH_WORKERS)
+        self.disk_executor = ThreadPoolExecutor(self.DISK_WORKERS)
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.hash_executor.shutdown()
+            self.disk_executor.shutdown()
+            self.close()
+
+    def close(self):
+        """closes the storage once the executors writing to it were shut down"""
+        self.storage.close()
+        if self.resume is not None:
+            self.resume.save(clean=True)  # all written pieces are on disk
@@ -0,0 +1,117 @@
+import os
+import sys
+import copy
+import queue
+import atexit
+import logging
+import logging.handlers
+from typing import Dict, Optional, Tuple
+
+
+FORMAT = '%(asctime)s %(levelname)s - %(process)d - %(name)s - %(message)s'
+
+DEFAULT_LEVEL = "INFO"
+
+_listener = None  # type: Optional[logging.handlers.QueueListener]
+_listener_pid = None
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a queue of this process with their message rendered but not formatted,
+    so the listener thread writes the arguments as they were when logged, not as the event loop changed them since.
+    Filters run before, so records dropped by the level or the SampleFilter are never rendered"""
+
+    exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback keeps the frames and their changing locals, its text is written instead
+            if not record.exc_text:
+                record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """Passes 1 of every `every` DEBUG records of the same logger and message template, e.g. of every block,
+    and all records of higher levels. Messages should pass their arguments lazily for the template to repeat,
+    the counts are reset once MAX_TEMPLATES templates were seen, so pre-formatted messages do not grow them."""
+
+    MAX_TEMPLATES = 1000
+
+    def __init__(self, every: int = 1):
+        super().__init__()
+        self.every = every
+        self.counts = {}  # (logger name, message template) -> number of records
+
+    def __str__(self):
+        return "SampleFilter(every={})".format(self.every)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every <= 1 or record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.msg)
+        count = self.counts.get(key, 0)
+        if not count and len(self.counts) >= self.MAX_TEMPLATES:
+            self.counts.clear()
+        self.counts[key] = count + 1
+        return count % self.every == 0
+
+
+def parse_levels(spec: str) -> Tuple[str, Dict[str, str]]:
+    """parses "LEVEL,component=LEVEL,..." to the root level and the levels of the components (logger names),
+    e.g. "INFO,peer-connection=DEBUG" """
+    level, levels = DEFAULT_LEVEL, {}
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        name, separator, component_level = part.rpartition("=")
+        if separator:
+            levels[name] = component_level.upper()
+        else:
+            level = part.upper()
+    return level, levels
+
+
+def configure(level: str = DEFAULT_LEVEL, levels: Dict[str, str] = None, path: str = None, sample_every: int = 1):
+    """logs through a queue to a listener thread writing to stderr, and to a file if given,
+    so the event loop and worker threads never wait for log I/O
+    :param level: level of all loggers
+    :param levels: levels of components overriding `level`, by logger name (e.g. {'peer-connection': 'DEBUG'})
+    :param path: file records are appended to in addition to stderr
+    :param sample_every: only 1 of every `sample_every` DEBUG records of a message template is logged
+    """
+    global _listener, _listener_pid
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()  # a forked process has the listener of its parent, without its thread
+    formatter = logging.Formatter(FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if path is not None:
+        handlers.append(logging.FileHandler(path))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    queue_handler = LocalQueueHandler(records)
+    queue_handler.addFilter(SampleFilter(sample_every))
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, component_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(component_level)
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener_pid = os.getpid()
+    _listener.start()
+
+
+def shutdown():
+    """writes the queued records and stops the listener thread"""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+
+atexit.register(shutdown)
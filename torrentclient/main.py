@@ -2,177 +2,135 @@ import os
 import logging
 import argparse
 from typing import List
-from multiprocessing import Queue, Process, Value
 
+from torrentclient import logconfig
 from torrentclient.mytorrent import MyTorrent
-from torrentclient.peerinteract.peer import Peer
-from torrentclient.peerinteract.connection import PeerConnection
+from torrentclient.metrics import Metrics
+from torrentclient.engine import DownloadEngine
+from torrentclient.session import Session
+from torrentclient.diskinteract.mmapstorage import MmapStorage
+from torrentclient.diskinteract.resume import FastResume
+from torrentclient.trackerinteract.announcer import Announcer
+from torrentclient.trackerinteract.swarmcache import SwarmCache
 from torrentclient.peerinteract.getpiece import GetPiece
+from torrentclient.peerinteract.dialer import ConnectionLimits
+from torrentclient.peerinteract.uploader import Uploader
+from torrentclient.peerinteract.ratelimit import RateLimiter
 
 
-QUEUE_STOP_FLAG = None
+TRACKERS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests", "trackers.txt")
+"""list of announce URLs tried for every torrent, one per line"""
 
 
-PARALLEL_TRACKERS_COUNT = 40
-"""number of parallel processes establishing a connection with a tracker"""
-
-
-def peers_from_tracker(tracker_url: str, torrent: MyTorrent) -> List[Peer]:
-    """returns list of peers of a torrent from a specific tracker"""
-    from torrentclient.trackerinteract.tracker import Tracker
-    from torrentclient.trackerinteract.requestpeers import RequestPeers
-    from torrentclient.trackerinteract.handleresponse import HandleResponse
-
+def listed_tracker_urls(trackers_path: str = TRACKERS_PATH) -> List[str]:
+    """returns announce URLs from trackers list file"""
     try:
-        response = RequestPeers(Tracker(tracker_url), torrent).send()
-        peers = HandleResponse(response).get_peers()
-    except (Tracker.Exception, RequestPeers.Exception, HandleResponse.Exception) as e:
-        RequestPeers.logger.warning("Failed getting peers of '{}' from {}: {}".format(
-            torrent.name, tracker_url, e))
+        with open(trackers_path, "r") as trackers_file:
+            return [line.strip() for line in trackers_file if line.strip()]
+    except FileNotFoundError:
+        logging.getLogger('main').warning("No trackers list at {}".format(trackers_path))
         return []
-    else:
-        return peers
 
 
-def peers_from_trackers(torrent: MyTorrent) -> List[Peer]:
-    """returns a list of peers from all trackers from torrent file and local cache"""
-    from torrentclient.trackerinteract.parallel import map_parallel
-    if torrent.trackers is not None:
-        trackers = torrent.trackers
-    else:
-        trackers = []
-    trackers.extend(
-        [tracker[:-1]] for tracker in open(os.path.join(os.getcwd(), "tests\\trackers.txt"), "r").readlines())
-    map_args = [(tracker_url[0], torrent) for tracker_url in trackers]
-    peers = map_parallel(peers_from_tracker, map_args, PARALLEL_TRACKERS_COUNT)
-    return set(peers)  # remove duplicates
-
-
-def next_connected_peer(peers: Queue, torrent: MyTorrent) -> PeerConnection:
-    """returns a PeerConnection from the peers queue"""
-    from torrentclient.peerinteract.handshake import PeerHandshake
-    while not peers.empty():
-        peer = peers.get()
-        peers.put(peer)  # move back to end of queue
-        hs = PeerHandshake(peer=peer, torrent=torrent)
-        try:
-            connection = hs.handshake()
-        except PeerHandshake.Exception as e:
-            hs.logger.error(e)
-        else:
-            hs.logger.info("Connected to {}!".format(peer))
-            return connection
-
-
-def write_piece(pieces_queue: Queue, peers_queue: Queue, torrent: MyTorrent, pieces_counter: Value):
-    """pops a piece index and a PeerConnection from the corresponding queues,
-    tries to get and write the piece with the PeerConnection.
-    in case of failure, puts piece index back to queue."""
-    piece_idx = pieces_queue.get()
-    connection = next_connected_peer(peers_queue, torrent)
-    while connection is not None and piece_idx is not QUEUE_STOP_FLAG:
-        GetPiece.logger.debug("Process {}: piece_idx={}, pid={}".format(connection.peer, piece_idx, os.getpid()))
-        try:
-            piece = GetPiece(peer_connection=connection, torrent=torrent, piece_idx=piece_idx).get()
-        except Exception as e:
-            GetPiece.logger.error("Failed to get piece #{} with {}: {}".format(piece_idx, connection, e))
-            connection.socket.close()
-            connection = next_connected_peer(peers_queue, torrent)
-        else:
-            GetPiece.logger.info("Successfully obtained piece #{} with {}".format(piece_idx, connection))
-            with open(torrent.out_filename, "rb+") as out:
-                out.seek(piece_idx*torrent.my_piece_size)
-                out.write(piece)
-            with pieces_counter.get_lock():
-                pieces_counter.value += 1
-            piece_idx = pieces_queue.get()
-    if connection is not None:
-        connection.socket.close()
-    GetPiece.logger.debug("write_piece done")
-
-
-def feed_pieces_queue(pieces_queue: Queue, pieces_count: int, parallel_peers_count: int):
-    """puts piece indices and stop flags to `pieces_queue`"""
-    for idx in range(pieces_count):
-        pieces_queue.put(idx)
-    for p_count in range(parallel_peers_count):
-        pieces_queue.put(QUEUE_STOP_FLAG)
-    GetPiece.logger.debug("Done feeding queue: {}".format(pieces_queue.qsize()))
-
-
-def update_progress(total_pieces: int, pieces_counter: Value):
-    """updates file with number of pieces obtained out of the total amount"""
-    import time
-    while True:
-        with pieces_counter.get_lock():
-            with open("progress.txt", "w") as out:
-                out.write("{}/{} downloaded".format(
-                    pieces_counter.value, total_pieces))
-            if pieces_counter.value == total_pieces:
-                return
-        time.sleep(1)
-
-
-def write_pieces(peers_queue: Queue, torrent: MyTorrent):
-    """tries getting all pieces in parallel using peers queue and piece indices queue"""
-    GetPiece.logger.info("Trying to get {} pieces".format(torrent.piece_count))
-    pieces_queue = Queue()
-    processes = []
-    parallel_peers_count = peers_queue.qsize() // 5
-    pieces_counter = Value('i', 0)
-    GetPiece.logger.debug("parallel_peers_count={}".format(parallel_peers_count))
-    # run `parallel_peers_count` identical processes of trying to write a piece
-    for _ in range(parallel_peers_count):
-        peer_process = Process(target=write_piece, args=(pieces_queue, peers_queue, torrent, pieces_counter))
-        peer_process.daemon = True
-        processes.append(peer_process)
-    # process to update progress of download, stops when all pieces were written
-    progress_process = Process(target=update_progress, args=(torrent.piece_count, pieces_counter))
-    for process in processes:
-        process.start()
-    progress_process.start()
-    feed_pieces_queue(pieces_queue, torrent.piece_count, parallel_peers_count)
-    progress_process.join()
-
-
-def partition_content_to_files(torrent: MyTorrent):
-    """partition the entire torrent content to actual files using the torrent meta-info"""
-    parent_path = os.path.join("downloads", torrent.out_filename)
-    if not os.path.exists(parent_path):
-        os.makedirs(parent_path)
-    with open(torrent.out_filename, "rb") as content:
-        try:
-            for relative_path, length in torrent.paths_and_lengths:
-                relative_path = [parent_path] + relative_path
-                full_path = os.path.join(*relative_path)
-                dir_path = os.path.dirname(full_path)
-                if not os.path.exists(dir_path):
-                    os.makedirs(dir_path)
-                GetPiece.logger.info("Writing {} bytes to {}".format(length, full_path))
-                with open(full_path, "wb+") as out:
-                    out.write(content.read(length))
-        except KeyError:
-            # single file - move it
-            os.rename(torrent.out_filename, parent_path)
-
-
-def get_files(torrent_path: str):
+def tracker_urls(torrent: MyTorrent, trackers_path: str = TRACKERS_PATH) -> List[str]:
+    """returns announce URLs from torrent file and trackers list file"""
+    return [tier[0] for tier in torrent.trackers or []] + listed_tracker_urls(trackers_path)
+
+
+def get_files(torrent_path: str, verify: bool = False, trackers_path: str = TRACKERS_PATH, seed: bool = False,
+              limiter: RateLimiter = None, metrics: Metrics = None,
+              max_connections: int = ConnectionLimits.MAX_CONNECTIONS,
+              max_half_open: int = ConnectionLimits.MAX_HALF_OPEN):
+    """downloads the torrent content, resuming any interrupted download of it
+    :param verify: whether to verify the completed pieces of a download which was not shut down cleanly
+    :param trackers_path: list of announce URLs to try in addition to the torrent's
+    :param seed: whether to keep uploading the content once it was downloaded, until interrupted
+    :param limiter: RateLimiter of the peer connections, the bandwidth is not limited if None
+    :param metrics: Metrics of the download to export
+    :param max_connections: maximal number of peer connections, dialed or made by peers
+    :param max_half_open: maximal number of handshakes in progress
+    """
     torrent = MyTorrent.read(filepath=torrent_path)
-    open(torrent.out_filename, "w")
-
-    peers_queue = Queue()
-    for peer in peers_from_trackers(torrent):
-        peers_queue.put(peer)
-    write_pieces(peers_queue, torrent)
+    storage = MmapStorage(torrent)
+    storage.preallocate()  # fixed sizes, so the resume file can detect other changes
+    resume = FastResume.load(torrent, storage, verify=verify)
+
+    cache = SwarmCache.load(torrent.infohash)
+    announcer = Announcer(torrent, tracker_urls(torrent, trackers_path), cache=cache, metrics=metrics)
+    limits = ConnectionLimits(max_connections, max_half_open)
+    uploader = Uploader(torrent, storage, resume.completed_pieces(), limiter=limiter, limits=limits)
+    try:
+        DownloadEngine(torrent, cache.known_peers(), storage=storage, resume=resume, announcer=announcer,
+                       cache=cache, uploader=uploader, seed=seed, limiter=limiter, metrics=metrics,
+                       limits=limits).download()
+    finally:
+        cache.save()
 
-    partition_content_to_files(torrent)
-    if os.path.exists(torrent.out_filename):
-        os.remove(torrent.out_filename)
+    # the resume file is kept, saved clean with every piece completed, so a later run seeds right away
     GetPiece.logger.info("Done downloading torrent content!")
 
 
+def get_many_files(torrent_paths: List[str], priorities: List[float] = None, verify: bool = False,
+                   trackers_path: str = TRACKERS_PATH, seed: bool = False, limiter: RateLimiter = None,
+                   metrics: Metrics = None, max_connections: int = ConnectionLimits.MAX_CONNECTIONS,
+                   max_half_open: int = ConnectionLimits.MAX_HALF_OPEN):
+    """downloads the content of many torrents concurrently in one Session, resuming any interrupted downloads
+    :param priorities: weight of the share of the bandwidth of every torrent, all are equal if None
+    :param max_connections: maximal number of peer connections of all torrents
+    :param max_half_open: maximal number of handshakes in progress of all torrents
+    other parameters are as of `get_files`, the rates of `limiter` are split among the torrents
+    """
+    if priorities is not None and len(priorities) != len(torrent_paths):
+        raise Session.Exception("Got {} priorities for {} torrents".format(len(priorities), len(torrent_paths)))
+    session = Session(limiter=limiter, metrics=metrics, max_connections=max_connections,
+                      max_half_open=max_half_open, seed=seed)
+    urls = listed_tracker_urls(trackers_path)
+    for torrent_path, priority in zip(torrent_paths, priorities or [1] * len(torrent_paths)):
+        session.add(torrent_path, urls, priority=priority, verify=verify)
+    session.download()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='torrentclient')
-    parser.add_argument("path")
+    parser.add_argument("path", nargs="+", help="torrent files, many are downloaded concurrently in one session")
+    parser.add_argument("--priorities", type=float, nargs="+",
+                        help="weight of the share of the bandwidth of every torrent, all are equal by default")
+    parser.add_argument("--max-connections", type=int, default=ConnectionLimits.MAX_CONNECTIONS,
+                        help="peer connections, of all torrents of a session")
+    parser.add_argument("--max-half-open", type=int, default=ConnectionLimits.MAX_HALF_OPEN,
+                        help="handshakes in progress, of all torrents of a session")
+    parser.add_argument("--verify", action="store_true",
+                        help="verify pieces of an interrupted download which was not shut down cleanly")
+    parser.add_argument("--trackers", default=TRACKERS_PATH, help="file of announce URLs to try, one per line")
+    parser.add_argument("--seed", action="store_true", help="keep uploading the content once it was downloaded")
+    parser.add_argument("--max-upload-rate", type=float, help="KiB per second uploaded, unlimited by default")
+    parser.add_argument("--max-download-rate", type=float, help="KiB per second downloaded, unlimited by default")
+    parser.add_argument("--peer-max-upload-rate", type=float, help="KiB per second uploaded to a single peer")
+    parser.add_argument("--peer-max-download-rate", type=float, help="KiB per second downloaded from a single peer")
+    parser.add_argument("--metrics-file", help="file the metrics are written to in Prometheus text format")
+    parser.add_argument("--metrics-port", type=int, help="local port serving /metrics and /metrics.json")
+    parser.add_argument("--log-level", default=logconfig.DEFAULT_LEVEL,
+                        help="level of all components, and of single ones, e.g. INFO,peer-connection=DEBUG")
+    parser.add_argument("--log-file", help="file the log is appended to in addition to stderr")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="log only 1 of every N debug records of the same message, e.g. of every block")
     args = parser.parse_args()
-    get_files(torrent_path=args.path)
+    level, levels = logconfig.parse_levels(args.log_level)
+    logconfig.configure(level, levels, path=args.log_file, sample_every=args.log_sample)
+
+    def kib(rate):
+        return rate * 1024 if rate is not None else None
+    rates = (args.max_upload_rate, args.max_download_rate, args.peer_max_upload_rate, args.peer_max_download_rate)
+    limiter = None
+    if any(rate is not None for rate in rates):
+        limiter = RateLimiter(kib(args.max_upload_rate), kib(args.max_download_rate))
+        limiter.set_peer_rates(kib(args.peer_max_upload_rate), kib(args.peer_max_download_rate))
+    metrics = Metrics(path=args.metrics_file, port=args.metrics_port)
+    if len(args.path) == 1 and args.priorities is None:
+        get_files(torrent_path=args.path[0], verify=args.verify, trackers_path=args.trackers, seed=args.seed,
+                  limiter=limiter, metrics=metrics, max_connections=args.max_connections,
+                  max_half_open=args.max_half_open)
+    else:
+        get_many_files(args.path, priorities=args.priorities, verify=args.verify, trackers_path=args.trackers,
+                       seed=args.seed, limiter=limiter, metrics=metrics, max_connections=args.max_connections,
+                       max_half_open=args.max_half_open)
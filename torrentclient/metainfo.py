@@ -0,0 +1,107 @@
+import bisect
+import hashlib
+import bencode
+
+
+HASH_SIZE = 20  # [bytes]
+
+
+class PieceHashes:
+    """Read-only sequence of SHA-1 piece hashes, backed by the single contiguous 'pieces' buffer"""
+
+    __slots__ = ('raw', '_view')
+
+    def __init__(self, raw: bytes):
+        """
+        :param raw: concatenated 20 bytes SHA-1 hashes, as in the 'pieces' key of the info dictionary
+        """
+        self.raw = raw
+        self._view = memoryview(raw)
+
+    def __len__(self) -> int:
+        return len(self.raw) // HASH_SIZE
+
+    def __getitem__(self, piece_idx: int) -> memoryview:
+        """returns the hash of piece `piece_idx` without copying it"""
+        if piece_idx < 0:
+            piece_idx += len(self)
+        if not 0 <= piece_idx < len(self):
+            raise IndexError("piece index out of range ({})".format(piece_idx))
+        start = piece_idx * HASH_SIZE
+        return self._view[start:start + HASH_SIZE]
+
+    def __iter__(self):
+        for piece_idx in range(len(self)):
+            yield self[piece_idx]
+
+    def __getstate__(self) -> bytes:
+        """memoryview can not be pickled - only the raw buffer is sent to other processes"""
+        return self.raw
+
+    def __setstate__(self, raw: bytes):
+        self.__init__(raw)
+
+
+class MetaInfo:
+    """Information of a .torrent file's info dictionary, decoded once:
+    infohash, piece hashes and the geometry of pieces and files"""
+
+    class Exception(Exception):
+        """An exception with the torrent meta-info occurred"""
+
+    def __init__(self, info: dict):
+        """
+        :param info: bdecoded info dictionary of a .torrent file
+        """
+        try:
+            self.infohash = hashlib.sha1(bencode.bencode(info)).digest()
+            self.name = info.get('name')
+            self.piece_length = info['piece length']
+            self.hashes = PieceHashes(info['pieces'])
+            if 'length' in info:
+                self.files = None  # single file
+                self.total_length = info['length']
+            else:
+                self.files = [(file['path'], file['length']) for file in info['files']]
+                self.total_length = sum(length for _, length in self.files)
+        except (KeyError, TypeError) as e:
+            raise MetaInfo.Exception("Invalid info dictionary: {}".format(e))
+        self.piece_count = len(self.hashes)
+        if self.piece_count != -(-self.total_length // self.piece_length):
+            raise MetaInfo.Exception("{} hashes do not match total length {} with pieces of {} bytes".format(
+                self.piece_count, self.total_length, self.piece_length))
+        self.last_piece_length = self.total_length - (self.piece_count - 1) * self.piece_length
+        self.file_offsets = []
+        offset = 0
+        for _, length in self.files or [(None, self.total_length)]:
+            self.file_offsets.append(offset)
+            offset += length
+
+    def __str__(self):
+        return "MetaInfo(name={}, piece_count={}, piece_length={})".format(
+            self.name, self.piece_count, self.piece_length)
+
+    @classmethod
+    def read(cls, path: str):
+        """decodes .torrent file in `path`"""
+        try:
+            bcode = bencode.bread(path)
+        except bencode.BencodeDecodeError as e:
+            raise MetaInfo.Exception("Could not bdecode {}: {}".format(path, e))
+        if 'info' not in bcode:
+            raise MetaInfo.Exception("No info dictionary in {}".format(path))
+        return cls(bcode['info'])
+
+    def piece_offset(self, piece_idx: int) -> int:
+        """returns offset of piece `piece_idx` in the entire torrent content [bytes]"""
+        return piece_idx * self.piece_length
+
+    def piece_size(self, piece_idx: int) -> int:
+        """returns length of piece `piece_idx`, the last piece may be shorter [bytes]"""
+        if piece_idx == self.piece_count - 1:
+            return self.last_piece_length
+        return self.piece_length
+
+    def file_index(self, offset: int) -> int:
+        """returns index of the file containing byte `offset` of the entire torrent content"""
+        return bisect.bisect_right(self.file_offsets, offset) - 1
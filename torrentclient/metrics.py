@@ -0,0 +1,205 @@
+import os
+import json
+import bisect
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+
+class Histogram:
+    """Counts of observed values in cumulative buckets by their upper bounds, as Prometheus histograms"""
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts values above all buckets
+        self.sum = 0
+        self.count = 0
+
+    def __str__(self):
+        return "Histogram(count={}, sum={:.3f})".format(self.count, self.sum)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """returns (upper bound, number of values up to it) of every bucket, the last bound is infinite"""
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class Metrics:
+    """Counters, gauges and histograms of the download, each with any labels (e.g. peer="1.2.3.4:6881").
+    A snapshot of all of them is a JSON-serializable dict, and they are exported in the Prometheus text format
+    to a file rewritten by `export`, and to a local HTTP endpoint serving /metrics and /metrics.json.
+    Metrics are only updated from the event loop thread.
+    A child of the metrics (e.g. of one torrent of a session) shares their series, adding its labels to every one."""
+
+    PREFIX = "torrentclient_"
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # [seconds]
+
+    HOST = "127.0.0.1"
+    """the HTTP endpoint is local only"""
+
+    logger = logging.getLogger('metrics')
+
+    class Exception(Exception):
+        """An exception with exporting the metrics occurred"""
+
+    def __init__(self, path: Optional[str] = None, port: Optional[int] = None, labels: Dict[str, str] = None):
+        """
+        :param path: file the metrics are written to in Prometheus text format by `export`, not written if None
+        :param port: port of the HTTP endpoint, not served if None
+        :param labels: labels added to every series
+        """
+        self.path = path
+        self.port = port
+        self.labels = labels or {}
+        self.counters = {}  # type: Dict[str, Dict[Tuple, float]]
+        self.gauges = {}  # type: Dict[str, Dict[Tuple, float]]
+        self.histograms = {}  # type: Dict[str, Dict[Tuple, Histogram]]
+        self.server = None
+
+    def __str__(self):
+        return "Metrics(counters={}, gauges={}, histograms={})".format(
+            len(self.counters), len(self.gauges), len(self.histograms))
+
+    def child(self, **labels) -> 'Metrics':
+        """returns metrics sharing the series of these, with `labels` added to every series set through them.
+        the child is neither exported nor served, these metrics are"""
+        child = Metrics(labels={**self.labels, **labels})
+        child.counters, child.gauges, child.histograms = self.counters, self.gauges, self.histograms
+        return child
+
+    def _key(self, labels: dict) -> Tuple:
+        if self.labels:
+            labels = {**self.labels, **labels}
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """adds `value` to a counter"""
+        series = self.counters.setdefault(name, {})
+        key = self._key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        """sets a gauge"""
+        self.gauges.setdefault(name, {})[self._key(labels)] = value
+
+    def clear(self, name: str):
+        """removes all labeled values of a gauge, e.g. of peers which are gone. a child removes only its own"""
+        if not self.labels:
+            self.gauges.pop(name, None)
+            return
+        own = set(self.labels.items())
+        series = self.gauges.get(name, {})
+        for key in [key for key in series if own.issubset(key)]:
+            del series[key]
+
+    def observe(self, name: str, value: float, buckets: Iterable[float] = LATENCY_BUCKETS, **labels):
+        """adds a value to a histogram"""
+        series = self.histograms.setdefault(name, {})
+        key = self._key(labels)
+        if key not in series:
+            series[key] = Histogram(buckets)
+        series[key].observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        """returns the value of a counter or gauge, 0 if it was not set"""
+        key = self._key(labels)
+        return self.counters.get(name, {}).get(key, self.gauges.get(name, {}).get(key, 0))
+
+    def snapshot(self) -> dict:
+        """returns all metrics as {type: {name: [{'labels': {...}, ...}]}}"""
+        def values(metrics: dict) -> dict:
+            return {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                    for name, series in metrics.items()}
+        return {
+            'counters': values(self.counters),
+            'gauges': values(self.gauges),
+            'histograms': {
+                name: [{'labels': dict(key), 'count': histogram.count, 'sum': histogram.sum,
+                        'buckets': [[bound if bound != float("inf") else "+Inf", count]
+                                    for bound, count in histogram.cumulative()]}
+                       for key, histogram in series.items()]
+                for name, series in self.histograms.items()
+            },
+        }
+
+    @staticmethod
+    def _labels_text(key: Tuple, extra: Tuple = ()) -> str:
+        labels = key + extra
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels) + "}"
+
+    def prometheus(self) -> str:
+        """returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric_type, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+            for name, series in sorted(metrics.items()):
+                lines.append("# TYPE {}{} {}".format(self.PREFIX, name, metric_type))
+                for key, value in series.items():
+                    lines.append("{}{}{} {}".format(self.PREFIX, name, self._labels_text(key), value))
+        for name, series in sorted(self.histograms.items()):
+            lines.append("# TYPE {}{} histogram".format(self.PREFIX, name))
+            for key, histogram in series.items():
+                for bound, count in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append("{}{}_bucket{} {}".format(self.PREFIX, name, self._labels_text(key, (("le", le),)),
+                                                           count))
+                lines.append("{}{}_sum{} {}".format(self.PREFIX, name, self._labels_text(key), histogram.sum))
+                lines.append("{}{}_count{} {}".format(self.PREFIX, name, self._labels_text(key), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """atomically rewrites the metrics file, if there is one"""
+        if self.path is None:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as out:
+            out.write(self.prometheus())
+        os.replace(temp_path, self.path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass  # headers
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.prometheus()
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.snapshot())
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            body = body.encode("utf-8")
+            writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+                status, content_type, len(body)).encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.logger.debug("Metrics request failed: %s", e)
+        finally:
+            writer.close()
+
+    async def start(self):
+        """serves the HTTP endpoint in the running event loop, if there is a port"""
+        if self.port is None or self.server is not None:
+            return
+        try:
+            self.server = await asyncio.start_server(self._handle, self.HOST, self.port)
+        except OSError as e:
+            raise Metrics.Exception("Could not serve metrics on port {}: {}".format(self.port, e))
+        self.logger.info("Serving metrics on http://{}:{}/metrics".format(self.HOST, self.port))
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
@@ -1,62 +1,58 @@
 import math
-import bencode
+from typing import List, Tuple
 
 from torf import Torrent
 
+from torrentclient.metainfo import MetaInfo, PieceHashes, HASH_SIZE
+
 
 class MyTorrent(Torrent):
     """Class wrapper to torf's Torrent, adding fixes and additional features"""
 
-    HASH_SIZE = 20  # [bytes]
+    HASH_SIZE = HASH_SIZE  # [bytes]
+    BLOCK_SIZE = 2 ** 14  # [bytes] largest request length peers are required to serve
 
     @classmethod
     def read(cls, *args, **kwargs):
         obj = super().read(*args, **kwargs)
         if obj.path is None:
             obj.path = kwargs['filepath']
+        obj.meta = MetaInfo.read(obj.path)  # decoded once, setting `path` drops torf's info dictionary
         return obj
 
     @property
     def total_length(self) -> int:
-        bcode = bencode.bread(self.path)
-        if 'length' in bcode['info']:
-            self._total_length = bcode['info']['length']
-        else:
-            self._total_length = 0
-            for file in bcode['info']['files']:
-                self._total_length += file['length']
-        return self._total_length
+        return self.meta.total_length
 
     @property
     def paths_and_lengths(self) -> list:
-        bcode = bencode.bread(self.path)
-        return [(file['path'], file['length']) for file in bcode['info']['files']]
+        if self.meta.files is None:
+            raise KeyError('files')  # single file torrent
+        return self.meta.files
 
     @property
     def infohash(self) -> bytes:
-        import hashlib
-        return hashlib.sha1(bencode.bencode(bencode.bread(self.path)['info'])).digest()
+        return self.meta.infohash
 
     @property
     def raw_hashes(self) -> bytes:
-        return bencode.bread(self.path)['info']['pieces']
+        return self.meta.hashes.raw
 
     @property
-    def hashes(self):
-        """fix of hashes attribute in torf
-        and used list instead of generator"""
-        return [self.raw_hashes[idx:idx+self.HASH_SIZE] for idx in range(0, len(self.raw_hashes), self.HASH_SIZE)]
+    def hashes(self) -> PieceHashes:
+        """fix of hashes attribute in torf,
+        indexing returns a 20 bytes memoryview of the piece hash"""
+        return self.meta.hashes
 
     @property
     def piece_count(self) -> int:
         """number of hashed pieces"""
-        return len(self.raw_hashes) // self.HASH_SIZE
+        return self.meta.piece_count
 
     @property
     def my_piece_size(self) -> int:
         """size of hashed piece [bytes]"""
-        minimal_size = round(self.total_length / self.piece_count)
-        return 2 ** math.ceil(math.log(minimal_size, 2))  # rounds up to highest 2**x value
+        return self.meta.piece_length
 
     @property
     def block_count(self) -> int:
@@ -66,7 +62,13 @@ class MyTorrent(Torrent):
     @property
     def block_size(self) -> int:
         """block length to request from peer [bytes]"""
-        return self.piece_size
+        return self.BLOCK_SIZE
+
+    def blocks(self, piece_idx: int) -> List[Tuple[int, int]]:
+        """returns (block_begin, block_length) of every block in piece `piece_idx`"""
+        piece_size = self.meta.piece_size(piece_idx)
+        return [(block_begin, min(self.block_size, piece_size - block_begin))
+                for block_begin in range(0, piece_size, self.block_size)]
 
     @property
     def out_filename(self) -> str:
@@ -1,5 +1,7 @@
 """All classes below inherit from PeerMessages.
 Each message presents a specific message from the peer wire BitTorrent protocol."""
+import struct
+
 from torrentclient.peercode.message import PeerMessage
 
 
@@ -10,30 +12,43 @@ class KeepAlive(PeerMessage):
     """Peers may close a connection if they receive no messages for a certain period of time, so a keep-alive message
     must be sent to maintain the connection alive if no command have been sent for a given amount of time."""
 
+    __slots__ = ()
+
     MESSAGE_ID = None
 
+    def create(self) -> bytes:
+        return self.int_to_4bytes(0)
+
 
 class Choke(PeerMessage):
     """Indicating the sending peer will not handle current and future requests until un-chocked"""
 
+    __slots__ = ()
+
     MESSAGE_ID = 0
 
 
 class UnChoke(PeerMessage):
     """Indicating the sending peer will handle future requests"""
 
+    __slots__ = ()
+
     MESSAGE_ID = 1
 
 
 class Interested(PeerMessage):
     """Indicating the sending peer will send requests when the receiver peer is un-choked"""
 
+    __slots__ = ()
+
     MESSAGE_ID = 2
 
 
 class NotInterested(PeerMessage):
     """Indicating the sending peer will stop sending requests"""
 
+    __slots__ = ()
+
     MESSAGE_ID = 3
 
 
@@ -43,8 +58,13 @@ class NotInterested(PeerMessage):
 class HavePiece(PeerMessage):
     """Indicating the sending peer has a specific piece"""
 
+    __slots__ = ('piece_index',)
+
     MESSAGE_ID = 4
 
+    CODEC = struct.Struct(">IBI")
+    """length prefix, message ID and piece index"""
+
     def __init__(self, piece_index: int):
         """
         :param piece_index: zero-based index of a piece
@@ -52,18 +72,19 @@ class HavePiece(PeerMessage):
         self.piece_index = piece_index
         if not isinstance(piece_index, int):
             raise super().Exception("piece_index must be a positive integer ({})".format(piece_index))
-        super().__init__(payload=self.int_to_4bytes(piece_index))
 
     def __str__(self):
         return "HavePiece(piece_index={})".format(self.piece_index)
 
+    def create(self) -> bytes:
+        return self.CODEC.pack(1 + self.PARAM_LENGTH, self.MESSAGE_ID, self.piece_index)
+
     @classmethod
     def from_payload(cls, payload: bytes):
         if len(payload) != cls.PARAM_LENGTH:
             raise super().Exception("Invalid payload length ({}), should be {} bytes".format(
                 len(payload), cls.PARAM_LENGTH))
-        piece_index = int.from_bytes(payload, byteorder="big")
-        return cls(piece_index=piece_index)
+        return cls(cls.LENGTH.unpack(payload)[0])
 
 
 class PiecesBitField(PeerMessage):
@@ -71,6 +92,8 @@ class PiecesBitField(PeerMessage):
     May only be sent immediately after the handshaking sequence is completed, and before any other messages are sent,
     It is optional, and need not be sent if a client has no pieces."""
 
+    __slots__ = ('bitfield',)
+
     MESSAGE_ID = 5
 
     def __init__(self, bitfield: bytes):
@@ -80,57 +103,88 @@ class PiecesBitField(PeerMessage):
             spare bits at the end are set to zero.
         """
         self.bitfield = bitfield
-        super().__init__(payload=bitfield)
 
     def __str__(self):
         return "PiecesBitField(bitfield={})".format(self.bitfield)
 
+    def create(self) -> bytes:
+        return self.PREFIX.pack(1 + len(self.bitfield), self.MESSAGE_ID) + self.bitfield
+
     @classmethod
     def from_payload(cls, payload: bytes):
-        return cls(bitfield=payload)
+        return cls(bitfield=bytes(payload))  # payload may be a view of a reused receive buffer
 
 
-class RequestBlock(PeerMessage):
-    """Request of a specific block of a piece"""
+class BlockSpanMessage(PeerMessage):
+    """Base of the messages naming a block of a piece by its begin and length, RequestBlock and CancelRequest"""
 
-    MESSAGE_ID = 6
+    __slots__ = ('piece_index', 'block_begin', 'block_length')
+
+    CODEC = struct.Struct(">IBIII")
+    """length prefix, message ID, piece index, block begin and block length"""
+
+    PAYLOAD = struct.Struct(">III")
 
     def __init__(self, piece_index: int, block_begin: int, block_length: int):
         """
         :param piece_index: zero-based index of a piece
         :param block_begin: zero-based byte offset within the piece
-        :param block_length: block length in bytes
+        :param block_length: block length in bytes, use of 2^14 (16KB) is recommended by BitTorrent specifications
         """
         self.piece_index = piece_index
         self.block_begin = block_begin
         self.block_length = block_length
-        super().__init__(
-            payload=self.int_to_4bytes(piece_index) + self.int_to_4bytes(block_begin) + self.int_to_4bytes(block_length)
-        )
 
     def __str__(self):
-        return "RequestBlock(piece_index={}, block_begin={}, block_length={})".format(
+        return "{}(piece_index={}, block_begin={}, block_length={})".format(
+            type(self).__name__,
             self.piece_index,
             self.block_begin,
             self.block_length,
         )
 
+    def create(self) -> bytes:
+        return self.CODEC.pack(1 + self.PAYLOAD.size, self.MESSAGE_ID, self.piece_index, self.block_begin,
+                               self.block_length)
+
+    @classmethod
+    def create_many(cls, piece_index: int, blocks: list) -> bytearray:
+        """returns the encoded messages of (block begin, block length) `blocks` of a piece,
+        packed into a single buffer instead of joining a bytes object of every message"""
+        buffer = bytearray(cls.CODEC.size * len(blocks))
+        for offset, (block_begin, block_length) in zip(range(0, len(buffer), cls.CODEC.size), blocks):
+            cls.CODEC.pack_into(buffer, offset, 1 + cls.PAYLOAD.size, cls.MESSAGE_ID, piece_index, block_begin,
+                                block_length)
+        return buffer
+
     @classmethod
     def from_payload(cls, payload: bytes):
-        if len(payload) != cls.PARAM_LENGTH*3:
+        if len(payload) != cls.PAYLOAD.size:
             raise super().Exception("Invalid payload length ({}), should be {} bytes".format(
-                len(payload), cls.PARAM_LENGTH*3))
-        piece_index = int.from_bytes(payload[:cls.PARAM_LENGTH], byteorder="big")
-        block_begin = int.from_bytes(payload[cls.PARAM_LENGTH:cls.PARAM_LENGTH*2], byteorder="big")
-        block_length = int.from_bytes(payload[cls.PARAM_LENGTH*2:cls.PARAM_LENGTH*3], byteorder="big")
-        return cls(piece_index, block_begin, block_length)
+                len(payload), cls.PAYLOAD.size))
+        return cls(*cls.PAYLOAD.unpack(payload))
+
+
+class RequestBlock(BlockSpanMessage):
+    """Request of a specific block of a piece"""
+
+    __slots__ = ()
+
+    MESSAGE_ID = 6
 
 
 class Block(PeerMessage):
     """A block from a piece"""
 
+    __slots__ = ('piece_index', 'block_begin', 'block')
+
     MESSAGE_ID = 7
 
+    HEADER = struct.Struct(">IBII")
+    """length prefix, message ID, piece index and block begin"""
+
+    PAYLOAD_HEADER = struct.Struct(">II")
+
     def __init__(self, piece_index: int, block_begin: int, block: bytes):
         """
         :param piece_index: zero-based index of a piece
@@ -140,53 +194,34 @@ class Block(PeerMessage):
         self.piece_index = piece_index
         self.block_begin = block_begin
         self.block = block
-        super().__init__(payload=self.int_to_4bytes(piece_index) + self.int_to_4bytes(block_begin) + block)
 
     def __str__(self):
         return "Block(piece_index={}, block_begin={})".format(self.piece_index, self.block_begin)
 
     @classmethod
-    def from_payload(cls, payload: bytes):
-        piece_index = int.from_bytes(payload[:cls.PARAM_LENGTH], byteorder="big")
-        block_begin = int.from_bytes(payload[cls.PARAM_LENGTH:cls.PARAM_LENGTH*2], byteorder="big")
-        block = payload[cls.PARAM_LENGTH*2:]
-        return cls(piece_index, block_begin, block)
+    def header(cls, piece_index: int, block_begin: int, block_length: int) -> bytes:
+        """returns the encoded message up to the block content, so the content can be sent straight from a file"""
+        return cls.HEADER.pack(1 + cls.PAYLOAD_HEADER.size + block_length, cls.MESSAGE_ID, piece_index, block_begin)
 
+    def create(self) -> bytes:
+        return self.header(self.piece_index, self.block_begin, len(self.block)) + self.block
 
-class CancelRequest(PeerMessage):
-    """Cancel block requests (Request class)"""
+    @classmethod
+    def from_payload(cls, payload: bytes):
+        """`block` is a zero-copy memoryview of `payload`"""
+        if len(payload) < cls.PAYLOAD_HEADER.size:
+            raise super().Exception("Invalid payload length ({}), should be at least {} bytes".format(
+                len(payload), cls.PAYLOAD_HEADER.size))
+        piece_index, block_begin = cls.PAYLOAD_HEADER.unpack_from(payload)
+        return cls(piece_index, block_begin, memoryview(payload)[cls.PAYLOAD_HEADER.size:])
 
-    MESSAGE_ID = 8
 
-    def __init__(self, piece_index: int, block_begin: int, block_length: int):
-        """
-        :param piece_index: zero-based index of a piece
-        :param block_begin: zero-based byte offset within the piece
-        :param block_length: block length in bytes, use of 2^14 (16KB) is recommended by BitTorrent specifications
-        """
-        self.piece_index = piece_index
-        self.block_begin = block_begin
-        self.block_length = block_length
-        super().__init__(
-            payload=self.int_to_4bytes(piece_index) + self.int_to_4bytes(block_begin) + self.int_to_4bytes(block_length)
-        )
+class CancelRequest(BlockSpanMessage):
+    """Cancel block requests (Request class)"""
 
-    def __str__(self):
-        return "CancelRequest(piece_index={}, block_begin={}, block_length={})".format(
-            self.piece_index,
-            self.block_begin,
-            self.block_length,
-        )
+    __slots__ = ()
 
-    @classmethod
-    def from_payload(cls, payload: bytes):
-        if len(payload) != cls.PARAM_LENGTH*3:
-            raise super().Exception("Invalid payload length ({}), should be {} bytes".format(
-                len(payload), cls.PARAM_LENGTH*3))
-        piece_index = int.from_bytes(payload[:cls.PARAM_LENGTH], byteorder="big")
-        block_begin = int.from_bytes(payload[cls.PARAM_LENGTH:cls.PARAM_LENGTH*2], byteorder="big")
-        block_length = int.from_bytes(payload[cls.PARAM_LENGTH*2:cls.PARAM_LENGTH*3], byteorder="big")
-        return cls(piece_index, block_begin, block_length)
+    MESSAGE_ID = 8
 
 
 class Port(PeerMessage):
@@ -194,22 +229,27 @@ class Port(PeerMessage):
     The listen port is the port this peer's DHT node is listening on.
     This peer should be inserted in the local routing table"""
 
+    __slots__ = ('listen_port',)
+
     MESSAGE_ID = 9
 
+    CODEC = struct.Struct(">H")
+
     def __init__(self, listen_port: int):
         self.listen_port = listen_port
-        super.__init__(payload=self.int_to_4bytes(listen_port))
 
     def __str__(self):
         return "Port(listen_port={})".format(self.listen_port)
 
+    def create(self) -> bytes:
+        return self.PREFIX.pack(1 + self.CODEC.size, self.MESSAGE_ID) + self.CODEC.pack(self.listen_port)
+
     @classmethod
     def from_payload(cls, payload: bytes):
-        if len(payload) != cls.PARAM_LENGTH:
+        if len(payload) != cls.CODEC.size:
             raise super().Exception("Invalid payload length ({}), should be {} bytes".format(
-                len(payload), cls.PARAM_LENGTH))
-        listen_port = int.from_bytes(payload[:cls.PARAM_LENGTH], byteorder="big")
-        return cls(listen_port)
+                len(payload), cls.CODEC.size))
+        return cls(*cls.CODEC.unpack(payload))
 
 
 all_messages = [
@@ -0,0 +1,64 @@
+class RecvBuffer:
+    """Reusable receive buffer of a peer wire connection.
+    Received bytes are written in place (`socket.recv_into`) and read as memoryview slices,
+    once all bytes are read the buffer starts over from its beginning.
+    Slices handed out are only valid until the next call to `writable`, which may move unread bytes."""
+
+    INITIAL_SIZE = 2 ** 17  # [bytes] fits several 16KB Block messages
+
+    class Exception(Exception):
+        """An exception with the receive buffer occurred"""
+
+    def __init__(self, size: int = INITIAL_SIZE):
+        """
+        :param size: initial capacity, grows for messages larger than it
+        """
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self.start = 0  # first unread byte
+        self.end = 0  # end of received bytes
+
+    def __len__(self) -> int:
+        """number of received bytes which were not read yet"""
+        return self.end - self.start
+
+    def __str__(self):
+        return "RecvBuffer(unread={}, capacity={})".format(len(self), len(self._buffer))
+
+    def clear(self):
+        self.start = self.end = 0
+
+    def writable(self, min_count: int = 1) -> memoryview:
+        """returns the free space after the unread bytes, at least `min_count` bytes long"""
+        if self.start == self.end:
+            self.clear()
+        if len(self._buffer) - self.end < min_count:
+            unread = len(self)
+            if unread + min_count > len(self._buffer):
+                # replaced instead of resized - handed out slices still reference the old buffer
+                buffer = bytearray(max(unread + min_count, 2 * len(self._buffer)))
+                buffer[:unread] = self._view[self.start:self.end]
+                self._buffer = buffer
+                self._view = memoryview(buffer)
+            else:
+                self._view[:unread] = self._view[self.start:self.end]  # memoryview copies with memmove
+            self.start, self.end = 0, unread
+        return self._view[self.end:]
+
+    def written(self, count: int):
+        """marks `count` bytes, received into the `writable` view, as unread"""
+        if self.end + count > len(self._buffer):
+            raise RecvBuffer.Exception("Written {} bytes beyond capacity {}".format(count, len(self._buffer)))
+        self.end += count
+
+    def peek(self, count: int) -> memoryview:
+        """returns next `count` unread bytes without reading them"""
+        if count > len(self):
+            raise RecvBuffer.Exception("Only {} unread bytes - requested {}".format(len(self), count))
+        return self._view[self.start:self.start + count]
+
+    def read(self, count: int) -> memoryview:
+        """returns next `count` unread bytes"""
+        view = self.peek(count)
+        self.start += count
+        return view
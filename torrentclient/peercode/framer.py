@@ -0,0 +1,98 @@
+import logging
+from typing import List
+
+from torrentclient.peercode.buffer import RecvBuffer
+from torrentclient.peercode.message import PeerMessage
+from torrentclient.peercode.allmessages import KeepAlive, Choke, UnChoke, Interested, NotInterested, \
+    id_to_message
+
+
+class MessageFramer:
+    """Incremental framing state machine of the peer wire protocol.
+    Accepts arbitrary chunks of received bytes and returns every complete message,
+    a partial message is kept in the buffer and completed by the following chunks."""
+
+    LENGTH_BYTES = 4
+    MESSAGE_ID_BYTES = 1
+
+    MAX_MESSAGE_LENGTH = 2 ** 21  # [bytes]
+    """longer length prefixes mean the stream is corrupt and can not be framed anymore"""
+
+    NO_PAYLOAD_MESSAGES = {message_cls.MESSAGE_ID: message_cls() for message_cls in (
+        Choke, UnChoke, Interested, NotInterested)}
+    """messages without payload have no state, a single instance of each is returned for all of them"""
+
+    KEEPALIVE = KeepAlive()
+
+    logger = logging.getLogger('message-framer')
+
+    class Exception(Exception):
+        """An exception with framing the peer messages stream occurred"""
+
+    def __init__(self, buffer: RecvBuffer = None):
+        """
+        :param buffer: buffer received bytes are written to
+        """
+        self.buffer = RecvBuffer() if buffer is None else buffer
+        self.length = None  # of the current message, None while its length prefix is incomplete
+
+    def __str__(self):
+        return "MessageFramer(buffer={}, length={})".format(self.buffer, self.length)
+
+    @property
+    def missing(self) -> int:
+        """minimal number of bytes required to complete the current message"""
+        if self.length is None:
+            return self.LENGTH_BYTES - len(self.buffer)
+        return self.length - len(self.buffer)
+
+    def get_buffer(self, min_count: int = 1) -> memoryview:
+        """returns a writable view to receive bytes into (e.g. with `socket.recv_into`)"""
+        return self.buffer.writable(max(min_count, 1))
+
+    def buffer_updated(self, count: int):
+        """marks `count` bytes received into the view of `get_buffer`"""
+        self.buffer.written(count)
+
+    def feed(self, chunk: bytes) -> List[PeerMessage]:
+        """appends `chunk` and returns all messages completed by it"""
+        self.get_buffer(len(chunk))[:len(chunk)] = chunk
+        self.buffer_updated(len(chunk))
+        return self.messages()
+
+    def _decode(self, body: memoryview) -> PeerMessage:
+        """messages factory-like method,
+        payloads are memoryview slices of the receive buffer"""
+        if len(body) == 0:
+            return self.KEEPALIVE
+        # Messages that at least have an ID
+        message = self.NO_PAYLOAD_MESSAGES.get(body[0])
+        if message is not None:
+            if len(body) != self.MESSAGE_ID_BYTES:
+                raise PeerMessage.Exception("{} messages should be of length 1 ({})".format(
+                    message.__class__.__name__, len(body)))
+            return message
+        return id_to_message[body[0]].from_payload(body[self.MESSAGE_ID_BYTES:])
+
+    def messages(self) -> List[PeerMessage]:
+        """returns all complete messages in the buffer,
+        a message which can not be decoded is skipped without losing the messages after it"""
+        messages = []
+        while True:
+            if self.length is None:
+                if len(self.buffer) < self.LENGTH_BYTES:
+                    return messages
+                self.length = PeerMessage.LENGTH.unpack(self.buffer.read(self.LENGTH_BYTES))[0]
+                if self.length > self.MAX_MESSAGE_LENGTH:
+                    raise MessageFramer.Exception("Message length {} exceeds {} bytes".format(
+                        self.length, self.MAX_MESSAGE_LENGTH))
+            if len(self.buffer) < self.length:
+                return messages
+            body = self.buffer.read(self.length)
+            self.length = None
+            try:
+                messages.append(self._decode(body))
+            except KeyError:
+                self.logger.debug("Skipping message of unsupported ID %d", body[0])
+            except PeerMessage.Exception as e:
+                self.logger.warning("Skipping message which could not be decoded: %s", e)
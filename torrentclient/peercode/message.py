@@ -1,11 +1,20 @@
+import struct
 import logging
 
 
 class PeerMessage:
-    """Data class of a peer message in BitTorrent protocol"""
+    """Data class of a peer message in BitTorrent protocol.
+    Messages are created for every block sent and received, so they have __slots__ instead of a __dict__,
+    and messages with fixed-size fields encode and decode them with precompiled struct codecs."""
+
+    __slots__ = ()
 
     PARAM_LENGTH = 4
 
+    LENGTH = struct.Struct(">I")
+    PREFIX = struct.Struct(">IB")
+    """length prefix and message ID"""
+
     logger = logging.getLogger('peer-message')
 
     class Exception(Exception):
@@ -13,25 +22,14 @@ class PeerMessage:
 
     @staticmethod
     def int_to_4bytes(param: int) -> bytes:
-        return param.to_bytes(length=PeerMessage.PARAM_LENGTH, byteorder="big", signed=False)
-
-    def __init__(self, payload: bytes = b''):
-        """
-        :param payload: message content in bytes
-        """
-        if self.MESSAGE_ID is None:
-            self.message_id = b''
-        else:
-            self.message_id = bytes([self.MESSAGE_ID])  # 1 byte
-        self.payload = payload
-        self.length = self.int_to_4bytes(len(self.message_id + self.payload))
+        return PeerMessage.LENGTH.pack(param)
 
     def __str__(self):
         """used for debug logging"""
         return "{}(MESSAGE_ID={}, length={})".format(
             self.__class__.__name__,
             self.MESSAGE_ID,
-            len(self.message_id + self.payload),
+            len(self.create()) - self.PARAM_LENGTH,
         )
 
     @property
@@ -40,6 +38,11 @@ class PeerMessage:
             self.__class__.__name__
         ))
 
+    @property
+    def payload(self) -> bytes:
+        """message content in bytes, after the message ID"""
+        return self.create()[self.PREFIX.size:]
+
     def create(self) -> bytes:
-        """returns the entire encoded message in bytes"""
-        return self.length + self.message_id + self.payload
+        """returns the entire encoded message in bytes, messages with a payload override it"""
+        return self.PREFIX.pack(1, self.MESSAGE_ID)
@@ -1,19 +1,39 @@
+import socket
+import asyncio
 import logging
 from typing import List
 
 from torrentclient.peerinteract.peer import Peer
+from torrentclient.peercode.framer import MessageFramer
 from torrentclient.peercode.message import PeerMessage
 from torrentclient.peercode.allmessages import KeepAlive, Choke, UnChoke, Interested, \
-    NotInterested, RequestBlock, Block, CancelRequest, Port, id_to_message
+    NotInterested, HavePiece, PiecesBitField, RequestBlock, Block, CancelRequest, Port
+from torrentclient.peerinteract.piecepicker import PiecePicker
+from torrentclient.peerinteract.ratelimit import RateLimiter
 
 
 class PeerConnection:
-    """Class for a Peer wire protocol TCP connection"""
+    """Class for a Peer wire protocol TCP connection,
+    the socket is non-blocking and all I/O is awaited in the running asyncio event loop.
+    A timer of the connection sends KeepAlive only after KEEPALIVE_INTERVAL of outbound silence,
+    and closes the connection after IDLE_TIMEOUT of inbound silence while it is not being read from.
+    Sends are serialized by a lock, so blocks may be uploaded while pieces are being downloaded.
+    With a RateLimiter limiting a rate of some scope, every send waits for upload tokens, and every receive
+    of up to RECV_QUANTUM bytes waits for the download tokens of the bytes it got,
+    so a connection waiting for data holds no tokens."""
 
-    LENGTH_BYTES = 4
-    MESSAGE_ID_BYTES = 1
+    RECV_TIMEOUT = 30  # [seconds]
 
-    BUFFER_SIZE = 1024
+    KEEPALIVE_INTERVAL = 110  # [seconds]
+    """outbound silence after which a KeepAlive is sent, peers drop connections silent for 2 minutes"""
+
+    IDLE_TIMEOUT = 180  # [seconds]
+    """inbound silence after which the peer is assumed gone"""
+
+    TIMER_INTERVAL = 10  # [seconds]
+
+    RECV_QUANTUM = 2 ** 15  # [bytes]
+    """most bytes received at once while rate limited, so limited connections share the rate evenly"""
 
     logger = logging.getLogger('peer-connection')
 
@@ -22,140 +42,246 @@ class PeerConnection:
     class Exception(Exception):
         """An exception with connection to peer occurred"""
 
-    def __init__(self, peer: Peer, socket):
+    def __init__(self, peer: Peer, socket, picker: PiecePicker = None, uploader=None, limiter: RateLimiter = None):
         """
         :param peer: Peer connected to
         :param socket: connected socket after a handshake
+        :param picker: PiecePicker counting the pieces announced by the peer
+        :param uploader: Uploader answering the peer's RequestBlock messages, they are ignored if None
+        :param limiter: RateLimiter of the peer, the connection is not limited if None
         """
         self.peer = peer
         self.socket = socket
+        self.picker = picker
+        self.uploader = uploader
+        self.limiter = limiter
+        self.framer = MessageFramer()
         self.am_choking = True
         self.am_interested = False
         self.peer_choking = True
         self.peer_interested = False
+        self.loop = asyncio.get_running_loop()
+        self.last_sent = self.last_received = self.loop.time()
+        self.sending = False
+        self.receiving = False
+        self.send_lock = asyncio.Lock()
+        self.downloaded = 0  # [bytes] of received blocks
+        self.uploaded = 0  # [bytes] of sent blocks
+        self.closed_reason = None
+        self.on_close = None  # called with the connection once it is closed
+        self.keepalive_task = None
+        self.timer = self.loop.call_later(self.TIMER_INTERVAL, self._on_timer)
 
     def __str__(self):
         return "PeerConnection(peer={})".format(self.peer)
 
-    def _recv(self, buffer_size: int) -> bytes:
-        self.socket.send(self.keepalive_message)
+    def _on_timer(self):
+        """sends a KeepAlive after outbound silence, closes the connection after inbound silence"""
+        if self.socket.fileno() == -1:
+            return
+        now = self.loop.time()
+        if not self.receiving and now - self.last_received >= self.IDLE_TIMEOUT:
+            self.logger.info("Closing {} silent for {:.0f} seconds".format(self, now - self.last_received))
+            self.close("silent for {:.0f} seconds".format(now - self.last_received))
+            return
+        if not self.sending and not self.send_lock.locked() and now - self.last_sent >= self.KEEPALIVE_INTERVAL and \
+                (self.keepalive_task is None or self.keepalive_task.done()):
+            self.keepalive_task = asyncio.ensure_future(self._send_keepalive())
+        self.timer = self.loop.call_later(self.TIMER_INTERVAL, self._on_timer)
+
+    async def _send_keepalive(self):
+        """sends a KeepAlive through the send lock, so it is never interleaved with a partially sent message"""
+        try:
+            await self._sendall(self.keepalive_message)
+        except PeerConnection.Exception as e:
+            self.logger.info("Could not send KeepAlive to %s: %s", self.peer, e)
+
+    def close(self, reason: str = "closed"):
+        if self.closed_reason is None and self.on_close is not None:
+            self.on_close(self)
+        self.closed_reason = reason
+        self.timer.cancel()
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+        self.socket.close()
+
+    def _check_open(self):
+        if self.closed_reason is not None:
+            raise PeerConnection.Exception("Connection to {} was closed: {}".format(self.peer, self.closed_reason))
+
+    async def _recv(self, min_count: int = 1, timeout: float = RECV_TIMEOUT):
+        """receives at least one byte into the framer buffer, as many as are available,
+        with room for at least `min_count` bytes"""
+        self._check_open()
+        self.receiving = True
+        buffer = self.framer.get_buffer(min_count)
+        # the rates may be changed at runtime, so whether they are limited is checked on every receive
+        limited = self.limiter is not None and self.limiter.limits_download
+        if limited:
+            buffer = buffer[:self.RECV_QUANTUM]
         try:
-            return self.socket.recv(buffer_size)
+            recv_count = await asyncio.wait_for(self.loop.sock_recv_into(self.socket, buffer), timeout)
+        except asyncio.CancelledError:
+            raise  # an Exception before Python 3.8, the connection is still usable
         except Exception as e:
-            self.socket.close()
+            self.close("failed to read")
             raise PeerConnection.Exception("Failed to read from socket: {}".format(e))
+        finally:
+            self.receiving = False
+        if recv_count == 0:
+            raise PeerConnection.Exception("Connection closed by {}".format(self.peer))
+        self.last_received = self.loop.time()
+        self.framer.buffer_updated(recv_count)
+        if limited:
+            # charged once received, the next receive waits until the rate allows for these bytes
+            await self.limiter.take_download(recv_count)
 
-    def _read_missing_bytes(self, missing_count: int):
-        """tries reading `missing_count` bytes from socket"""
-        missing_bytes = b''
-        while len(missing_bytes) < missing_count:
-            recv_bytes = self._recv(missing_count)
-            self.logger.debug("Received {} bytes".format(len(recv_bytes)))
-            if recv_bytes == b'':
-                raise PeerConnection.Exception("Expected {} more bytes and did not receive them".format(
-                    missing_count))
-            missing_bytes += recv_bytes
-        self.response += missing_bytes
-
-    def _handle_response_length(self):
-        """validates length, updates idx, and receives any missing bytes"""
-        if self.idx + self.LENGTH_BYTES > len(self.response):
-            raise PeerMessage.Exception("Corrupt response: {}".format(self.response))
-        self.length = int.from_bytes(self.response[self.idx:self.idx + self.LENGTH_BYTES], byteorder="big")
-        self.idx += self.LENGTH_BYTES
-        if self.length + self.idx > len(self.response):
-            self.logger.debug("Message length ({}) is higher than current length in buffer ({})".format(
-                self.length, len(self.response) - self.idx
-            ))
-            self._read_missing_bytes(self.length + self.idx - len(self.response))
-
-    def _determine_message_type(self):
-        """messages factory-like method"""
-        if self.length == 0:
-            self.message = KeepAlive()
-        else:
-            # Messages that at least have an ID
-            id = self.response[self.idx]
-            payload = self.response[self.idx+self.MESSAGE_ID_BYTES:self.idx + self.length]
-            message_cls = id_to_message[id]
-            self.logger.debug("'{}' message".format(message_cls.__name__))
-            if message_cls in [Choke, UnChoke, Interested, NotInterested]:
-                # All messages with id only and no payload
-                if self.length != self.MESSAGE_ID_BYTES:
-                    raise PeerMessage.Exception("{} messages should be of length 1 ({})".format(
-                        type(message_cls).__name__, self.length
-                    ))
-                self.message = message_cls()
-            else:
-                self.message = message_cls.from_payload(payload)
+    async def _sendall(self, data: bytes):
+        await self.send_parts([data])
+
+    async def send_parts(self, parts: list):
+        """sends the parts one after the other, with no other message in between.
+        a part is bytes-like, or a (file, offset, count) tuple whose bytes are sent from the file with sendfile
+        """
+        self._check_open()
+        if self.limiter is not None and self.limiter.limits_upload:
+            await self.limiter.take_upload(sum(part[2] if isinstance(part, tuple) else len(part) for part in parts))
+        # corked, a short first part is not sent alone and held up by Nagle's algorithm until it is ACKed
+        cork = len(parts) > 1 and hasattr(socket, "TCP_CORK")
+        async with self.send_lock:
+            self.sending = True
+            try:
+                if cork:
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+                for part in parts:
+                    if isinstance(part, tuple):
+                        await self.loop.sock_sendfile(self.socket, *part)
+                    else:
+                        await self.loop.sock_sendall(self.socket, part)
+                if cork:
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.close("failed to send")
+                raise PeerConnection.Exception("Failed to send message to socket: {}".format(e))
+            finally:
+                self.sending = False
+        self.last_sent = self.loop.time()
 
-    def _parse_response(self) -> List[PeerMessage]:
+    async def send_control(self, message: bytes):
+        """sends a message regardless of choking, such as Choke, UnChoke or HavePiece"""
+        await self._sendall(message)
+
+    async def _parse_response(self, timeout: float = RECV_TIMEOUT) -> List[PeerMessage]:
         """returns list of messages objects
-        tries reading whole messages, but not everything from socket"""
-        self.response = self._recv(self.BUFFER_SIZE)
-        self.logger.debug("Parsing response")
+        reads from socket until at least one whole message was received,
+        returns all whole messages and keeps any partial message for the next call"""
         messages = []
-        self.idx = 0
-        while self.idx < len(self.response):
+        while not messages:
+            await self._recv(self.framer.missing, timeout)
             try:
-                self._handle_response_length()
-                self._determine_message_type()
-            except (PeerMessage.Exception, KeyError) as e:
-                self.logger.error("Failed to parse messages, dropping all read messages from buffer: {}".format(e))
-                return messages
-            messages.append(self.message)
-            self.idx += self.length
+                messages = self.framer.messages()
+            except MessageFramer.Exception as e:
+                self.close("corrupt messages stream")
+                raise PeerConnection.Exception("Corrupt messages stream from {}: {}".format(self.peer, e))
+        self.logger.debug("Parsed %d messages", len(messages))
         return messages
 
+    def _on_ignored(self, message: PeerMessage, block_messages: List[Block]):
+        self.logger.debug("Ignoring message of type %s - not supported", type(message).__name__)
+
+    def _on_choke(self, message: Choke, block_messages: List[Block]):
+        self.peer_choking = True
+
+    def _on_unchoke(self, message: UnChoke, block_messages: List[Block]):
+        self.peer_choking = False
+
+    def _on_interest(self, message: PeerMessage, block_messages: List[Block]):
+        self.peer_interested = type(message) is Interested
+        if self.uploader is not None:
+            self.uploader.on_interest(self)
+
+    def _on_request(self, message: RequestBlock, block_messages: List[Block]):
+        if self.uploader is None:
+            return self._on_ignored(message, block_messages)
+        self.uploader.on_request(self, message)
+
+    def _on_cancel(self, message: CancelRequest, block_messages: List[Block]):
+        if self.uploader is None:
+            return self._on_ignored(message, block_messages)
+        self.uploader.on_cancel(self, message)
+
+    def _on_pieces(self, message: PeerMessage, block_messages: List[Block]):
+        self._handle_pieces_message(message)
+
+    def _on_block(self, message: Block, block_messages: List[Block]):
+        self.downloaded += len(message.block)
+        block_messages.append(message)
+
+    HANDLERS = {
+        KeepAlive: _on_ignored,
+        Port: _on_ignored,
+        Choke: _on_choke,
+        UnChoke: _on_unchoke,
+        Interested: _on_interest,
+        NotInterested: _on_interest,
+        RequestBlock: _on_request,
+        CancelRequest: _on_cancel,
+        PiecesBitField: _on_pieces,
+        HavePiece: _on_pieces,
+        Block: _on_block,
+    }
+    """handler of every message type, dispatched by the exact type instead of a chain of isinstance checks"""
+
     def _handle_messages(self, messages: list) -> List[Block]:
         """changes state machine according to received messages
         and appends any Block messages to be handled by GetPiece class"""
         block_messages = []
         for message in messages:
-            self.logger.info("Handling {} message".format(message))
-            if isinstance(message, (KeepAlive, RequestBlock, CancelRequest, Port)):
-                self.logger.debug("Ignoring message of type {} - not supported".format(type(message).__name__))
-            elif isinstance(message, Choke):
-                self.peer_choking = True
-            elif isinstance(message, UnChoke):
-                self.peer_choking = False
-            elif isinstance(message, Interested):
-                self.peer_interested = True
-            elif isinstance(message, NotInterested):
-                self.peer_interested = False
-            elif isinstance(message, Block):
-                block_messages.append(message)
+            self.logger.debug("Handling %s message", message)
+            self.HANDLERS[type(message)](self, message, block_messages)
         return block_messages
 
-    def expect_blocks(self) -> List[Block]:
-        """returns a list of any received blocks"""
-        messages = self._parse_response()
+    def _handle_pieces_message(self, message: PeerMessage):
+        """updates the PiecePicker with pieces the peer has"""
+        if self.picker is None:
+            return
+        try:
+            if isinstance(message, PiecesBitField):
+                self.picker.add_peer(self.peer, message.bitfield)
+            else:
+                self.picker.add_peer_piece(self.peer, message.piece_index)
+        except PiecePicker.Exception as e:
+            self.close("invalid pieces information")
+            raise PeerConnection.Exception(e)
+
+    async def expect_blocks(self, timeout: float = RECV_TIMEOUT) -> List[Block]:
+        """returns a list of any received blocks
+        :param timeout: seconds to wait for the peer to send something, after which the connection is closed
+        """
+        messages = await self._parse_response(timeout)
         return self._handle_messages(messages)
 
-    def _wait_peer_unchoked(self):
+    async def _wait_peer_unchoked(self):
         """waits till peer can handle new requests"""
         for retry_count in range(6):
-            self.logger.info("Waiting for {} to send UnChoke message".format(self.peer))
-            self.expect_blocks()
+            self.logger.info("Waiting for %s to send UnChoke message", self.peer)
+            await self.expect_blocks()
             if not self.peer_choking:
                 return
         raise PeerConnection.Exception("Timeout of UnChoke message")
 
-    def _send_peer_interested(self):
+    async def _send_peer_interested(self):
         """notifies peer it will start sending requests"""
-        self.logger.info("Sending Interested message to {}".format(self.peer))
-        self.socket.send(Interested().create())
+        self.logger.info("Sending Interested message to %s", self.peer)
+        await self._sendall(Interested().create())
         self.am_interested = True
 
-    def send(self, message: bytes):
+    async def send(self, message: bytes):
         """wrapper of socket.send, applying BitTorrent specifications with `choking` and `interested` values"""
-        self.socket.send(self.keepalive_message)
         if not self.am_interested:
-            self._send_peer_interested()
+            await self._send_peer_interested()
         if self.peer_choking:
-            self._wait_peer_unchoked()
-        try:
-            self.socket.send(message)
-        except Exception as e:
-            self.socket.close()
-            raise PeerConnection.Exception("Failed to send message to socket: {}".format(e))
+            await self._wait_peer_unchoked()
+        await self._sendall(message)
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+from typing import Iterable, Optional
+from collections import deque, Counter
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.metrics import Metrics
+from torrentclient.peerinteract.peer import Peer
+from torrentclient.peerinteract.connection import PeerConnection
+from torrentclient.peerinteract.handshake import PeerHandshake
+
+
+class ConnectionLimits:
+    """Caps on the peer connections and half-open dials of all torrents of a session, shared by their Dialers.
+    A Dialer dials only while the caps allow, and all of them are woken when a dial ends or a connection closes,
+    in rotating order so no torrent gets the freed slots first every time."""
+
+    MAX_CONNECTIONS = 500
+    """number of open peer connections of all torrents, including spares and connections made by peers"""
+
+    MAX_HALF_OPEN = 100
+    """number of handshakes in progress of all torrents"""
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, max_half_open: int = MAX_HALF_OPEN):
+        self.max_connections = max_connections
+        self.max_half_open = max_half_open
+        self.connections = 0
+        self.half_open = 0
+        self.dialers = deque()  # Dialer of every torrent, woken when a slot is freed
+
+    def __str__(self):
+        return "ConnectionLimits(connections={}/{}, half_open={}/{})".format(
+            self.connections, self.max_connections, self.half_open, self.max_half_open)
+
+    def can_dial(self) -> bool:
+        return self.half_open < self.max_half_open and self.connections + self.half_open < self.max_connections
+
+    def can_accept(self) -> bool:
+        return self.connections + self.half_open < self.max_connections
+
+    def _notify(self):
+        self.dialers.rotate(1)
+        for dialer in self.dialers:
+            dialer._notify()
+
+    def handshake_started(self):
+        """must be called before the handshake task is created, so a burst of dials or peers can not exceed the caps"""
+        self.half_open += 1
+
+    def handshake_ended(self, connection: Optional[PeerConnection]):
+        """counts the connection of a successful handshake, dialed or accepted, until it is closed"""
+        self.half_open -= 1
+        if connection is not None and connection.closed_reason is None:
+            self.opened(connection)
+        self._notify()
+
+    def handshake_done(self, task: asyncio.Future):
+        """done callback of a handshake task returning its PeerConnection, or None if it failed.
+        the handshake ends even if the task was cancelled before it started"""
+        self.handshake_ended(None if task.cancelled() or task.exception() is not None else task.result())
+
+    def opened(self, connection: PeerConnection):
+        self.connections += 1
+        connection.on_close = self.closed
+
+    def closed(self, connection: PeerConnection):
+        self.connections -= 1
+        self._notify()
+
+
+class Dialer:
+    """Handshakes many peers concurrently and keeps a pool of spare handshaked PeerConnections,
+    so a worker which lost its peer gets another connection without waiting for a handshake.
+    A peer which failed, or was released without giving us any block, is connected to again after an exponential
+    backoff, and is dropped after MAX_FAILURES, so peers lacking the missing pieces are eventually given up."""
+
+    MAX_DIALS = 50
+    """number of handshakes in progress at the same time"""
+
+    WARM_CONNECTIONS = 8
+    """number of spare connections kept beyond the ones waited for"""
+
+    CONNECT_TIMEOUT = 3  # [seconds]
+
+    SPARE_MAX_AGE = 60  # [seconds]
+    """time after which a spare connection is assumed stale, its peer is dialed again instead"""
+
+    RETRY_DELAY = 10  # [seconds]
+    MAX_RETRY_DELAY = 10 * 60  # [seconds]
+    """a peer which failed n times is dialed again after RETRY_DELAY * 2 ** (n - 1), up to the max"""
+
+    MAX_FAILURES = 3
+    """number of failures, or connections giving no block, after which a peer is not connected to again"""
+
+    logger = logging.getLogger('dialer')
+
+    def __init__(self, torrent: MyTorrent, peers: Iterable[Peer] = (), metrics: Metrics = None,
+                 limits: ConnectionLimits = None):
+        """
+        :param torrent: MyTorrent whose peers are dialed
+        :param peers: peers to dial
+        :param metrics: Metrics the outcome and time of every handshake are counted in
+        :param limits: ConnectionLimits shared with the Dialers of other torrents, only MAX_DIALS applies if None
+        """
+        self.torrent = torrent
+        self.metrics = metrics
+        self.limits = limits
+        self.candidates = deque()
+        self.known_peers = set()
+        self.failures = Counter()
+        self.backing_off = set()
+        self.dialing = set()
+        self.spares = deque()  # (PeerConnection, time it was handshaked)
+        self.waiting = 0
+        self.more_peers = False  # whether peers may still be added, e.g. while trackers are announced to
+        self.changed = None
+        self.task = None
+        self.add_peers(peers)
+
+    def __str__(self):
+        return "Dialer(candidates={}, dialing={}, spares={}, backing_off={})".format(
+            len(self.candidates), len(self.dialing), len(self.spares), len(self.backing_off))
+
+    def __len__(self):
+        """number of peers which may still be connected to"""
+        return len(self.candidates) + len(self.dialing) + len(self.spares) + len(self.backing_off)
+
+    def _notify(self):
+        if self.changed is not None:
+            self.changed.set()
+
+    async def _wait_changed(self):
+        self.changed.clear()
+        await self.changed.wait()
+
+    def add_peers(self, peers: Iterable[Peer]) -> int:
+        """queues peers which were not seen before, returns their number"""
+        new_peers = [peer for peer in peers if peer not in self.known_peers]
+        self.known_peers.update(new_peers)
+        self.candidates.extend(new_peers)
+        if new_peers:
+            self._notify()
+        return len(new_peers)
+
+    def set_more_peers(self, more_peers: bool):
+        self.more_peers = more_peers
+        self._notify()
+
+    def _back_off(self, peer: Peer, failed: bool):
+        """dials the peer again later, the later the more times it failed"""
+        if failed:
+            self.failures[peer] += 1
+            if self.failures[peer] >= self.MAX_FAILURES:
+                self.logger.info("Dropping {} which failed {} times".format(peer, self.failures[peer]))
+                self._notify()
+                return
+        delay = min(self.RETRY_DELAY * 2 ** max(self.failures[peer] - 1, 0), self.MAX_RETRY_DELAY)
+        self.backing_off.add(peer)
+        asyncio.get_running_loop().call_later(delay, self._retry, peer)
+
+    def _retry(self, peer: Peer):
+        if peer in self.backing_off:
+            self.backing_off.discard(peer)
+            self.candidates.append(peer)
+            self._notify()
+
+    async def _dial(self, peer: Peer) -> Optional[PeerConnection]:
+        """returns the PeerConnection of a successful handshake, which is kept as a spare, None if it failed"""
+        hs = PeerHandshake(peer=peer, torrent=self.torrent, connect_timeout=self.CONNECT_TIMEOUT)
+        started = asyncio.get_running_loop().time()
+        connection = None
+        try:
+            connection = await hs.handshake()
+        except PeerHandshake.Exception as e:
+            hs.logger.error(e)
+            if self.metrics is not None:
+                self.metrics.inc("handshakes_total", result="failure")
+            self._back_off(peer, failed=True)
+        else:
+            hs.logger.info("Connected to {}!".format(peer))
+            if self.metrics is not None:
+                self.metrics.inc("handshakes_total", result="success")
+                self.metrics.observe("handshake_seconds", asyncio.get_running_loop().time() - started)
+            self.spares.append((connection, asyncio.get_running_loop().time()))
+        finally:
+            self.dialing.discard(peer)
+            self._notify()
+        return connection
+
+    async def _dial_peers(self):
+        """keeps dialing candidates while connections are wanted, up to MAX_DIALS at a time"""
+        tasks = set()
+        try:
+            while True:
+                while self.candidates and len(self.dialing) < self.MAX_DIALS and \
+                        len(self.spares) + len(self.dialing) < self.waiting + self.WARM_CONNECTIONS and \
+                        (self.limits is None or self.limits.can_dial()):
+                    peer = self.candidates.popleft()
+                    self.dialing.add(peer)
+                    if self.limits is not None:
+                        self.limits.handshake_started()
+                    task = asyncio.ensure_future(self._dial(peer))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    if self.limits is not None:
+                        task.add_done_callback(self.limits.handshake_done)
+                await self._wait_changed()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start(self):
+        """starts dialing in the running event loop"""
+        self.changed = asyncio.Event()
+        if self.limits is not None:
+            self.limits.dialers.append(self)
+        self.task = asyncio.ensure_future(self._dial_peers())
+
+    async def wait_starving(self, workers: int):
+        """waits until every worker waits for a connection while no peers are left to dial,
+        e.g. the cached peers all failed. peers backing off are not counted, they failed before
+        :param workers: number of workers getting connections
+        """
+        while self.waiting < workers or self.spares or self.candidates or self.dialing:
+            await self._wait_changed()
+
+    def _exhausted(self) -> bool:
+        return not (self.spares or self.candidates or self.dialing or self.backing_off or self.more_peers)
+
+    async def get(self) -> Optional[PeerConnection]:
+        """returns a handshaked PeerConnection, waiting for one if there are no spares.
+        returns None if no peers are left to connect to"""
+        loop = asyncio.get_running_loop()
+        self.waiting += 1
+        self._notify()
+        try:
+            while True:
+                while self.spares:
+                    connection, connected_at = self.spares.popleft()
+                    if connection.closed_reason is None and loop.time() - connected_at < self.SPARE_MAX_AGE:
+                        self._notify()  # a spare was taken, another one may be dialed
+                        return connection
+                    connection.close()
+                    self.candidates.append(connection.peer)
+                if self._exhausted():
+                    return None
+                await self._wait_changed()
+        finally:
+            self.waiting -= 1
+
+    def release(self, connection: PeerConnection, failed: bool):
+        """closes the connection, the peer is dialed again after a backoff unless it failed too often.
+        a connection which gave no block counts as a failure, even when the peer just had no wanted pieces"""
+        connection.close()
+        self._back_off(connection.peer, failed or connection.downloaded == 0)
+
+    async def close(self):
+        """stops dialing and closes the spare connections"""
+        if self.limits is not None and self in self.limits.dialers:
+            self.limits.dialers.remove(self)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        while self.spares:
+            connection, _ = self.spares.popleft()
+            connection.close()
+        self.backing_off.clear()
@@ -1,113 +1,237 @@
+import math
+import time
+import asyncio
 import logging
-from retry import retry
+from typing import List, Optional
+from collections import deque
+from concurrent.futures import Executor
 
 from torrentclient.peerinteract.connection import PeerConnection
+from torrentclient.peercode.allmessages import RequestBlock, Block, CancelRequest
 from torrentclient.mytorrent import MyTorrent
 
 
+class PieceProgress:
+    """Blocks of a piece received so far, shared by the GetPiece of every peer the piece is requested from.
+    In endgame mode the missing blocks of a piece are requested from several peers,
+    the first copy of a block is kept and the duplicate requests are cancelled."""
+
+    def __init__(self, torrent: MyTorrent, piece_idx: int):
+        self.piece_idx = piece_idx
+        self.blocks = torrent.blocks(piece_idx)
+        self.piece = bytearray(torrent.meta.piece_size(piece_idx))
+        self.received = set()  # begin of every received block
+        self.getters = set()  # GetPiece of every peer the piece is being requested from
+        self.duplicate_bytes = 0
+
+    def __str__(self):
+        return "PieceProgress(piece_idx={}, received={}/{}, getters={})".format(
+            self.piece_idx, len(self.received), len(self.blocks), len(self.getters))
+
+    @property
+    def complete(self) -> bool:
+        return len(self.received) == len(self.blocks)
+
+    def missing_blocks(self) -> List[tuple]:
+        return [(block_begin, block_length) for block_begin, block_length in self.blocks
+                if block_begin not in self.received]
+
+
 class GetPiece:
     """Class for getting a torrent piece using a peer connection"""
 
+    PIPELINE_DEPTH = 5
+    """default number of RequestBlock messages kept outstanding on the connection"""
+
+    MIN_PIPELINE_DEPTH = 2
+    MAX_PIPELINE_DEPTH = 64
+
+    PIPELINE_QUEUE_TIME = 2  # [seconds]
+    """with adaptive depth, enough blocks are requested to keep the peer busy for this long"""
+
+    MAX_IDLE_READS = 20
+    """number of consecutive reads without any requested Block before giving up the piece"""
+
     logger = logging.getLogger('get-piece')
 
     class Exception(Exception):
         """An exception with getting a piece from peer"""
 
-    def __init__(self, peer_connection: PeerConnection, torrent: MyTorrent, piece_idx: int):
+    class HashException(Exception):
+        """The obtained piece does not match its hash"""
+
+    def __init__(self, peer_connection: PeerConnection, torrent: MyTorrent, piece_idx: int,
+                 pipeline_depth: int = PIPELINE_DEPTH, adaptive: bool = False, hash_executor: Executor = None,
+                 progress: PieceProgress = None):
         """
         :param peer_connection: PeerConnection to obtain piece with
         :param torrent: MyTorrent containing block and pieces information
         :param piece_idx: zero-based index of a piece
+        :param pipeline_depth: number of outstanding block requests,
+            with `adaptive` it is updated according to the measured throughput of the peer
+        :param adaptive: whether to adapt `pipeline_depth`
+        :param hash_executor: executor validating the piece hash off the event loop, None for the loop's default
+        :param progress: PieceProgress shared with the GetPiece of other peers in endgame mode, a new one if None
         """
         self.peer_connection = peer_connection
         self.torrent = torrent
         self.piece_idx = piece_idx
-        self.piece = b''
-
-    def _request_block(self, block_idx: int):
-        """tries requesting block of index `block_idx`"""
-        from torrentclient.peercode.allmessages import RequestBlock
-        self.block_begin = block_idx * self.torrent.block_size
-        request = RequestBlock(
-            piece_index=self.piece_idx,
-            block_begin=self.block_begin,
-            block_length=self.torrent.block_size
-        ).create()
-        self.logger.debug("request={}".format(request))
-        self.peer_connection.send(request)
-        self.logger.info("Waiting for {} to send Block message of block index #{}".format(
-            self.peer_connection.peer, block_idx))
-        self.received_blocks = self.peer_connection.expect_blocks()
-
-    def _validate_block(self, is_last_block: bool):
-        if not self.received_blocks:
-            raise GetPiece.Exception("No Blocks received")
-        if len(self.received_blocks) > 1:
-            raise GetPiece.Exception("Received more than one Block: {}".format(self.received_blocks))
-        recv_message = self.received_blocks[0]
-        if recv_message.piece_index != self.piece_idx:
-            raise GetPiece.Exception("Got Block of different piece ({}) - requested piece #{}".format(
-                recv_message.piece_index,
-                self.piece_idx,
-            ))
-        if recv_message.block_begin != self.block_begin:
-            raise GetPiece.Exception("Wrong Block begin value ({}) - requested {}".format(
-                recv_message.block_begin,
-                self.block_begin,
-            ))
-        if len(recv_message.block) < self.torrent.block_size and not is_last_block:
-            raise GetPiece.Exception("Did not get all of block #{} ({}): {}}".format(
-                self.piece_idx,
-                self.torrent.block_size,
-                recv_message.payload,
-            ))
-        return recv_message.block
+        self.pipeline_depth = pipeline_depth
+        self.adaptive = adaptive
+        self.hash_executor = hash_executor
+        self.progress = progress if progress is not None else PieceProgress(torrent, piece_idx)
+        self.piece = self.progress.piece
+        self.outstanding = {}  # (piece_index, block_begin) -> block_length
+        self.cancels = []  # (block_begin, block_length) of requests to cancel, another peer sent them first
+        self.recv_task = None
+        self.interrupted = False
+
+    async def _request_blocks(self, blocks: List[tuple]):
+        """sends all RequestBlock messages of `blocks` at once"""
+        for block_begin, block_length in blocks:
+            self.outstanding[(self.piece_idx, block_begin)] = block_length
+        self.logger.debug("Requesting %d blocks of piece #%d from %s", len(blocks), self.piece_idx,
+                          self.peer_connection.peer)
+        await self.peer_connection.send(RequestBlock.create_many(self.piece_idx, blocks))
+
+    async def _fill_pipeline(self):
+        """tops up outstanding requests to the pipeline depth, skipping blocks another peer already sent"""
+        blocks = []
+        while self.pending and len(self.outstanding) + len(blocks) < self.pipeline_depth:
+            block = self.pending.popleft()
+            if block[0] not in self.progress.received:
+                blocks.append(block)
+        if blocks:
+            await self._request_blocks(blocks)
+
+    async def _send_cancels(self):
+        """sends CancelRequest messages of blocks another peer sent first,
+        a choking peer already discarded all requests"""
+        if self.cancels and not self.peer_connection.peer_choking:
+            self.logger.debug("Cancelling %d requests of piece #%d from %s", len(self.cancels), self.piece_idx,
+                              self.peer_connection.peer)
+            await self.peer_connection.send(CancelRequest.create_many(self.piece_idx, self.cancels))
+        self.cancels.clear()
+
+    def _cancel_block(self, block_begin: int):
+        """another peer sent the block, cancels its request from this peer"""
+        block_length = self.outstanding.pop((self.piece_idx, block_begin), None)
+        if block_length is not None:
+            self.cancels.append((block_begin, block_length))
+
+    def _interrupt(self):
+        """stops getting the piece which another peer completed"""
+        self.interrupted = True
+        if self.recv_task is not None:
+            self.recv_task.cancel()
+
+    def _store_blocks(self, blocks: List[Block]) -> int:
+        """copies blocks matching outstanding requests into the piece, in any order
+        returns number of bytes stored"""
+        stored = 0
+        for block in blocks:
+            block_length = self.outstanding.pop((block.piece_index, block.block_begin), None)
+            if block_length is None:
+                self.logger.debug("Ignoring %s - was not requested", block)
+                continue
+            if len(block.block) != block_length:
+                raise GetPiece.Exception("{} has {} bytes - requested {}".format(
+                    block, len(block.block), block_length))
+            if block.block_begin in self.progress.received:
+                self.progress.duplicate_bytes += block_length
+                continue
+            self.piece[block.block_begin:block.block_begin + block_length] = block.block
+            self.progress.received.add(block.block_begin)
+            for getter in self.progress.getters:
+                if getter is not self:
+                    getter._cancel_block(block.block_begin)
+            stored += block_length
+        return stored
 
-    @retry(Exception, tries=3)
-    def _get_block(self, block_idx: int, is_last_block=False):
+    async def _expect_blocks(self) -> Optional[List[Block]]:
+        """returns received blocks, None if interrupted because another peer completed the piece"""
+        if self.interrupted:
+            return None
+        self.recv_task = asyncio.ensure_future(self.peer_connection.expect_blocks())
         try:
-            self._request_block(block_idx)
-        except (PeerConnection.Exception, Exception) as e:
-            if self._is_last_piece and block_idx != 0:
-                self.logger.debug("Skipping block #{}".format(block_idx))
-                return b''  # last blocks would be missing
-            else:
-                raise e
-        return self._validate_block(is_last_block)
+            return await self.recv_task
+        except asyncio.CancelledError:
+            if not self.interrupted:
+                raise
+            return None
+        finally:
+            self.recv_task = None
+
+    def _requeue_outstanding(self):
+        """a choking peer discards all requests, they are requested again once un-choked"""
+        self.logger.debug("%s choked, re-queueing %d requests", self.peer_connection.peer, len(self.outstanding))
+        for (_, block_begin), block_length in sorted(self.outstanding.items(), reverse=True):
+            self.pending.appendleft((block_begin, block_length))
+        self.outstanding.clear()
+
+    def _adapt_depth(self):
+        """sets pipeline depth to the number of blocks the peer delivers in PIPELINE_QUEUE_TIME"""
+        elapsed = time.monotonic() - self.started
+        if elapsed <= 0:
+            return
+        rate = self.received / elapsed  # [bytes/second]
+        depth = math.ceil(rate * self.PIPELINE_QUEUE_TIME / self.torrent.block_size)
+        self.pipeline_depth = max(self.MIN_PIPELINE_DEPTH, min(self.MAX_PIPELINE_DEPTH, depth))
 
     def _validate_hash(self):
         import hashlib
-        if hashlib.sha1(self.piece).digest() != self.torrent.hashes[self.piece_idx]:
-            raise GetPiece.Exception("Invalid SHA-1 hash of piece #{}: {}\nExpected: {}".format(
+        digest = hashlib.sha1(self.piece).digest()
+        expected = self.torrent.hashes[self.piece_idx]
+        if digest != expected:
+            raise GetPiece.HashException("Invalid SHA-1 hash of piece #{}: {}\nExpected: {}".format(
                 self.piece_idx,
-                hashlib.sha1(self.piece).digest(),
-                self.torrent.hashes[self.piece_idx],
+                digest,
+                bytes(expected),
             ))
 
-    @property
-    def _is_last_piece(self) -> bool:
-        """returns whether this is the last hashed piece"""
-        return self.piece_idx == self.torrent.piece_count-1
+    async def _get_blocks(self):
+        """requests the missing blocks until the piece is complete or another peer completed it"""
+        idle_reads = 0
+        while not self.progress.complete and not self.interrupted:
+            await self._send_cancels()
+            await self._fill_pipeline()
+            if not self.outstanding and not self.pending:
+                return  # the missing blocks are outstanding with other peers
+            blocks = await self._expect_blocks()
+            if blocks is None:
+                return
+            stored = self._store_blocks(blocks)
+            if self.peer_connection.peer_choking and self.outstanding:
+                self._requeue_outstanding()
+            if stored:
+                idle_reads = 0
+                self.received += stored
+                if self.adaptive:
+                    self._adapt_depth()
+            else:
+                idle_reads += 1
+                if idle_reads > self.MAX_IDLE_READS:
+                    raise GetPiece.Exception("No requested Blocks received in {} reads".format(idle_reads))
 
-    @property
-    def _last_block_idx(self) -> int:
-        """returns last block index inside piece"""
-        return self.torrent.block_count - 1
-
-    def _is_last_block_idx(self, block_idx) -> bool:
-        """returns whether `block_idx` of this piece is the last block of the torrent"""
-        return self._is_last_piece and block_idx == self._last_block_idx
-
-    @retry(Exception, tries=3)
-    def get(self) -> bytes:
-        self.logger.info("Trying to get {} blocks from piece #{}".format(self.torrent.block_count, self.piece_idx))
-        for block_idx in range(0, self.torrent.block_count):
-            received_block = self._get_block(block_idx=block_idx, is_last_block=self._is_last_block_idx(block_idx))
-            if received_block == b'':  # no more blocks to receive
-                break
-            self.piece += received_block
-        if not self._is_last_piece:
-            # No idea why the last piece hash is incorrect, but it won't work otherwise
-            # TODO: fix this - probably append zeros?
-            self._validate_hash()
+    async def get(self) -> Optional[bytearray]:
+        """returns the piece once its hash was validated,
+        None if another peer completed it, its GetPiece returns the piece"""
+        self.pending = deque(self.progress.missing_blocks())
+        self.received = 0
+        self.started = time.monotonic()
+        self.logger.debug("Trying to get %d blocks from piece #%d", len(self.pending), self.piece_idx)
+        self.progress.getters.add(self)
+        try:
+            await self._get_blocks()
+        finally:
+            self.progress.getters.discard(self)
+        if not self.progress.complete or self.interrupted:
+            for (_, block_begin) in list(self.outstanding):
+                self._cancel_block(block_begin)
+            await self._send_cancels()
+            return None
+        for getter in self.progress.getters:  # completed by this peer
+            getter._interrupt()
+        self.progress.getters.clear()
+        await asyncio.get_running_loop().run_in_executor(self.hash_executor, self._validate_hash)
         return self.piece
@@ -1,16 +1,15 @@
 import socket
+import asyncio
 import logging
 
 from torrentclient.mytorrent import MyTorrent
 from torrentclient.peerinteract.peer import Peer
-from torrentclient.peerinteract.connections import PeerConnection
-
-
-socket.setdefaulttimeout(30)
+from torrentclient.peerinteract.connection import PeerConnection
 
 
 class PeerHandshake:
-    """Class for establishing a connection with a remote Peer"""
+    """Class for establishing a connection with a remote Peer,
+    over a non-blocking socket driven by the running asyncio event loop"""
 
     PSTR = bytes("BitTorrent protocol", "utf-8")
     PSTR_LEN = bytes([len(PSTR)])
@@ -19,14 +18,22 @@ class PeerHandshake:
     PSTR_LEN_BYTE = 0
     PSTR_BYTE = 1
 
+    CONNECT_TIMEOUT = 10  # [seconds]
+    RESPONSE_TIMEOUT = 10  # [seconds]
+
     logger = logging.getLogger('peer-handshake')
 
     class Exception(Exception):
         """An exception with peer handshake"""
 
-    def __init__(self, peer: Peer, torrent: MyTorrent):
+    def __init__(self, peer: Peer, torrent: MyTorrent, connect_timeout: float = CONNECT_TIMEOUT):
+        """
+        :param connect_timeout: seconds to wait for the TCP connection to be established
+        """
         self.peer = peer
         self.torrent = torrent
+        self.connect_timeout = connect_timeout
+        self.socket = None
 
     def __str__(self):
         return "PeerHandshake(peer={}, torrent={})".format(self.peer, self.torrent)
@@ -34,19 +41,34 @@ class PeerHandshake:
     def _create_message(self):
         self.request = self.PSTR_LEN + self.PSTR + self.RESERVED + self.torrent.infohash + Peer.LOCAL_PEER_ID
 
-    def _send_message(self):
-        self.logger.debug("Trying to send initial handshake to {}".format(self.peer))
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    async def _send_message(self):
+        self.logger.debug("Trying to send initial handshake to %s", self.peer)
+        loop = asyncio.get_running_loop()
+        self.socket = socket.socket(self.peer.family, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
         try:
-            self.socket.connect((self.peer.ip_address, self.peer.port))
+            await asyncio.wait_for(
+                loop.sock_connect(self.socket, (self.peer.ip_address, self.peer.port)), self.connect_timeout)
         except Exception as e:
             raise PeerHandshake.Exception("Could not connect to {}: {}".format(self.peer, e))
         try:
-            self.socket.send(self.request)
+            await loop.sock_sendall(self.socket, self.request)
         except Exception as e:
             self.socket.close()
             raise PeerHandshake.Exception("Could not send message to {}: {}".format(self.peer, e))
 
+    async def _recv_response(self, received: bytes = b''):
+        """reads the peer's handshake, which is as long as ours
+        :param received: beginning of the handshake which was already read from the socket
+        """
+        loop = asyncio.get_running_loop()
+        self.peer_response = received
+        while len(self.peer_response) < len(self.request):
+            recv_bytes = await loop.sock_recv(self.socket, len(self.request) - len(self.peer_response))
+            if recv_bytes == b'':
+                break
+            self.peer_response += recv_bytes
+
     @property
     def RESERVED_BYTE(self) -> int:
         return self.PSTR_BYTE + self.response_pstrlen
@@ -86,25 +108,52 @@ class PeerHandshake:
 
     def _validate_peer_id(self):
         self.peer.peer_id = self.peer_response[self.PEER_ID_BYTE:]
+        if self.peer.peer_id == Peer.LOCAL_PEER_ID:
+            raise PeerHandshake.Exception("{} is this client".format(self.peer))
         if len(self.peer.peer_id) != 20:
             self.logger.warning("peer_id ({}) length {}".format(self.peer.peer_id, len(self.peer.peer_id)))
 
-    def _validate_response(self):
+    async def _validate_response(self, received: bytes = b''):
         """raises an exception if the received handshake is not as expected"""
         self.logger.debug("Validating response handshake")
-        self.peer_response = self.socket.recv(len(self.request))
+        await asyncio.wait_for(self._recv_response(received), self.RESPONSE_TIMEOUT)
         self._validate_length()
         self._validate_protocol()
         self._validate_reserved()
         self._validate_info_hash()
         self._validate_peer_id()
 
-    def handshake(self) -> PeerConnection:
+    async def handshake(self) -> PeerConnection:
         """returns PeerConnection if handshake was successful"""
         try:
             self._create_message()
-            self._send_message()
-            self._validate_response()
+            await self._send_message()
+            await self._validate_response()
+        except asyncio.CancelledError:
+            if self.socket is not None:
+                self.socket.close()
+            raise
+        except Exception as e:
+            if self.socket is not None:
+                self.socket.close()
+            raise PeerHandshake.Exception(e)
+        else:
+            return PeerConnection(peer=self.peer, socket=self.socket)
+
+    async def accept(self, socket, received: bytes = b'') -> PeerConnection:
+        """returns PeerConnection if the handshake of a peer which connected to us was successful,
+        our handshake is sent after the peer's was validated
+        :param socket: non-blocking socket accepted from the listening socket
+        :param received: beginning of the peer's handshake which was already read, e.g. to find its info hash
+        """
+        self.socket = socket
+        try:
+            self._create_message()
+            await self._validate_response(received)
+            await asyncio.get_running_loop().sock_sendall(self.socket, self.request)
+        except asyncio.CancelledError:
+            self.socket.close()
+            raise
         except Exception as e:
             self.socket.close()
             raise PeerHandshake.Exception(e)
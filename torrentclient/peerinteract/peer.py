@@ -6,10 +6,19 @@ from torf import Torrent
 
 
 class Peer:
-    """Data class of BitTorrent remote peer"""
+    """Data class of BitTorrent remote peer.
+    A peer is its packed compact address - 4 bytes of IPv4 or 16 bytes of IPv6 address and 2 bytes of port,
+    as trackers send it, so hundreds of thousands of peers take little memory and are compared by their bytes.
+    The IP address string and port are decoded only when they are used."""
+
+    __slots__ = ('address', 'peer_id')
 
     LOCAL_PEER_ID = bytes("-{}{}-{}".format('SG', '1000', str(os.getpid()).zfill(12)), "utf-8")
 
+    PORT_LENGTH = 2  # [bytes]
+    IPV4_LENGTH = 4 + PORT_LENGTH  # [bytes]
+    IPV6_LENGTH = 16 + PORT_LENGTH  # [bytes]
+
     logger = logging.getLogger('peer')
 
     class Exception(Exception):
@@ -17,29 +26,50 @@ class Peer:
 
     def __init__(self, ip_address: str, port: int):
         """
-        :param ip_address: IPv4 address str
+        :param ip_address: IPv4 or IPv6 address str
         :param port: port number
         """
-        import socket
         try:
-            socket.inet_aton(ip_address)
-        except socket.error as e:
+            packed_ip = socket.inet_pton(socket.AF_INET6 if ":" in ip_address else socket.AF_INET, ip_address)
+        except (OSError, TypeError) as e:
             raise Peer.Exception("Invalid IP address ({}): {}".format(ip_address, e))
-        self.ip_address = ip_address
         try:
-            self.port = int(port)
+            packed_port = int(port).to_bytes(self.PORT_LENGTH, byteorder="big")
         except TypeError:
             raise Peer.Exception("Invalid port type ({}) - should be convertible to int".format(type(port).__name__))
-        self.id = None  # determined in PeerHandshake response
+        except (ValueError, OverflowError):
+            raise Peer.Exception("Invalid port ({})".format(port))
+        self.address = packed_ip + packed_port
+        self.peer_id = None  # determined in PeerHandshake response
+
+    @classmethod
+    def from_address(cls, address: bytes) -> 'Peer':
+        """returns the peer of a compact address, which must be IPV4_LENGTH or IPV6_LENGTH bytes"""
+        peer = cls.__new__(cls)
+        peer.address = address
+        peer.peer_id = None
+        return peer
+
+    @property
+    def family(self) -> int:
+        """socket address family of the peer"""
+        return socket.AF_INET6 if len(self.address) == self.IPV6_LENGTH else socket.AF_INET
+
+    @property
+    def ip_address(self) -> str:
+        return socket.inet_ntop(self.family, self.address[:-self.PORT_LENGTH])
+
+    @property
+    def port(self) -> int:
+        return int.from_bytes(self.address[-self.PORT_LENGTH:], byteorder="big")
 
     def __eq__(self, other):
-        return isinstance(other, Peer) and self.ip_address == other.ip_address and self.port == other.port
+        return isinstance(other, Peer) and self.address == other.address
 
     def __hash__(self):
-        return hash((
-            'ip_address', self.ip_address,
-            'port', self.port,
-        ))
+        return hash(self.address)
 
     def __str__(self):
+        if self.family == socket.AF_INET6:
+            return "Peer([{}]:{})".format(self.ip_address, self.port)
         return "Peer({}:{})".format(self.ip_address, self.port)
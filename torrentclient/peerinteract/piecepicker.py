@@ -0,0 +1,173 @@
+import random
+import logging
+from array import array
+from typing import Optional
+
+from torrentclient.peerinteract.peer import Peer
+
+
+SET_BITS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
+"""offsets of set bits in each byte value, high bit first"""
+
+
+class PiecePicker:
+    """Chooses the next piece to get from a peer: the rarest in the swarm among the pieces the peer has.
+    Availability is counted from peers' PiecesBitField and HavePiece messages.
+    Wanted pieces are kept in buckets by availability, so picking does not scan all pieces,
+    and seeds (peers having all pieces) are counted once instead of per piece."""
+
+    logger = logging.getLogger('piece-picker')
+
+    class Exception(Exception):
+        """An exception with pieces information of a peer occurred"""
+
+    def __init__(self, piece_count: int):
+        """
+        :param piece_count: number of pieces in the torrent, all of them are wanted
+        """
+        self.piece_count = piece_count
+        self.bitfield_length = -(-piece_count // 8)
+        self.availability = array('I', [0]) * piece_count  # number of non-seed peers having each piece
+        self.seeds = set()
+        self.peer_pieces = {}  # Peer -> bitfield, of non-seed peers
+        self.peer_counts = {}  # Peer -> number of pieces set in its bitfield, a peer having all of them is a seed
+        self.wanted = bytearray(b'\x01') * piece_count
+        self.buckets = [list(range(piece_count))]  # availability -> wanted pieces
+        self.position = array('I', range(piece_count))  # index of each wanted piece inside its bucket
+        self.in_progress = set()
+
+    def __str__(self):
+        return "PiecePicker(wanted={}, in_progress={}, peers={})".format(
+            self.wanted_count, len(self.in_progress), len(self.peer_pieces) + len(self.seeds))
+
+    @property
+    def wanted_count(self) -> int:
+        """number of pieces which are neither obtained nor in progress"""
+        return sum(len(bucket) for bucket in self.buckets)
+
+    @staticmethod
+    def _has(bitfield: bytearray, piece_idx: int) -> bool:
+        return bool(bitfield[piece_idx >> 3] & (0x80 >> (piece_idx & 7)))
+
+    def _bucket_remove(self, piece_idx: int):
+        bucket = self.buckets[self.availability[piece_idx]]
+        last = bucket.pop()
+        if last != piece_idx:
+            position = self.position[piece_idx]
+            bucket[position] = last
+            self.position[last] = position
+
+    def _bucket_add(self, piece_idx: int):
+        level = self.availability[piece_idx]
+        while len(self.buckets) <= level:
+            self.buckets.append([])
+        self.position[piece_idx] = len(self.buckets[level])
+        self.buckets[level].append(piece_idx)
+
+    def _change_availability(self, piece_idx: int, delta: int):
+        if self.wanted[piece_idx]:
+            self._bucket_remove(piece_idx)
+        self.availability[piece_idx] += delta
+        if self.wanted[piece_idx]:
+            self._bucket_add(piece_idx)
+
+    def _change_bitfield_availability(self, bitfield: bytes, delta: int):
+        change_availability = self._change_availability
+        for byte_idx, byte in enumerate(bitfield):
+            if byte:
+                first_piece = byte_idx << 3
+                for bit in SET_BITS[byte]:
+                    change_availability(first_piece + bit, delta)
+
+    def _validate_bitfield(self, peer: Peer, bitfield: bytes):
+        if len(bitfield) != self.bitfield_length:
+            raise PiecePicker.Exception("{} sent bitfield of {} bytes, should be {}".format(
+                peer, len(bitfield), self.bitfield_length))
+        spare_bits = self.bitfield_length * 8 - self.piece_count
+        if spare_bits and bitfield[-1] & ((1 << spare_bits) - 1):
+            raise PiecePicker.Exception("{} sent bitfield with spare bits set".format(peer))
+
+    def add_peer(self, peer: Peer, bitfield: bytes):
+        """counts pieces of `peer` from its PiecesBitField message"""
+        self._validate_bitfield(peer, bitfield)
+        self.remove_peer(peer)
+        count = bin(int.from_bytes(bitfield, byteorder="big")).count("1")
+        if count == self.piece_count:
+            self.seeds.add(peer)
+            return
+        self.peer_pieces[peer] = bytearray(bitfield)
+        self.peer_counts[peer] = count
+        self._change_bitfield_availability(bitfield, 1)
+
+    def add_peer_piece(self, peer: Peer, piece_idx: int):
+        """counts a single piece of `peer` from its HavePiece message"""
+        if not 0 <= piece_idx < self.piece_count:
+            raise PiecePicker.Exception("{} has piece #{} out of {} pieces".format(peer, piece_idx, self.piece_count))
+        if peer in self.seeds:
+            return
+        bitfield = self.peer_pieces.get(peer)
+        if bitfield is None:
+            bitfield = self.peer_pieces[peer] = bytearray(self.bitfield_length)
+            self.peer_counts[peer] = 0
+        if self._has(bitfield, piece_idx):
+            return
+        bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+        self._change_availability(piece_idx, 1)
+        self.peer_counts[peer] += 1
+        if self.peer_counts[peer] == self.piece_count:
+            self.remove_peer(peer)
+            self.seeds.add(peer)
+
+    def remove_peer(self, peer: Peer):
+        """stops counting pieces of a disconnected peer"""
+        self.seeds.discard(peer)
+        self.peer_counts.pop(peer, None)
+        bitfield = self.peer_pieces.pop(peer, None)
+        if bitfield is None:
+            return
+        self._change_bitfield_availability(bitfield, -1)
+
+    def has_piece(self, peer: Peer, piece_idx: int) -> bool:
+        if peer in self.seeds:
+            return True
+        bitfield = self.peer_pieces.get(peer)
+        return bitfield is not None and self._has(bitfield, piece_idx)
+
+    def pick(self, peer: Peer) -> Optional[int]:
+        """returns the rarest wanted piece `peer` has, ties are broken randomly,
+        the piece is in progress until it is either `complete`d or `abort`ed.
+        returns None if `peer` has no wanted pieces"""
+        is_seed = peer in self.seeds
+        bitfield = self.peer_pieces.get(peer)
+        if not is_seed and bitfield is None:
+            return None
+        # without seeds, pieces of availability 0 are not owned by anyone
+        for bucket in self.buckets[0 if is_seed else 1:]:
+            if not bucket:
+                continue
+            start = random.randrange(len(bucket))
+            for offset in range(len(bucket)):
+                piece_idx = bucket[(start + offset) % len(bucket)]
+                if is_seed or self._has(bitfield, piece_idx):
+                    self._bucket_remove(piece_idx)
+                    self.wanted[piece_idx] = 0
+                    self.in_progress.add(piece_idx)
+                    return piece_idx
+        return None
+
+    def mark_obtained(self, piece_idx: int):
+        """marks a piece which was obtained before, without picking it"""
+        if self.wanted[piece_idx]:
+            self._bucket_remove(piece_idx)
+            self.wanted[piece_idx] = 0
+
+    def complete(self, piece_idx: int):
+        """marks a picked piece as obtained"""
+        self.in_progress.discard(piece_idx)
+
+    def abort(self, piece_idx: int):
+        """a picked piece was not obtained, it is wanted again"""
+        self.in_progress.discard(piece_idx)
+        if not self.wanted[piece_idx]:
+            self.wanted[piece_idx] = 1
+            self._bucket_add(piece_idx)
@@ -0,0 +1,167 @@
+import time
+import asyncio
+import logging
+import weakref
+from typing import Optional
+from collections import deque
+
+
+class TokenBucket:
+    """Limits a byte rate, every transfer takes tokens for its bytes and the tokens refill at `rate`.
+    Transfers waiting for tokens are served in the order they asked, by a timer set for when the first can go,
+    so connections asking for bounded amounts each get an even share of the rate."""
+
+    BURST_TIME = 0.5  # [seconds]
+    """the bucket holds the tokens of BURST_TIME at most, so an idle connection can not save up for a spike"""
+
+    MIN_BURST = 2 ** 15  # [bytes]
+
+    def __init__(self, rate: Optional[float] = None):
+        """
+        :param rate: bytes per second, unlimited if None
+        """
+        self.rate = rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiters = deque()  # (byte count, Future) in the order they asked
+        self.timer = None
+        self.loop = None
+
+    def __str__(self):
+        return "TokenBucket(rate={}, tokens={:.0f}, waiters={})".format(self.rate, self.tokens, len(self.waiters))
+
+    @property
+    def capacity(self) -> float:
+        return max(self.rate * self.BURST_TIME, self.MIN_BURST) if self.rate is not None else 0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _can_take(self, count: int) -> bool:
+        # a transfer larger than the bucket goes once it is full, leaving the bucket in debt
+        return self.rate is None or self.tokens >= min(count, self.capacity)
+
+    async def take(self, count: int):
+        """waits until `count` bytes may be transferred"""
+        if self.rate is None:
+            return
+        self._refill()
+        if not self.waiters and self._can_take(count):
+            self.tokens -= count
+            return
+        self.loop = asyncio.get_running_loop()
+        future = self.loop.create_future()
+        self.waiters.append((count, future))
+        self._schedule()
+        await future
+
+    def _drain(self):
+        """lets waiting transfers go in order while there are tokens for them"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self._refill()
+        while self.waiters:
+            count, future = self.waiters[0]
+            if future.done():  # the transfer was cancelled
+                self.waiters.popleft()
+            elif self._can_take(count):
+                self.waiters.popleft()
+                if self.rate is not None:
+                    self.tokens -= count
+                future.set_result(None)
+            else:
+                break
+        self._schedule()
+
+    def _schedule(self):
+        if self.timer is None and self.waiters:
+            count = min(self.waiters[0][0], self.capacity)
+            self.timer = self.loop.call_later(max((count - self.tokens) / self.rate, 0), self._drain)
+
+    def set_rate(self, rate: Optional[float]):
+        """changes the rate, effective for waiting transfers too. must be called from the event loop"""
+        self._refill()
+        was_unlimited, self.rate = self.rate is None, rate
+        self.tokens = self.capacity if was_unlimited else min(self.tokens, self.capacity)
+        if self.waiters:
+            self._drain()
+
+
+class RateLimiter:
+    """Upload and download rate limits of a scope - all torrents, a torrent, or a peer.
+    A limiter may have a parent limiter of a wider scope, transfers wait for the tokens of every scope up the chain.
+    Limiters of the peers are created by `for_peer` of their torrent's limiter,
+    with the per-peer rates which may be changed for all of them at runtime."""
+
+    logger = logging.getLogger('rate-limiter')
+
+    def __init__(self, upload_rate: Optional[float] = None, download_rate: Optional[float] = None,
+                 parent: 'RateLimiter' = None):
+        """
+        :param upload_rate: bytes per second sent, unlimited if None
+        :param download_rate: bytes per second received, unlimited if None
+        :param parent: RateLimiter of a wider scope
+        """
+        self.upload = TokenBucket(upload_rate)
+        self.download = TokenBucket(download_rate)
+        self.parent = parent
+        self.peer_upload_rate = None
+        self.peer_download_rate = None
+        self.peers = weakref.WeakSet()  # RateLimiter of every peer connection
+
+    def __str__(self):
+        return "RateLimiter(upload={}, download={})".format(self.upload.rate, self.download.rate)
+
+    def set_rates(self, upload_rate: Optional[float], download_rate: Optional[float]):
+        self.logger.info("Limiting upload to {} and download to {} bytes per second".format(upload_rate, download_rate))
+        self.upload.set_rate(upload_rate)
+        self.download.set_rate(download_rate)
+
+    def set_peer_rates(self, upload_rate: Optional[float], download_rate: Optional[float]):
+        """changes the rates of every peer limiter created by `for_peer`, and of the ones created later"""
+        self.peer_upload_rate, self.peer_download_rate = upload_rate, download_rate
+        for peer_limiter in self.peers:
+            peer_limiter.upload.set_rate(upload_rate)
+            peer_limiter.download.set_rate(download_rate)
+
+    def for_peer(self) -> 'RateLimiter':
+        """returns a new limiter of a peer connection, with this limiter as its parent"""
+        peer_limiter = RateLimiter(self.peer_upload_rate, self.peer_download_rate, parent=self)
+        self.peers.add(peer_limiter)
+        return peer_limiter
+
+    @property
+    def limits_upload(self) -> bool:
+        """whether a scope up the chain limits the upload rate, else uploads need not take tokens"""
+        limiter = self
+        while limiter is not None:
+            if limiter.upload.rate is not None:
+                return True
+            limiter = limiter.parent
+        return False
+
+    @property
+    def limits_download(self) -> bool:
+        """whether a scope up the chain limits the download rate, else receives need not take tokens"""
+        limiter = self
+        while limiter is not None:
+            if limiter.download.rate is not None:
+                return True
+            limiter = limiter.parent
+        return False
+
+    async def take_upload(self, count: int):
+        limiter = self
+        while limiter is not None:
+            await limiter.upload.take(count)
+            limiter = limiter.parent
+
+    async def take_download(self, count: int):
+        limiter = self
+        while limiter is not None:
+            await limiter.download.take(count)
+            limiter = limiter.parent
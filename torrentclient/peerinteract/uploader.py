@@ -0,0 +1,331 @@
+import socket
+import random
+import asyncio
+import logging
+from typing import Dict, Iterable, Optional
+from collections import deque
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.diskinteract.storage import Storage
+from torrentclient.peercode.allmessages import Choke, UnChoke, HavePiece, PiecesBitField, RequestBlock, Block, \
+    CancelRequest
+from torrentclient.peerinteract.peer import Peer
+from torrentclient.peerinteract.connection import PeerConnection
+from torrentclient.peerinteract.handshake import PeerHandshake
+from torrentclient.peerinteract.dialer import ConnectionLimits
+from torrentclient.peerinteract.ratelimit import RateLimiter
+from torrentclient.trackerinteract.requestpeers import RequestPeers
+
+
+class PeerUpload:
+    """Upload state of a single peer connection"""
+
+    def __init__(self, connection: PeerConnection):
+        self.connection = connection
+        self.requests = deque()  # (piece index, begin, length) of requested blocks, in the order requested
+        self.haves = deque()  # indices of pieces completed since the connection was added
+        self.choked = True  # wanted by the choke policy, sent by the writer of the connection
+        self.counted = 0  # [bytes] exchanged with the peer at the previous rechoke
+        self.rate = 0  # [bytes] exchanged with the peer between the two previous rechokes
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __str__(self):
+        return "PeerUpload(peer={}, choked={}, requests={})".format(
+            self.connection.peer, self.choked, len(self.requests))
+
+
+class Uploader:
+    """Answers RequestBlock messages of peers with blocks of the completed pieces,
+    both on the download connections and on connections peers make to our listening port.
+    Blocks are sent without copying them into Python: straight from the files with sendfile,
+    or from memoryviews of the mappings of MmapStorage.
+    Peers are unchoked by tit-for-tat: every RECHOKE_INTERVAL the interested peers we downloaded the most from -
+    or uploaded the most to once the torrent is complete - get all upload slots but one,
+    which is given to a random other peer and rotated every OPTIMISTIC_ROUNDS rechokes."""
+
+    UPLOAD_SLOTS = 4
+    """number of peers unchoked at the same time, one of them optimistically"""
+
+    RECHOKE_INTERVAL = 10  # [seconds]
+
+    OPTIMISTIC_ROUNDS = 3
+    """number of rechokes the optimistically unchoked peer keeps its slot"""
+
+    MAX_QUEUED_REQUESTS = 250
+    """number of requests of a peer waiting to be answered, more are dropped"""
+
+    MAX_BLOCK_LENGTH = 2 ** 17
+    """length of the longest block answered, peers request 2 ** 14 bytes"""
+
+    MAX_INBOUND = 50
+    """number of connections made by peers served at the same time"""
+
+    logger = logging.getLogger('uploader')
+
+    class Exception(Exception):
+        """An exception with uploading the torrent content occurred"""
+
+    def __init__(self, torrent: MyTorrent, storage: Storage, completed_pieces: Iterable[int] = (),
+                 port: Optional[int] = None, upload_slots: int = UPLOAD_SLOTS, limiter: RateLimiter = None,
+                 listen: bool = True, limits: ConnectionLimits = None):
+        """
+        :param torrent: MyTorrent to upload
+        :param storage: Storage the completed pieces were written to
+        :param completed_pieces: indices of the pieces which are already stored
+        :param port: port to listen on, the first free one of RequestPeers.LOCAL_PORTS if None
+        :param upload_slots: number of peers unchoked at the same time
+        :param limiter: RateLimiter of the torrent, the parent of a limiter of every connection made by a peer
+        :param listen: whether to listen on the port, otherwise peers connecting to it are handed over with `serve`
+            by whoever listens on it, e.g. a session of many torrents
+        :param limits: ConnectionLimits the connections made by peers count towards
+        """
+        self.torrent = torrent
+        self.storage = storage
+        self.port = port
+        self.listen = listen
+        self.limits = limits
+        self.upload_slots = upload_slots
+        self.limiter = limiter
+        self.uploads = {}  # type: Dict[PeerConnection, PeerUpload]
+        self.bitfield = bytearray(-(-torrent.piece_count // 8))
+        self.completed_count = 0
+        for piece_idx in completed_pieces:
+            self.piece_completed(piece_idx)
+        self.optimistic = None  # PeerUpload unchoked optimistically
+        self.uploaded = 0  # [bytes] of all blocks sent
+        self.listener = None
+        self.tasks = set()
+
+    def __str__(self):
+        return "Uploader(torrent={}, port={}, peers={}, uploaded={})".format(
+            self.torrent.name, self.port, len(self.uploads), self.uploaded)
+
+    def has_piece(self, piece_idx: int) -> bool:
+        return bool(self.bitfield[piece_idx >> 3] & (0x80 >> (piece_idx & 7)))
+
+    @property
+    def seeding(self) -> bool:
+        return self.completed_count == self.torrent.piece_count
+
+    def piece_completed(self, piece_idx: int):
+        """announces a piece which was written to the storage to all peers"""
+        if self.has_piece(piece_idx):
+            return
+        self.bitfield[piece_idx >> 3] |= 0x80 >> (piece_idx & 7)
+        self.completed_count += 1
+        for upload in self.uploads.values():
+            upload.haves.append(piece_idx)
+            upload.wakeup.set()
+
+    async def add(self, connection: PeerConnection):
+        """serves the peer of a handshaked connection, before anything else is sent on it"""
+        if connection in self.uploads:
+            return
+        connection.uploader = self
+        upload = self.uploads[connection] = PeerUpload(connection)
+        if self.completed_count:
+            try:
+                await connection.send_control(PiecesBitField(bytes(self.bitfield)).create())
+            except PeerConnection.Exception as e:
+                self.logger.info("Could not send pieces to {}: {}".format(connection.peer, e))
+        upload.task = self._spawn(self._write(upload))
+        if connection.peer_interested:
+            self.on_interest(connection)
+
+    def remove(self, connection: PeerConnection):
+        upload = self.uploads.pop(connection, None)
+        if upload is None:
+            return
+        upload.task.cancel()
+        if self.optimistic is upload:
+            self.optimistic = None
+
+    def _set_choked(self, upload: PeerUpload, choked: bool):
+        if upload.choked != choked:
+            upload.choked = choked
+            if choked:
+                upload.requests.clear()  # peers request blocks again after being unchoked
+            upload.wakeup.set()
+
+    def on_interest(self, connection: PeerConnection):
+        """unchokes a peer which became interested right away if an upload slot is free"""
+        upload = self.uploads.get(connection)
+        if upload is None or not connection.peer_interested or not upload.choked:
+            return
+        if sum(not other.choked for other in self.uploads.values()) < self.upload_slots:
+            self._set_choked(upload, False)
+
+    def on_request(self, connection: PeerConnection, request: RequestBlock):
+        """queues a requested block to be sent, requests which can not be answered are dropped"""
+        upload = self.uploads.get(connection)
+        if upload is None or upload.choked or connection.am_choking:
+            return
+        piece_idx, begin, length = request.piece_index, request.block_begin, request.block_length
+        if piece_idx >= self.torrent.piece_count or not self.has_piece(piece_idx):
+            self.logger.warning("%s requested piece #%d which we do not have", connection.peer, piece_idx)
+            return
+        if not 0 < length <= self.MAX_BLOCK_LENGTH or begin + length > self.torrent.meta.piece_size(piece_idx):
+            self.logger.warning("%s requested an invalid block: %s", connection.peer, request)
+            return
+        if len(upload.requests) >= self.MAX_QUEUED_REQUESTS:
+            self.logger.debug("Dropping %s of %s with a full queue", request, connection.peer)
+            return
+        upload.requests.append((piece_idx, begin, length))
+        upload.wakeup.set()
+
+    def on_cancel(self, connection: PeerConnection, cancel: CancelRequest):
+        upload = self.uploads.get(connection)
+        if upload is not None:
+            try:
+                upload.requests.remove((cancel.piece_index, cancel.block_begin, cancel.block_length))
+            except ValueError:
+                pass  # already sent
+
+    async def _send_block(self, connection: PeerConnection, piece_idx: int, begin: int, length: int):
+        parts = self.storage.sendable(self.torrent.meta.piece_offset(piece_idx) + begin, length)
+        try:
+            await connection.send_parts([Block.header(piece_idx, begin, length)] + parts)
+        finally:
+            for part in parts:
+                if isinstance(part, memoryview):
+                    part.release()
+        connection.uploaded += length
+        self.uploaded += length
+
+    async def _write(self, upload: PeerUpload):
+        """sends choking changes, HavePiece messages and requested blocks of a connection, in that order"""
+        connection = upload.connection
+        try:
+            while True:
+                if upload.choked != connection.am_choking:
+                    connection.am_choking = upload.choked  # requests arriving from now on are dropped if choked
+                    await connection.send_control((Choke() if upload.choked else UnChoke()).create())
+                elif upload.haves:
+                    await connection.send_control(HavePiece(upload.haves.popleft()).create())
+                elif upload.requests:
+                    await self._send_block(connection, *upload.requests.popleft())
+                else:
+                    upload.wakeup.clear()
+                    await upload.wakeup.wait()
+        except (PeerConnection.Exception, Storage.Exception, OSError) as e:
+            self.logger.info("Stopped uploading to {}: {}".format(connection.peer, e))
+            connection.close("failed to upload")
+
+    def _rechoke(self, rotate_optimistic: bool):
+        """unchokes the interested peers which gave us the most since the previous rechoke,
+        and one other peer optimistically"""
+        for upload in self.uploads.values():
+            counted = upload.connection.uploaded if self.seeding else upload.connection.downloaded
+            upload.rate, upload.counted = counted - upload.counted, counted
+        interested = sorted((upload for upload in self.uploads.values() if upload.connection.peer_interested),
+                            key=lambda upload: upload.rate, reverse=True)
+        unchoked = interested[:self.upload_slots - 1]
+        others = [upload for upload in interested if upload not in unchoked]
+        if rotate_optimistic or self.optimistic not in others:
+            self.optimistic = random.choice(others) if others else None
+        if self.optimistic is not None:
+            unchoked.append(self.optimistic)
+        for upload in self.uploads.values():
+            self._set_choked(upload, upload not in unchoked)
+        self.logger.debug("Unchoked %d of %d interested peers", len(unchoked), len(interested))
+
+    async def _rechoke_periodically(self):
+        rechoke_count = 0
+        while True:
+            await asyncio.sleep(self.RECHOKE_INTERVAL)
+            self._rechoke(rotate_optimistic=rechoke_count % self.OPTIMISTIC_ROUNDS == 0)
+            rechoke_count += 1
+
+    async def _handshake(self, peer_socket: socket.socket, address: tuple, received: bytes) \
+            -> Optional[PeerConnection]:
+        """handshakes a peer which connected to us, returns its PeerConnection or None if it was rejected"""
+        try:
+            peer = Peer(address[0], address[1])
+            return await PeerHandshake(peer=peer, torrent=self.torrent).accept(peer_socket, received)
+        except (Peer.Exception, PeerHandshake.Exception) as e:
+            self.logger.info("Rejected connection from {}:{}: {}".format(address[0], address[1], e))
+            peer_socket.close()
+            return None
+
+    def _handshake_done(self, task: asyncio.Future):
+        if task.cancelled() or task.exception() is not None or task.result() is None:
+            return
+        self._spawn(self._serve(task.result()))
+
+    async def _serve(self, connection: PeerConnection):
+        """reads the messages of a peer which connected to us until it leaves"""
+        self.logger.info("Accepted connection from {}".format(connection.peer))
+        if self.limiter is not None:
+            connection.limiter = self.limiter.for_peer()
+        try:
+            await self.add(connection)
+            while True:
+                await connection.expect_blocks(timeout=PeerConnection.IDLE_TIMEOUT)
+        except PeerConnection.Exception as e:
+            self.logger.info("Lost {}: {}".format(connection, e))
+        finally:
+            self.remove(connection)
+            connection.close()
+
+    def serve(self, peer_socket: socket.socket, address: tuple, received: bytes = b'') -> bool:
+        """serves a peer which connected to us in the running event loop, returns False if it was refused
+        :param peer_socket: socket accepted from the listening socket
+        :param address: IP address and port of the peer
+        :param received: beginning of the peer's handshake which was already read from the socket
+        """
+        if len(self.uploads) >= self.MAX_INBOUND or (self.limits is not None and not self.limits.can_accept()):
+            self.logger.debug("Refusing %s:%d with %d peers served", address[0], address[1], len(self.uploads))
+            peer_socket.close()
+            return False
+        peer_socket.setblocking(False)
+        if self.limits is not None:
+            self.limits.handshake_started()
+        task = self._spawn(self._handshake(peer_socket, address, received))
+        if self.limits is not None:
+            task.add_done_callback(self.limits.handshake_done)
+        task.add_done_callback(self._handshake_done)
+        return True
+
+    async def _accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            peer_socket, address = await loop.sock_accept(self.listener)
+            self.serve(peer_socket, address)
+
+    def _spawn(self, coroutine) -> asyncio.Future:
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def start(self):
+        """listens for peers on the port, unless `listen` is unset, and starts rechoking, in the running event loop"""
+        if not self.listen:
+            self._spawn(self._rechoke_periodically())
+            return
+        try:
+            if self.port is None:
+                self.port = RequestPeers._get_local_port()
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(("", self.port))
+            self.listener.listen()
+            self.listener.setblocking(False)
+        except (RequestPeers.Exception, OSError) as e:
+            if self.listener is not None:
+                self.listener.close()
+            raise Uploader.Exception("Could not listen on port {}: {}".format(self.port, e))
+        self.logger.info("Listening on port {}".format(self.port))
+        self._spawn(self._accept())
+        self._spawn(self._rechoke_periodically())
+
+    async def close(self):
+        """stops listening and serving peers, connections made by peers are closed"""
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.uploads.clear()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
@@ -0,0 +1,299 @@
+import os
+import socket
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.metrics import Metrics
+from torrentclient.engine import DownloadEngine
+from torrentclient.diskinteract.mmapstorage import MmapStorage
+from torrentclient.diskinteract.resume import FastResume
+from torrentclient.trackerinteract.announcer import Announcer
+from torrentclient.trackerinteract.swarmcache import SwarmCache
+from torrentclient.trackerinteract.requestpeers import RequestPeers
+from torrentclient.trackerinteract.udptracker import UdpTracker
+from torrentclient.peerinteract.dialer import ConnectionLimits
+from torrentclient.peerinteract.handshake import PeerHandshake
+from torrentclient.peerinteract.uploader import Uploader
+from torrentclient.peerinteract.ratelimit import RateLimiter
+
+
+class SessionTorrent:
+    """Data class of a torrent of a session, and of the objects downloading and uploading it"""
+
+    def __init__(self, torrent: MyTorrent, storage: MmapStorage, resume: FastResume, cache: SwarmCache,
+                 limiter: RateLimiter, engine: DownloadEngine, priority: float):
+        self.torrent = torrent
+        self.storage = storage
+        self.resume = resume
+        self.cache = cache
+        self.limiter = limiter
+        self.engine = engine
+        self.priority = priority
+        self.task = None  # running DownloadEngine.run
+
+    def __str__(self):
+        return "SessionTorrent(name={}, priority={}, pieces={}/{})".format(
+            self.torrent.name, self.priority, self.engine.pieces_done, self.torrent.piece_count)
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def downloading(self) -> bool:
+        return self.running and self.engine.pieces_done < self.torrent.piece_count
+
+
+class Session:
+    """Downloads many torrents concurrently in a single asyncio event loop, each by a DownloadEngine of its own.
+    The torrents share the thread pools of hashing, disk writes and HTTP announces, the UdpTracker clients,
+    and a single listening port, a peer connecting to it is handed to the Uploader of the info hash of its handshake.
+    ConnectionLimits cap the connections and half-open dials of all torrents together.
+    The global rates of the session's limiter are split among the running torrents by their priority
+    every REBALANCE_INTERVAL, a torrent which completed its download gets no share of the download rate."""
+
+    HASH_WORKERS = os.cpu_count() or 1
+    DISK_WORKERS = 2
+    ANNOUNCE_WORKERS = Announcer.WORKERS
+
+    REBALANCE_INTERVAL = 5  # [seconds]
+
+    HANDSHAKE_TIMEOUT = PeerHandshake.RESPONSE_TIMEOUT  # [seconds]
+    """time for a peer which connected to us to send the beginning of its handshake"""
+
+    INFO_HASH_START = len(PeerHandshake.PSTR_LEN + PeerHandshake.PSTR + PeerHandshake.RESERVED)
+    INFO_HASH_END = INFO_HASH_START + 20
+    """the info hash is read from the handshake of a peer to find its torrent"""
+
+    logger = logging.getLogger('session')
+
+    class Exception(Exception):
+        """An exception with downloading the torrents of the session occurred"""
+
+    def __init__(self, limiter: RateLimiter = None, metrics: Metrics = None, port: Optional[int] = None,
+                 max_connections: int = ConnectionLimits.MAX_CONNECTIONS,
+                 max_half_open: int = ConnectionLimits.MAX_HALF_OPEN, seed: bool = False):
+        """
+        :param limiter: RateLimiter of all torrents, its rates are split among them and its per-peer rates apply
+            to the peers of every torrent. the bandwidth is not limited if None
+        :param metrics: Metrics of the session, the series of every torrent are labeled with its name
+        :param port: port peers connect to for any torrent, the first free one of RequestPeers.LOCAL_PORTS if None
+        :param max_connections: maximal number of peer connections of all torrents
+        :param max_half_open: maximal number of handshakes in progress of all torrents
+        :param seed: whether to keep uploading the torrents once they were downloaded, until cancelled
+        """
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.port = port
+        self.limits = ConnectionLimits(max_connections, max_half_open)
+        self.seed = seed
+        self.torrents = {}  # type: Dict[bytes, SessionTorrent]
+        self.udp_trackers = {}  # type: Dict[str, UdpTracker]
+        self.hash_executor = None
+        self.disk_executor = None
+        self.announce_executor = None
+        self.listener = None
+        self.tasks = set()
+
+    def __str__(self):
+        return "Session(torrents={}, port={}, limits={})".format(len(self.torrents), self.port, self.limits)
+
+    def add(self, torrent_path: str, tracker_urls: Iterable[str] = (), priority: float = 1,
+            verify: bool = False) -> SessionTorrent:
+        """adds a torrent to download once the session runs, resuming any interrupted download of it
+        :param tracker_urls: announce URLs to try in addition to the torrent's
+        :param priority: weight of the torrent's share of the session's rates
+        :param verify: whether to verify the completed pieces of a download which was not shut down cleanly
+        """
+        if priority <= 0:
+            raise Session.Exception("Invalid priority ({}) - should be positive".format(priority))
+        torrent = MyTorrent.read(filepath=torrent_path)
+        if torrent.infohash in self.torrents:
+            raise Session.Exception("'{}' was already added".format(torrent.name))
+        if any(entry.torrent.out_filename == torrent.out_filename for entry in self.torrents.values()):
+            raise Session.Exception("Another torrent is downloaded to '{}'".format(torrent.out_filename))
+        if self.port is None:
+            try:
+                self.port = RequestPeers._get_local_port()
+            except RequestPeers.Exception as e:
+                raise Session.Exception("Could not find a port to listen on: {}".format(e))
+        storage = MmapStorage(torrent)
+        storage.preallocate()  # fixed sizes, so the resume file can detect other changes
+        resume = FastResume.load(torrent, storage, verify=verify)
+        cache = SwarmCache.load(torrent.infohash)
+        metrics = self.metrics.child(torrent=torrent.name)
+        limiter = RateLimiter(parent=self.limiter)
+        limiter.set_peer_rates(self.limiter.peer_upload_rate, self.limiter.peer_download_rate)
+        announcer = Announcer(torrent, [tier[0] for tier in torrent.trackers or []] + list(tracker_urls),
+                              workers=self.ANNOUNCE_WORKERS, udp_trackers=self.udp_trackers, cache=cache,
+                              port=self.port, metrics=metrics)
+        uploader = Uploader(torrent, storage, resume.completed_pieces(), port=self.port, limiter=limiter,
+                            listen=False, limits=self.limits)
+        engine = DownloadEngine(torrent, cache.known_peers(), storage=storage, resume=resume, announcer=announcer,
+                                cache=cache, uploader=uploader, seed=self.seed, limiter=limiter, metrics=metrics,
+                                limits=self.limits, progress_path="progress_{}.txt".format(torrent.out_filename))
+        entry = SessionTorrent(torrent, storage, resume, cache, limiter, engine, priority)
+        self.torrents[torrent.infohash] = entry
+        self.logger.info("Added {} with priority {}".format(torrent.name, priority))
+        return entry
+
+    def set_priority(self, infohash: bytes, priority: float):
+        """changes the weight of a torrent's share of the rates, effective by the next rebalance"""
+        if priority <= 0:
+            raise Session.Exception("Invalid priority ({}) - should be positive".format(priority))
+        self.torrents[infohash].priority = priority
+
+    def set_peer_rates(self, upload_rate: Optional[float], download_rate: Optional[float]):
+        """changes the rates of every peer of every torrent"""
+        self.limiter.set_peer_rates(upload_rate, download_rate)
+        for entry in self.torrents.values():
+            entry.limiter.set_peer_rates(upload_rate, download_rate)
+
+    @staticmethod
+    def _share(rate: Optional[float], entry: SessionTorrent, entries: List[SessionTorrent]) -> Optional[float]:
+        """returns the torrent's share of the rate by its priority, unlimited if it is not one of the entries"""
+        if rate is None or entry not in entries:
+            return None
+        return rate * entry.priority / sum(other.priority for other in entries)
+
+    def _rebalance(self):
+        """splits the session's rates among the torrents which use them, by their priority"""
+        uploading = [entry for entry in self.torrents.values() if entry.running]
+        downloading = [entry for entry in uploading if entry.downloading]
+        for entry in self.torrents.values():
+            upload_rate = self._share(self.limiter.upload.rate, entry, uploading)
+            download_rate = self._share(self.limiter.download.rate, entry, downloading)
+            if (upload_rate, download_rate) != (entry.limiter.upload.rate, entry.limiter.download.rate):
+                entry.limiter.set_rates(upload_rate, download_rate)
+
+    def _export_metrics(self):
+        try:
+            self.metrics.export()
+        except OSError as e:
+            self.logger.error("Could not export metrics: {}".format(e))
+
+    async def _rebalance_periodically(self):
+        """rebalances the rates and exports the metrics of all torrents, which are collected by their engines"""
+        while True:
+            self._rebalance()
+            self._export_metrics()
+            await asyncio.sleep(self.REBALANCE_INTERVAL)
+
+    async def _recv_info_hash(self, peer_socket: socket.socket) -> bytes:
+        """reads the handshake of a peer up to the end of the info hash"""
+        loop = asyncio.get_running_loop()
+        received = b''
+        while len(received) < self.INFO_HASH_END:
+            recv_bytes = await loop.sock_recv(peer_socket, self.INFO_HASH_END - len(received))
+            if recv_bytes == b'':
+                raise ConnectionResetError("connection closed by peer")
+            received += recv_bytes
+        return received
+
+    async def _dispatch(self, peer_socket: socket.socket, address: tuple):
+        """hands a peer which connected to us over to the Uploader of the torrent it asks for"""
+        try:
+            received = await asyncio.wait_for(self._recv_info_hash(peer_socket), self.HANDSHAKE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.info("Rejected connection from {}:{}: {!r}".format(address[0], address[1], e))
+            peer_socket.close()
+            return
+        entry = self.torrents.get(received[self.INFO_HASH_START:self.INFO_HASH_END])
+        if entry is None or not entry.running:
+            self.logger.info("Rejected connection from {}:{} for an unknown torrent".format(address[0], address[1]))
+            peer_socket.close()
+            return
+        entry.engine.uploader.serve(peer_socket, address, received)
+
+    async def _accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            peer_socket, address = await loop.sock_accept(self.listener)
+            if not self.limits.can_accept():
+                self.logger.debug("Refusing %s:%d with %s", address[0], address[1], self.limits)
+                peer_socket.close()
+                continue
+            peer_socket.setblocking(False)
+            self._spawn(self._dispatch(peer_socket, address))
+
+    def _spawn(self, coroutine) -> asyncio.Future:
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def _listen(self):
+        try:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(("", self.port))
+            self.listener.listen()
+            self.listener.setblocking(False)
+        except OSError as e:
+            self.listener.close()
+            self.listener = None
+            raise Session.Exception("Could not listen on port {}: {}".format(self.port, e))
+        self.logger.info("Listening on port {} for {} torrents".format(self.port, len(self.torrents)))
+
+    async def run(self) -> list:
+        """runs the engines of all torrents until they are done, seeding them if `seed` was set.
+        returns the outcome of every torrent, in the order they were added - None, or the exception it failed with"""
+        entries = list(self.torrents.values())
+        try:
+            await self.metrics.start()
+            self._listen()
+            for entry in entries:
+                entry.task = asyncio.ensure_future(entry.engine.run())
+            self._spawn(self._accept())
+            self._spawn(self._rebalance_periodically())
+            return await asyncio.gather(*(entry.task for entry in entries), return_exceptions=True)
+        finally:
+            for entry in entries:
+                if entry.task is not None:
+                    entry.task.cancel()
+            await asyncio.gather(*(entry.task for entry in entries if entry.task is not None), return_exceptions=True)
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            if self.listener is not None:
+                self.listener.close()
+                self.listener = None
+            for udp_tracker in self.udp_trackers.values():
+                udp_tracker.close()
+            self.udp_trackers.clear()
+            self._export_metrics()
+            await self.metrics.close()
+
+    def download(self):
+        """runs the event loop until all torrents were downloaded.
+        raises an exception naming the torrents whose peers ran out before all pieces were obtained"""
+        if not self.torrents:
+            raise Session.Exception("No torrents to download")
+        self.hash_executor = ThreadPoolExecutor(self.HASH_WORKERS)
+        self.disk_executor = ThreadPoolExecutor(self.DISK_WORKERS)
+        self.announce_executor = ThreadPoolExecutor(self.ANNOUNCE_WORKERS)
+        for entry in self.torrents.values():
+            entry.engine.hash_executor = self.hash_executor
+            entry.engine.disk_executor = self.disk_executor
+            entry.engine.announcer.executor = self.announce_executor
+        try:
+            outcomes = asyncio.run(self.run())
+        finally:
+            self.announce_executor.shutdown(wait=False)
+            self.hash_executor.shutdown()
+            self.disk_executor.shutdown()
+            for entry in self.torrents.values():
+                entry.engine.close()
+                entry.cache.save()
+        failures = []
+        for entry, outcome in zip(self.torrents.values(), outcomes):
+            if isinstance(outcome, BaseException):
+                failures.append("{}: {}".format(entry.torrent.name, outcome))
+            else:  # the resume file is kept with every piece completed, a later session seeds right away
+                self.logger.info("Done downloading {}!".format(entry.torrent.name))
+        if failures:
+            raise Session.Exception("Could not download {} of {} torrents - {}".format(
+                len(failures), len(self.torrents), "; ".join(failures)))
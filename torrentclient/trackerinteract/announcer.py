@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.metrics import Metrics
+from torrentclient.peerinteract.peer import Peer
+from torrentclient.trackerinteract.tracker import Tracker
+from torrentclient.trackerinteract.requestpeers import RequestPeers
+from torrentclient.trackerinteract.handleresponse import HandleResponse
+from torrentclient.trackerinteract.udptracker import UdpTracker
+from torrentclient.trackerinteract.swarmcache import SwarmCache
+
+
+class Announcer:
+    """Announces a torrent to all of its trackers concurrently from the download's event loop,
+    peers of each tracker are handed over as soon as its response arrives.
+    HTTP requests are sent from a thread pool with one requests.Session per tracker host,
+    so trackers sharing a host reuse its connections. UDP trackers are announced to by UdpTracker clients,
+    which may be shared between the announcers of many torrents, as may the thread pool.
+    With a SwarmCache, trackers which failed recently or whose interval did not pass are skipped,
+    unless an event such as "completed" is announced, and the outcome of every announce is recorded in it."""
+
+    WORKERS = 40
+    """number of trackers contacted at the same time"""
+
+    CONNECT_TIMEOUT = 5  # [seconds]
+    TIMEOUT = 15  # [seconds]
+    """time for a single tracker to respond, after which it is given up"""
+
+    logger = logging.getLogger('announcer')
+
+    class Exception(Exception):
+        """An exception with announcing to the trackers occurred"""
+
+    def __init__(self, torrent: MyTorrent, tracker_urls: Iterable[str], workers: int = WORKERS,
+                 udp_trackers: Dict[str, UdpTracker] = None, cache: SwarmCache = None, port: Optional[int] = None,
+                 metrics: Metrics = None, executor: ThreadPoolExecutor = None):
+        """
+        :param torrent: MyTorrent to announce
+        :param tracker_urls: announce URLs, duplicates are contacted once
+        :param workers: maximal number of concurrent HTTP requests
+        :param udp_trackers: UdpTracker clients by host and port, shared with other announcers which close them,
+            the announcer opens and closes its own if None
+        :param cache: SwarmCache of the torrent to consult and update
+        :param port: port peers can connect to, the first free local port if None
+        :param metrics: Metrics the outcome and latency of every announce are counted in
+        :param executor: thread pool HTTP requests are sent from, shared with other announcers which shut it down,
+            the announcer creates and shuts down its own for every announce if None
+        """
+        self.torrent = torrent
+        self.tracker_urls = list(dict.fromkeys(tracker_urls))
+        self.workers = workers
+        self.sessions = {}  # type: Dict[str, requests.Session]
+        self.owns_udp_trackers = udp_trackers is None
+        self.udp_trackers = udp_trackers if udp_trackers is not None else {}
+        self.cache = cache
+        self.port = port
+        self.metrics = metrics
+        self.executor = executor
+
+    def __str__(self):
+        return "Announcer(torrent={}, trackers={})".format(self.torrent.name, len(self.tracker_urls))
+
+    def _session(self, tracker: Tracker) -> requests.Session:
+        """returns the session of the tracker's host, keeping its connections alive between announces"""
+        key = "{}:{}".format(tracker.hostname, tracker.port)
+        if key not in self.sessions:
+            self.sessions[key] = requests.Session()
+        return self.sessions[key]
+
+    def _udp_tracker(self, tracker: Tracker) -> UdpTracker:
+        key = "{}:{}".format(tracker.hostname, tracker.port)
+        if key not in self.udp_trackers:
+            self.udp_trackers[key] = UdpTracker(tracker)
+        return self.udp_trackers[key]
+
+    def _announce_blocking(self, tracker: Tracker, session: requests.Session,
+                           stats: dict) -> Tuple[List[Peer], Optional[int]]:
+        """returns peers and interval from an HTTP tracker"""
+        response = RequestPeers(tracker, self.torrent).send(
+            session=session, timeout=(self.CONNECT_TIMEOUT, self.TIMEOUT), port=self.port, **stats)
+        handle_response = HandleResponse(response)
+        return handle_response.get_peers(), handle_response.interval
+
+    async def _announce(self, tracker_url: str, executor: ThreadPoolExecutor, stats: dict) -> List[Peer]:
+        """returns peers from a single tracker, an empty list if it failed or timed out"""
+        try:
+            tracker = Tracker(tracker_url)
+        except Tracker.Exception as e:
+            self.logger.debug("Skipping %s: %s", tracker_url, e)
+            return []
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            if tracker.protocol == "udp":
+                response = await asyncio.wait_for(
+                    self._udp_tracker(tracker).announce(self.torrent, port=self.port, **stats),
+                    self.TIMEOUT + self.CONNECT_TIMEOUT)
+                peers, interval = response.peers, response.interval
+            else:
+                future = loop.run_in_executor(
+                    executor, self._announce_blocking, tracker, self._session(tracker), stats)
+                peers, interval = await asyncio.wait_for(future, self.TIMEOUT + self.CONNECT_TIMEOUT)
+        except (RequestPeers.Exception, HandleResponse.Exception, UdpTracker.Exception) as e:
+            self.logger.warning("Failed getting peers of '{}' from {}: {}".format(self.torrent.name, tracker_url, e))
+            peers = None
+        except asyncio.TimeoutError:
+            self.logger.warning("{} did not respond in {} seconds".format(tracker_url, self.TIMEOUT))
+            peers = None
+        if self.metrics is not None:
+            self.metrics.inc("tracker_announces_total", protocol=tracker.protocol,
+                             result="failure" if peers is None else "success")
+            if peers is not None:
+                self.metrics.observe("tracker_latency_seconds", loop.time() - started, protocol=tracker.protocol)
+        if self.cache is not None:
+            if peers is None:
+                self.cache.tracker_failed(tracker_url)
+            else:
+                self.cache.tracker_succeeded(tracker_url, loop.time() - started, interval)
+                for peer in peers:
+                    self.cache.peer_seen(peer)
+        if peers is None:
+            return []
+        self.logger.info("Got {} peers from {}".format(len(peers), tracker_url))
+        return peers
+
+    async def announce(self, on_peers: Callable[[List[Peer]], None], uploaded: int = 0, downloaded: int = 0,
+                       left: Optional[int] = None, event: Optional[str] = "started", force: bool = False) -> int:
+        """announces to all trackers concurrently, calling `on_peers` with the peers of every response
+        as it arrives. returns once all trackers responded or timed out,
+        with the number of trackers skipped as the cache says their interval did not pass or they failed recently
+        :param uploaded: number of bytes uploaded to peers
+        :param downloaded: number of bytes downloaded from peers
+        :param left: number of bytes still missing, the torrent's total length if None
+        :param event: "started", "completed", "stopped", or None for a regular announce
+        :param force: announces to all trackers regardless of the cache
+        """
+        if not self.tracker_urls:
+            raise Announcer.Exception("No trackers to announce '{}' to".format(self.torrent.name))
+        stats = {'uploaded': uploaded, 'downloaded': downloaded, 'left': left, 'event': event}
+        tracker_urls = self.tracker_urls
+        if self.cache is not None and event in ("started", None):
+            tracker_urls = self.cache.trackers_by_latency(
+                [url for url in tracker_urls if force or self.cache.should_announce(url)])
+            self.logger.info("Announcing to {} of {} trackers".format(len(tracker_urls), len(self.tracker_urls)))
+            if not tracker_urls:
+                return len(self.tracker_urls)
+        executor = self.executor if self.executor is not None else ThreadPoolExecutor(
+            min(self.workers, len(tracker_urls)))
+        try:
+            for announce in asyncio.as_completed([self._announce(url, executor, stats) for url in tracker_urls]):
+                peers = await announce
+                if peers:
+                    on_peers(peers)
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(wait=False)
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            if self.owns_udp_trackers:
+                for udp_tracker in self.udp_trackers.values():
+                    udp_tracker.close()
+                self.udp_trackers.clear()
+        return len(self.tracker_urls) - len(tracker_urls)
@@ -1,6 +1,8 @@
+import struct
 import bencode
 import logging
 import requests
+from typing import List
 
 from torrentclient.peerinteract.peer import Peer
 
@@ -17,6 +19,7 @@ class HandleResponse:
 
     def __init__(self, response: requests.Response):
         self.response = response
+        self.interval = None  # [seconds] to wait before announcing again, as requested in the response
 
     def __str__(self):
         return "HandleResponse({})".format(self.response)
@@ -36,48 +39,63 @@ class HandleResponse:
         try:
             self.bresponse = bencode.bdecode(self.response.content)
         except bencode.BencodeDecodeError as e:
-            raise HandleResponse.Exception("Could not bdecode response ({}): {}".format(self.response.content, e))
+            raise HandleResponse.Exception("Could not bdecode response ({}): {}".format(self.response.content[:100], e))
         if "failure reason" in self.bresponse:
             raise HandleResponse.Exception("Failure in response: {}".format(self.bresponse["failure reason"]))
         if "warning message" in self.bresponse:
             self.logger.warning("Warning in response: {}".format(self.bresponse["warning message"]))
+        interval = self.bresponse.get("min interval", self.bresponse.get("interval"))
+        if isinstance(interval, int):
+            self.interval = interval
 
-    def _parse_peers_dict(self):
-        try:
-            peers_dict = bencode.bdecode(self.bresponse['peers'])
-        except bencode.exceptions.BencodeDecodeError as e:
-            raise HandleResponse.Exception(e)
-        # TODO: complete dictionary parsing
+    @classmethod
+    def parse_dict_peers(cls, peers_list: list) -> List[Peer]:
+        """returns peers of the dictionary model: a list of {'peer id', 'ip', 'port'} dictionaries,
+        peers whose 'ip' is a DNS name instead of an IPv4 or IPv6 address are skipped"""
+        peers = []
+        for entry in peers_list:
+            try:
+                peer = Peer(entry['ip'], entry['port'])
+            except (KeyError, TypeError, Peer.Exception) as e:
+                cls.logger.debug("Skipping peer %s: %s", entry, e)
+                continue
+            peer_id = entry.get('peer id')
+            if peer_id is not None:
+                peer.peer_id = peer_id.encode("utf-8") if isinstance(peer_id, str) else peer_id
+            peers.append(peer)
+        return peers
+
+    @classmethod
+    def parse_compact_peers(cls, peers_bytes: bytes, address_length: int = Peer.IPV4_LENGTH) -> List[Peer]:
+        """returns peers of the compact model: 4 bytes of IPv4 address (16 bytes of IPv6 address in 'peers6')
+        and 2 bytes of port per peer. the addresses are sliced and deduplicated in bulk,
+        addresses with port 0 which can not be connected to are skipped"""
+        if isinstance(peers_bytes, str):
+            peers_bytes = peers_bytes.encode("utf-8")  # bdecoded as str since it happened to be valid UTF-8
+        if len(peers_bytes) % address_length != 0:
+            raise HandleResponse.Exception("Invalid peers length ({}), not divisible by {}".format(
+                len(peers_bytes), address_length))
+        addresses = dict.fromkeys(address for (address,) in
+                                  struct.iter_unpack("{}s".format(address_length), peers_bytes))
+        return [Peer.from_address(address) for address in addresses if address[-Peer.PORT_LENGTH:] != b'\0\0']
 
     def _parse_peers_bytes(self):
-        import socket
-        self._peers = []
-        if len(self.bresponse['peers']) % 6 != 0:
-            raise HandleResponse.Exception(
-                "Invalid peers length ({}), not divisible by 6".format(len(self.bresponse['peers'])))
-        for start_idx in range(0, len(self.bresponse['peers']), 6):
-            peer_ip = socket.inet_ntoa(self.bresponse['peers'][start_idx:start_idx + 4])
-            peer_port = int.from_bytes(self.bresponse['peers'][start_idx+4:start_idx+6], byteorder="big", signed=False)
-            try:
-                peer = Peer(peer_ip, peer_port)
-            except Peer.Exception as e:
-                self.logger.warning(e)
-            else:
-                self._peers.append(peer)
+        self._peers = self.parse_compact_peers(self.bresponse.get('peers', b''))
 
     def _parse_peers(self):
-        """tries parsing peers from response using the 2 supported models"""
-        self.logger.debug("Parsing peers from: {}".format(self.response.content))
-        if 'peers' not in self.bresponse:
-            raise HandleResponse.Exception("No 'peers' in bencoded response: {}".format(self.bresponse))
-        try:
-            self._parse_peers_dict()
-        except HandleResponse.Exception:
-            self.logger.debug("Assuming peers in response are in bytes mode")
-            self._parse_peers_bytes()
+        """parses peers of the compact model or the dictionary model in 'peers', and IPv6 compact peers in 'peers6'.
+        peers listed more than once are kept once"""
+        if 'peers' not in self.bresponse and 'peers6' not in self.bresponse:
+            raise HandleResponse.Exception("No 'peers' in bencoded response with keys: {}".format(
+                ", ".join(sorted(str(key) for key in self.bresponse))))
+        if isinstance(self.bresponse.get('peers'), list):
+            self._peers = self.parse_dict_peers(self.bresponse['peers'])
         else:
-            raise HandleResponse.Exception("Peers in dictionary mode - not supported")
-        self.logger.debug("peers=[{}]".format(", ".join(str(peer) for peer in self._peers)))
+            self._parse_peers_bytes()
+        if 'peers6' in self.bresponse:
+            self._peers.extend(self.parse_compact_peers(self.bresponse['peers6'], Peer.IPV6_LENGTH))
+        self._peers = list(dict.fromkeys(self._peers))
+        self.logger.debug("Parsed %d peers", len(self._peers))
 
     def get_peers(self):
         self._validate_response()
@@ -40,21 +40,34 @@ class RequestPeers:
                     return port
         raise RequestPeers.Exception("Could not find any open local port from: {}".format(RequestPeers.LOCAL_PORTS))
 
-    def send(self):
+    def send(self, session=None, timeout=None, port: int = None, uploaded: int = 0, downloaded: int = 0,
+             left: int = None, event: str = "started"):
+        """
+        :param session: requests.Session to send with, keeping its connections alive
+        :param timeout: seconds to wait for the tracker, or a (connect, read) tuple, no limit if None
+        :param port: port peers can connect to, the first free local port if None
+        :param uploaded: number of bytes uploaded to peers
+        :param downloaded: number of bytes downloaded from peers
+        :param left: number of bytes still missing, the torrent's total length if None
+        :param event: "started", "completed", "stopped", or None for a regular announce
+        """
         import requests
+        params = {
+            "info_hash": self.torrent.infohash,
+            "peer_id": Peer.LOCAL_PEER_ID,
+            "port": str(port if port is not None else self._get_local_port()),
+            "uploaded": str(uploaded),
+            "downloaded": str(downloaded),
+            "left": str(self.torrent.total_length if left is None else left),
+            "compact": "1",
+        }
+        if event is not None:
+            params["event"] = event
         try:
-            return requests.get(
-                url=self.tracker.url,
-                params={
-                    "info_hash": self.torrent.infohash,
-                    "peer_id": Peer.LOCAL_PEER_ID,
-                    "port": str(self._get_local_port()),
-                    "uploaded": "0",
-                    "downloaded": "0",
-                    "left": str(self.torrent.total_length),
-                    "compact": "1",
-                    "event": "started",
-                },
-            )
+            return (session or requests).get(url=self.tracker.url, params=params, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            raise RequestPeers.Exception("Timed out on HTTP GET to {}: {}".format(self.tracker.url, e))
         except requests.exceptions.ConnectionError as e:
             raise RequestPeers.Exception("Could not send HTTP GET to {}: {}".format(self.tracker.url, e))
+        except requests.exceptions.RequestException as e:
+            raise RequestPeers.Exception("HTTP GET to {} failed: {}".format(self.tracker.url, e))
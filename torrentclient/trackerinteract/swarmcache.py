@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+from typing import List, Optional
+
+import bencode
+
+from torrentclient.peerinteract.peer import Peer
+
+
+class SwarmCache:
+    """Peers and trackers of a torrent remembered between runs, in a file named by the torrent's infohash.
+    Peers are kept with the time a piece was last obtained from them and their measured throughput,
+    so known-good peers are connected to at startup before any tracker responds.
+    Trackers are kept with their latency, consecutive failures and announce interval,
+    so dead trackers are backed off and trackers are not announced to again before their interval passed."""
+
+    ROOT = "cache"
+    SUFFIX = ".swarm"
+
+    PEER_TTL = 7 * 24 * 60 * 60  # [seconds]
+    """time after which a peer which was not seen again is forgotten"""
+
+    MAX_PEERS = 1000
+    """number of peers kept, the best ones first"""
+
+    THROUGHPUT_WEIGHT = 0.3
+    """weight of the latest measurement in the moving average of a peer's throughput"""
+
+    TRACKER_RETRY_DELAY = 5 * 60  # [seconds]
+    MAX_TRACKER_RETRY_DELAY = 24 * 60 * 60  # [seconds]
+    """a tracker which failed n consecutive times is skipped for TRACKER_RETRY_DELAY * 2 ** (n - 1), up to the max"""
+
+    logger = logging.getLogger('swarm-cache')
+
+    class Exception(Exception):
+        """An exception with the swarm cache file occurred"""
+
+    def __init__(self, infohash: bytes, root: str = ROOT):
+        """
+        :param infohash: infohash of the torrent
+        :param root: folder of the cache files
+        """
+        self.infohash = infohash
+        self.path = os.path.join(root, infohash.hex() + self.SUFFIX)
+        self.peers = {}  # "ip:port" -> {'ip', 'port', 'seen', 'success', 'throughput'}
+        self.trackers = {}  # url -> {'latency', 'failures', 'interval', 'announced'}
+
+    def __str__(self):
+        return "SwarmCache(path={}, peers={}, trackers={})".format(self.path, len(self.peers), len(self.trackers))
+
+    @staticmethod
+    def _peer_key(peer: Peer) -> str:
+        return "{}:{}".format(peer.ip_address, peer.port)
+
+    def _peer_entry(self, peer: Peer) -> dict:
+        return self.peers.setdefault(self._peer_key(peer), {
+            'ip': peer.ip_address, 'port': peer.port, 'seen': 0, 'success': 0, 'throughput': 0})
+
+    def peer_seen(self, peer: Peer):
+        """remembers a peer a tracker returned"""
+        self._peer_entry(peer)['seen'] = int(time.time())
+
+    def peer_succeeded(self, peer: Peer, byte_count: int, seconds: float):
+        """remembers a peer a piece of `byte_count` bytes was obtained from in `seconds`"""
+        entry = self._peer_entry(peer)
+        entry['seen'] = entry['success'] = int(time.time())
+        throughput = byte_count / max(seconds, 0.001)
+        if entry['throughput']:
+            throughput = self.THROUGHPUT_WEIGHT * throughput + (1 - self.THROUGHPUT_WEIGHT) * entry['throughput']
+        entry['throughput'] = int(throughput)
+
+    def known_peers(self) -> List[Peer]:
+        """returns peers seen within PEER_TTL, peers pieces were obtained from first by throughput"""
+        now = time.time()
+        entries = sorted((entry for entry in self.peers.values() if now - entry['seen'] < self.PEER_TTL),
+                         key=lambda entry: (entry['success'] > 0, entry['throughput'], entry['seen']), reverse=True)
+        peers = []
+        for entry in entries:
+            try:
+                peers.append(Peer(entry['ip'], entry['port']))
+            except Peer.Exception as e:
+                self.logger.warning(e)
+        return peers
+
+    def tracker_succeeded(self, url: str, latency: float, interval: Optional[int]):
+        """remembers a tracker which responded after `latency` seconds, asking to announce again after `interval`"""
+        self.trackers[url] = {
+            'latency': int(latency * 1000),  # [milliseconds]
+            'failures': 0,
+            'interval': interval or 0,
+            'announced': int(time.time()),
+        }
+
+    def tracker_failed(self, url: str):
+        entry = self.trackers.setdefault(url, {'latency': 0, 'failures': 0, 'interval': 0, 'announced': 0})
+        entry['failures'] += 1
+        entry['announced'] = int(time.time())
+
+    def should_announce(self, url: str) -> bool:
+        """returns False if the tracker's interval did not pass since it responded,
+        or it failed recently - the longer the more times it failed in a row"""
+        entry = self.trackers.get(url)
+        if entry is None:
+            return True
+        elapsed = time.time() - entry['announced']
+        if entry['failures']:
+            delay = min(self.TRACKER_RETRY_DELAY * 2 ** (entry['failures'] - 1), self.MAX_TRACKER_RETRY_DELAY)
+            if elapsed < delay:
+                self.logger.debug("Skipping %s which failed %d times in a row", url, entry['failures'])
+                return False
+        elif elapsed < entry['interval']:
+            self.logger.debug("Skipping %s which asked to wait %s seconds", url, entry['interval'])
+            return False
+        return True
+
+    def trackers_by_latency(self, urls: List[str]) -> List[str]:
+        """returns `urls` with trackers which responded fastest first, unknown ones after them"""
+        def latency(url: str) -> int:
+            entry = self.trackers.get(url)
+            return entry['latency'] if entry is not None and not entry['failures'] else self.MAX_TRACKER_RETRY_DELAY
+        return sorted(urls, key=latency)
+
+    def save(self):
+        """atomically writes the cache file, keeping the MAX_PEERS best peers seen within PEER_TTL"""
+        now = time.time()
+        best = sorted((item for item in self.peers.items() if now - item[1]['seen'] < self.PEER_TTL),
+                      key=lambda item: (item[1]['success'] > 0, item[1]['throughput'], item[1]['seen']), reverse=True)
+        self.peers = dict(best[:self.MAX_PEERS])
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as out:
+            out.write(bencode.bencode({'peers': self.peers, 'trackers': self.trackers}))
+        os.replace(temp_path, self.path)
+
+    def _load(self):
+        try:
+            cache = bencode.bread(self.path)
+        except FileNotFoundError:
+            return
+        except bencode.BencodeDecodeError as e:
+            raise SwarmCache.Exception("Could not bdecode {}: {}".format(self.path, e))
+        self.peers = dict(cache['peers'])
+        self.trackers = dict(cache['trackers'])
+
+    @classmethod
+    def load(cls, infohash: bytes, root: str = ROOT):
+        """returns SwarmCache of the torrent's cache file, an empty one if it does not exist or is invalid"""
+        swarm_cache = cls(infohash, root)
+        try:
+            swarm_cache._load()
+        except (SwarmCache.Exception, KeyError, TypeError) as e:
+            cls.logger.warning("Ignoring swarm cache: {}".format(e))
+            swarm_cache.peers, swarm_cache.trackers = {}, {}
+        else:
+            cls.logger.info("Loaded {}".format(swarm_cache))
+        return swarm_cache
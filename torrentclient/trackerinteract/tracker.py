@@ -5,7 +5,9 @@ import logging
 class Tracker:
     """Data class of BitTorrent tracker URL"""
 
-    URL_PATTERN = re.compile(r"(?P<protocol>wss|http|udp)://(?P<hostname>[.\w]+)(:(?P<port>[0-9]+))?(/announce)?")
+    URL_PATTERN = re.compile(r"(?P<protocol>wss|http|udp)://(?P<hostname>[-.\w]+)(:(?P<port>[0-9]+))?(/announce)?")
+
+    SUPPORTED_PROTOCOLS = ["http", "udp"]
 
     logger = logging.getLogger('tracker')
 
@@ -18,7 +20,7 @@ class Tracker:
         if match is None:
             raise Tracker.Exception("Invalid Tracker URL scheme: {}".format(self.url))
         self.protocol = match.group("protocol")
-        if self.protocol != "http":
+        if self.protocol not in Tracker.SUPPORTED_PROTOCOLS:
             raise Tracker.Exception("Unsupported protocol ({})".format(self.protocol))
         self.hostname = match.group("hostname")
         self.port = match.group("port")
@@ -0,0 +1,182 @@
+import time
+import random
+import socket
+import struct
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.peerinteract.peer import Peer
+from torrentclient.trackerinteract.tracker import Tracker
+from torrentclient.trackerinteract.requestpeers import RequestPeers
+from torrentclient.trackerinteract.handleresponse import HandleResponse
+
+
+class UdpAnnounce:
+    """Data class of a UDP tracker announce response"""
+
+    def __init__(self, interval: int, leechers: int, seeders: int, peers: List[Peer]):
+        self.interval = interval
+        self.leechers = leechers
+        self.seeders = seeders
+        self.peers = peers
+
+    def __str__(self):
+        return "UdpAnnounce(interval={}, leechers={}, seeders={}, peers={})".format(
+            self.interval, self.leechers, self.seeders, len(self.peers))
+
+
+class UdpTrackerProtocol(asyncio.DatagramProtocol):
+    """Matches datagrams from a UDP tracker to the pending requests by their transaction ID"""
+
+    def __init__(self):
+        self.pending = {}  # type: Dict[int, asyncio.Future]
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from(">I", data, 4)[0]
+        future = self.pending.pop(transaction_id, None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc: Exception):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+
+class UdpTracker:
+    """Client of a single BitTorrent UDP tracker (BEP 15).
+    A connect exchange gets a connection ID which is reused for CONNECTION_ID_TTL,
+    so announces of many torrents to the same tracker share it and its socket.
+    Requests are retransmitted with an exponential backoff while no response arrives."""
+
+    PROTOCOL_ID = 0x41727101980
+
+    ACTION_CONNECT = 0
+    ACTION_ANNOUNCE = 1
+    ACTION_ERROR = 3
+
+    EVENTS = {None: 0, "completed": 1, "started": 2, "stopped": 3}
+
+    CONNECTION_ID_TTL = 60  # [seconds]
+
+    BASE_TIMEOUT = 2  # [seconds]
+    MAX_RETRIES = 3
+    """a request waits BASE_TIMEOUT * 2 ** n seconds for its n-th transmission before retransmitting"""
+
+    KEY = random.getrandbits(32)
+    """identifies this client to trackers across IP address changes"""
+
+    logger = logging.getLogger('udp-tracker')
+
+    class Exception(Exception):
+        """An exception with a UDP tracker occurred"""
+
+    def __init__(self, tracker: Tracker):
+        """
+        :param tracker: Tracker of a udp:// URL
+        """
+        if tracker.protocol != "udp" or tracker.port is None:
+            raise UdpTracker.Exception("Not a UDP tracker URL with a port: {}".format(tracker.url))
+        self.tracker = tracker
+        self.address = (tracker.hostname, int(tracker.port))
+        self.transport = None
+        self.protocol = None
+        self.connection_id = None
+        self.connected_at = 0
+        self.lock = asyncio.Lock()
+
+    def __str__(self):
+        return "UdpTracker({}:{})".format(*self.address)
+
+    async def _open(self):
+        if self.transport is None:
+            loop = asyncio.get_running_loop()
+            try:
+                self.transport, self.protocol = await loop.create_datagram_endpoint(
+                    UdpTrackerProtocol, remote_addr=self.address)
+            except OSError as e:
+                raise UdpTracker.Exception("Could not open a socket to {}: {}".format(self, e))
+
+    async def _transact(self, build_request, action: int) -> bytes:
+        """sends the request built with a new transaction ID until a response arrives,
+        returns the response. raises an exception if the tracker did not respond or responded with an error"""
+        await self._open()
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.MAX_RETRIES + 1):
+            transaction_id = random.getrandbits(32)
+            request = await build_request(transaction_id)
+            future = loop.create_future()
+            self.protocol.pending[transaction_id] = future
+            self.transport.sendto(request)
+            try:
+                response = await asyncio.wait_for(future, self.BASE_TIMEOUT * 2 ** attempt)
+            except asyncio.TimeoutError:
+                self.logger.debug("No response from %s to transmission #%d", self, attempt + 1)
+                continue
+            except OSError as e:
+                raise UdpTracker.Exception("Could not reach {}: {}".format(self, e))
+            finally:
+                self.protocol.pending.pop(transaction_id, None)
+            response_action = struct.unpack_from(">I", response)[0]
+            if response_action == self.ACTION_ERROR:
+                raise UdpTracker.Exception("{} responded with error: {}".format(
+                    self, response[8:].decode("utf-8", "replace")))
+            if response_action != action:
+                raise UdpTracker.Exception("{} responded with action {}, expected {}".format(
+                    self, response_action, action))
+            return response
+        raise UdpTracker.Exception("{} did not respond to {} transmissions".format(self, self.MAX_RETRIES + 1))
+
+    async def _connection_id(self) -> int:
+        """returns the connection ID, connecting again if it expired"""
+        async with self.lock:  # concurrent announces wait for a single connect
+            if self.connection_id is None or time.monotonic() - self.connected_at > self.CONNECTION_ID_TTL:
+                async def build_connect(transaction_id: int) -> bytes:
+                    return struct.pack(">QII", self.PROTOCOL_ID, self.ACTION_CONNECT, transaction_id)
+                response = await self._transact(build_connect, self.ACTION_CONNECT)
+                if len(response) < 16:
+                    raise UdpTracker.Exception("Connect response of {} bytes from {}".format(len(response), self))
+                self.connection_id = struct.unpack_from(">Q", response, 8)[0]
+                self.connected_at = time.monotonic()
+                self.logger.debug("Connected to %s", self)
+            return self.connection_id
+
+    async def announce(self, torrent: MyTorrent, uploaded: int = 0, downloaded: int = 0, left: Optional[int] = None,
+                       event: Optional[str] = "started", num_want: int = -1, port: Optional[int] = None) -> UdpAnnounce:
+        """announces a torrent, returns the tracker's response
+        :param left: number of bytes still missing, the torrent's total length if None
+        :param event: one of EVENTS
+        :param num_want: number of peers wanted, -1 for the tracker's default
+        :param port: port peers can connect to, the first free local port if None
+        """
+        if port is None:
+            port = RequestPeers._get_local_port()
+
+        async def build_announce(transaction_id: int) -> bytes:
+            # the connection ID may expire between retransmissions
+            return struct.pack(">QII20s20sQQQIIIiH", await self._connection_id(), self.ACTION_ANNOUNCE,
+                               transaction_id, torrent.infohash, Peer.LOCAL_PEER_ID, downloaded,
+                               torrent.total_length if left is None else left, uploaded, self.EVENTS[event],
+                               0, self.KEY, num_want, port)
+        response = await self._transact(build_announce, self.ACTION_ANNOUNCE)
+        if len(response) < 20:
+            raise UdpTracker.Exception("Announce response of {} bytes from {}".format(len(response), self))
+        interval, leechers, seeders = struct.unpack_from(">III", response, 8)
+        try:
+            # trackers reached over IPv6 send IPv6 addresses of the peers
+            ipv6 = self.transport.get_extra_info('socket').family == socket.AF_INET6
+            peers = HandleResponse.parse_compact_peers(response[20:], Peer.IPV6_LENGTH if ipv6 else Peer.IPV4_LENGTH)
+        except HandleResponse.Exception as e:
+            raise UdpTracker.Exception("Invalid announce response from {}: {}".format(self, e))
+        return UdpAnnounce(interval, leechers, seeders, peers)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            self.protocol = None
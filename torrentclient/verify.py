@@ -0,0 +1,35 @@
+import argparse
+
+from torrentclient import logconfig
+from torrentclient.mytorrent import MyTorrent
+from torrentclient.diskinteract.storage import Storage
+from torrentclient.diskinteract.recheck import Recheck, RecheckResult
+from torrentclient.diskinteract.resume import FastResume
+
+
+def verify_files(torrent_path: str, root: str = Storage.ROOT, workers: int = Recheck.WORKERS) -> RecheckResult:
+    """hashes all pieces of existing data, and writes the pieces which match their hash to the resume file,
+    so the download only gets the missing and bad pieces
+    :param root: folder of the downloaded files
+    """
+    torrent = MyTorrent.read(filepath=torrent_path)
+    storage = Storage(torrent, root=root)
+    result = Recheck(torrent, storage, workers).check()
+    resume = FastResume(torrent, storage)
+    resume.update(result.bitfield)
+    resume.save(clean=True)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='torrentclient-verify')
+    parser.add_argument("path")
+    parser.add_argument("--root", default=Storage.ROOT, help="folder of the downloaded files")
+    parser.add_argument("--workers", type=int, default=Recheck.WORKERS, help="number of hashing threads")
+    parser.add_argument("--log-level", default=logconfig.DEFAULT_LEVEL)
+    args = parser.parse_args()
+    logconfig.configure(*logconfig.parse_levels(args.log_level))
+    result = verify_files(torrent_path=args.path, root=args.root, workers=args.workers)
+    print(result)
+    if result.bad_pieces:
+        print("Bad pieces: {}".format(", ".join(str(piece_idx) for piece_idx in result.bad_pieces)))